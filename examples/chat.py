@@ -109,6 +109,7 @@ if args.draft_model_dir:
 
     draft_config.max_seq_len = model.config.max_seq_len
     draft_config.no_flash_attn = args.no_flash_attn
+    draft_config.attn_backend = args.attn_backend
     draft_config.scale_pos_emb = args.rope_scale
 
     print(" -- Loading draft model...")
@@ -148,11 +149,14 @@ def format_prompt(user_prompt, first):
         return prompt_format.subs_prompt() \
             .replace("<|user_prompt|>", user_prompt)
 
+# Formatted prompts are encoded again every turn as the context is rebuilt, so go through the tokenizer's bounded
+# cache instead of encoding each one from scratch
+
 def encode_prompt(text):
     global tokenizer, prompt_format
 
     add_bos, add_eos, encode_special_tokens = prompt_format.encoding_options()
-    return tokenizer.encode(text, add_bos = add_bos, add_eos = add_eos, encode_special_tokens = encode_special_tokens)
+    return tokenizer.cached_encode_str(text, add_bos = add_bos, add_eos = add_eos, encode_special_tokens = encode_special_tokens)
 
 user_prompts = []
 responses_ids = []
@@ -1,9 +1,28 @@
 from exllamav2.version import __version__
+import importlib
 
-from exllamav2.model import ExLlamaV2
-from exllamav2.cache import ExLlamaV2CacheBase
-from exllamav2.cache import ExLlamaV2Cache
-from exllamav2.cache import ExLlamaV2Cache_8bit
-from exllamav2.config import ExLlamaV2Config
-from exllamav2.tokenizer import ExLlamaV2Tokenizer
-from exllamav2.lora import ExLlamaV2Lora
+# Public classes are imported on first access. Modules that need the C++/CUDA extension (model, cache, LoRA) are only
+# loaded when used, so the config and tokenizer can be imported on their own
+
+_lazy_imports = \
+{
+    "ExLlamaV2": "exllamav2.model",
+    "ExLlamaV2CacheBase": "exllamav2.cache",
+    "ExLlamaV2Cache": "exllamav2.cache",
+    "ExLlamaV2Cache_8bit": "exllamav2.cache",
+    "ExLlamaV2Config": "exllamav2.config",
+    "ExLlamaV2Tokenizer": "exllamav2.tokenizer",
+    "ExLlamaV2Lora": "exllamav2.lora",
+}
+
+__all__ = list(_lazy_imports.keys())
+
+def __getattr__(name):
+    if name not in _lazy_imports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_lazy_imports[name]), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_lazy_imports.keys()))
@@ -8,25 +8,144 @@ from exllamav2.linear import ExLlamaV2Linear
 from exllamav2.cache import ExLlamaV2CacheBase
 from exllamav2.embedding import ExLlamaV2Embedding
 import math
+from collections import OrderedDict
 from exllamav2 import ext
 from exllamav2.ext import exllamav2_ext as ext_c
 # import xformers.ops as xops
 # from exllamav2.util import list_live_tensors, set_snapshot, diff_snapshot, print_vram_usage_peak
 from exllamav2.compat import safe_move_tensor
+from exllamav2.attn_backend import select_attn_backend, attn_temp_size, ExLlamaV2AttnMatmul
 
-# Detect flash-attn
+# Attention masks shared by all layers and reused across forward passes. Causal masks for a given chunk length are
+# views into one buffer per device, with the triangular part at the right end so the mask for any past_len is a
+# slice of it. Masks with a padding mask are kept in absolute positions per (device, batch size, chunk length) and
+# updated in place as past_len changes, by restoring the columns under the previous triangle and masking the new
+# ones, so successive chunks and decode steps don't allocate new masks. A different input_mask tensor (matched by
+# identity, and assumed not to be modified in place) rebuilds the entry in its existing buffer. At most max_entries
+# are kept, least recently used first out.
+#
+# Masks for multi-token chunks are quadratic in size, so their buffers are only as wide as the current chunk needs
+# (rounded up to 256 columns), i.e. no larger than the per-chunk mask the split planner budgets for, and
+# ExLlamaV2.forward releases them at the end of every multi-token pass. Single-token masks are linear in size, grow
+# geometrically and are kept across decode steps.
+#
+# Returned masks are views into the cache, valid until the next call for the same device and shape
+
+class ExLlamaV2AttnMaskCache:
+
+    max_entries: int = 4
+    entries: OrderedDict        # (device, batch_size, seq_len, masked) -> dict of tensors and state
+
+    def __init__(self, max_entries = 4):
+
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+
+    def clear(self):
+
+        self.entries = OrderedDict()
+
+
+    def release_prefill(self):
+
+        for key in [k for k in self.entries if k[2] > 1]: del self.entries[key]
+
+
+    def tensors(self):
+
+        return [t for entry in self.entries.values() for k, t in entry.items() if isinstance(t, torch.Tensor) and k != "input_mask"]
+
+
+    def get_entry(self, device, batch_size, seq_len, masked):
+
+        key = (str(device), batch_size, seq_len, masked)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = { "buffer": None, "pad": None, "triu": None, "input_mask": None, "past_len": None }
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries: self.entries.popitem(last = False)
+        else:
+            self.entries.move_to_end(key)
+        return entry
+
+
+    @staticmethod
+    def buffer_width(width, current, seq_len):
+
+        if seq_len > 1: return (width + 255) // 256 * 256
+        return (max(width, 2 * current) + 255) // 256 * 256
+
+
+    @staticmethod
+    def apply_triu(entry, buffer, past_len, seq_len, device):
+
+        if seq_len == 1: return
+        if entry["triu"] is None:
+            entry["triu"] = torch.ones((seq_len - 1, seq_len - 1), dtype = torch.bool, device = device).triu()
+        buffer[:, :, : seq_len - 1, past_len + 1 : past_len + seq_len].masked_fill_(entry["triu"], float("-inf"))
+
+
+    def get(self, batch_size, seq_len, past_len, input_mask, device):
+
+        if input_mask is None: return self.get_causal(seq_len, past_len, device)
+        return self.get_masked(batch_size, seq_len, past_len, input_mask, device)
+
+
+    def get_causal(self, seq_len, past_len, device):
+
+        width = past_len + seq_len
+        entry = self.get_entry(device, 1, seq_len, False)
+
+        buffer = entry["buffer"]
+        if buffer is None or buffer.shape[-1] < width:
+            w = self.buffer_width(width, 0 if buffer is None else buffer.shape[-1], seq_len)
+            entry["buffer"] = None
+            buffer = torch.zeros((1, 1, seq_len, w), dtype = torch.float16, device = device)
+            self.apply_triu(entry, buffer, w - seq_len, seq_len, device)
+            entry["buffer"] = buffer
+
+        w = buffer.shape[-1]
+        return buffer.narrow(-1, w - width, width)
+
+
+    def get_masked(self, batch_size, seq_len, past_len, input_mask, device):
+
+        width = past_len + seq_len
+        entry = self.get_entry(device, batch_size, seq_len, True)
+
+        buffer = entry["buffer"]
+        if buffer is None or buffer.shape[-1] < width:
+            w = self.buffer_width(width, 0 if buffer is None else buffer.shape[-1], seq_len)
+            entry["buffer"] = None
+            entry["pad"] = None
+            buffer = torch.empty((batch_size, 1, seq_len, w), dtype = torch.float16, device = device)
+            entry["buffer"] = buffer
+            entry["pad"] = torch.empty((batch_size, 1, 1, w), dtype = torch.float16, device = device)
+            entry["input_mask"] = None
+
+        # Padding mask, clamped since the causal part is combined with it by taking the minimum
+
+        pad = entry["pad"]
+        if entry["input_mask"] is not input_mask:
+            mask_width = min(input_mask.shape[-1], pad.shape[-1])
+            pad.zero_()
+            pad[:, 0, 0, :mask_width] = safe_move_tensor(input_mask[:, :mask_width], device).clamp(max = 0)
+            buffer.copy_(pad.expand_as(buffer))
+            entry["input_mask"] = input_mask
+            entry["past_len"] = None
+
+        # Move the triangle
+
+        if entry["past_len"] != past_len:
+            prev = entry["past_len"]
+            if prev is not None and seq_len > 1:
+                buffer[:, :, :, prev + 1 : prev + seq_len] = pad[:, :, :, prev + 1 : prev + seq_len]
+            self.apply_triu(entry, buffer, past_len, seq_len, device)
+            entry["past_len"] = past_len
+
+        return buffer.narrow(-1, 0, width)
 
-has_flash_attn = False
-try:
-    import flash_attn
-    flash_attn_ver = [int(t) for t in flash_attn.__version__.split(".") if t.isdigit()]
-    is_ampere_or_newer_gpu = any(torch.cuda.get_device_properties(i).major >= 8 for i in range(torch.cuda.device_count()))
-    
-    if flash_attn_ver >= [2, 2, 1] and is_ampere_or_newer_gpu:
-        from flash_attn import flash_attn_func
-        has_flash_attn = True
-except ModuleNotFoundError:
-    pass
 
 class ExLlamaV2Attention(ExLlamaV2Module):
 
@@ -55,7 +174,7 @@ class ExLlamaV2Attention(ExLlamaV2Module):
 
     class Params:
 
-        def __init__(self, batch_size, seq_len, past_len, input_mask, position_offsets):
+        def __init__(self, batch_size, seq_len, past_len, input_mask, position_offsets, mask_cache = None):
 
             self.batch_size = batch_size
             self.seq_len = seq_len
@@ -70,7 +189,8 @@ class ExLlamaV2Attention(ExLlamaV2Module):
             self.input_mask = input_mask
 
             self.attn_mask = None
-            self.attn_masks = None
+            self.multi_cache_mask = None
+            self.mask_cache = mask_cache
 
             self.position_offsets = position_offsets
             self.past_lens_tensor = None
@@ -104,23 +224,46 @@ class ExLlamaV2Attention(ExLlamaV2Module):
             if self.attn_mask is None:
                 self.attn_mask = self.build_attn_mask(device)
             elif self.attn_mask.device != device:
-                self.attn_mask = safe_move_tensor(self.attn_mask, device)
+                if self.mask_cache is not None:
+                    self.attn_mask = self.build_attn_mask(device)
+                else:
+                    self.attn_mask = safe_move_tensor(self.attn_mask, device)
             return self.attn_mask
 
 
-        def get_attn_masks(self, device):
+        def get_multi_cache_mask(self, device):
+
+            if self.multi_cache_mask is None or self.multi_cache_mask.device != device:
+                self.multi_cache_mask = self.build_multi_cache_mask(device)
+            return self.multi_cache_mask
+
 
-            if self.attn_masks is None:
-                self.attn_masks = self.build_attn_masks(device)
-            elif self.attn_masks[0] is not None and self.attn_masks[0].device != device:
-                self.attn_masks = [(safe_move_tensor(m, device) if m is not None else None) for m in self.attn_masks]
-            return self.attn_masks
+        # Mask for attention over keys from multiple caches padded to the longest sequence. Query row r of sequence i
+        # is at position past_lens[i] + r and sees keys up to that position, which also masks out the padding
+
+        def build_multi_cache_mask(self, device):
+            assert self.multi_cache, "Building multi-cache mask for single cache"
+
+            max_len = max(self.past_lens) + self.seq_len
+            q_pos = self.get_past_lens(device).unsqueeze(1) + torch.arange(self.seq_len, device = device).unsqueeze(0)
+            k_pos = torch.arange(max_len, device = device)
+
+            attn_mask = torch.zeros((len(self.past_lens), 1, self.seq_len, max_len), dtype = torch.float16, device = device)
+            attn_mask.masked_fill_(k_pos.view(1, 1, 1, -1) > q_pos.unsqueeze(1).unsqueeze(-1), float("-inf"))
+
+            if self.input_mask is not None:
+                min_mask_width = min(self.input_mask.shape[-1], max_len)
+                input_mask_part = safe_move_tensor(self.input_mask[:, :min_mask_width], device)
+                input_mask_part = input_mask_part.unsqueeze(1).unsqueeze(2)
+                attn_mask[:, :, :, :min_mask_width] = torch.minimum(attn_mask[:, :, :, :min_mask_width], input_mask_part)
+
+            return attn_mask
 
 
         def build_single_attn_mask(self, batch_size, seq_len, past_len, device, input_mask):
 
             attn_mask = torch.zeros((batch_size, 1, seq_len, past_len + seq_len), dtype = torch.float16, device = device)
-            attn_mask_triu = torch.triu(torch.full((seq_len - 1, seq_len - 1), float("-inf")))
+            attn_mask_triu = torch.triu(torch.full((seq_len - 1, seq_len - 1), float("-inf"), device = device))
             attn_mask[:, :, : seq_len - 1, past_len + 1: past_len + seq_len] = attn_mask_triu
 
             if input_mask is not None:
@@ -136,21 +279,10 @@ class ExLlamaV2Attention(ExLlamaV2Module):
             assert not self.multi_cache, "Building single mask for multiple caches"
 
             if self.input_mask is None and self.seq_len == 1: return None
+            if self.mask_cache is not None:
+                return self.mask_cache.get(self.batch_size, self.seq_len, self.past_len, self.input_mask, device)
             return self.build_single_attn_mask(self.batch_size, self.seq_len, self.past_len, device, self.input_mask)
 
-
-        def build_attn_masks(self, device):
-            assert self.multi_cache, "Building multiple masks for single cache"
-
-            attn_masks = []
-            for i, past_len in enumerate(self.past_lens):
-                if self.input_mask is None and self.seq_len == 1:
-                    attn_masks.append(None)
-                else:
-                    attn_masks.append(self.build_single_attn_mask(1, self.seq_len, past_len, device, self.input_mask[i]))
-            return attn_masks
-
-
     def __init__(self, model, key, layer_idx):
         super().__init__(model, key)
 
@@ -300,15 +432,9 @@ class ExLlamaV2Attention(ExLlamaV2Module):
 
 
     def temp_attn_size(self):
-        global has_flash_attn
 
         att_max = min(self.model.config.max_attention_size, self.model.config.max_seq_len ** 2)
-
-        if has_flash_attn and not self.model.config.no_flash_attn:
-            eff = self.model.config.max_attention_size ** 0.5 / 190  # based on supposed memory savings listed in flash-attn repo + some fudging
-            att_max //= eff
-
-        return 2 * att_max * self.model.config.num_attention_heads * 2 + 128
+        return attn_temp_size(self.model.config, att_max)
 
 
     def set_device_idx(self, idx):
@@ -323,17 +449,53 @@ class ExLlamaV2Attention(ExLlamaV2Module):
 
     def repeat_kv(self, hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
 
-        if n_rep == 1: return hidden_states
+        return ExLlamaV2AttnMatmul.repeat_kv(hidden_states, n_rep)
 
-        batch, num_key_value_heads, slen, head_dim = hidden_states.shape
-        hidden_states = hidden_states[:, :, None, :, :].expand(batch, num_key_value_heads, n_rep, slen, head_dim)
-        hidden_states = hidden_states.reshape(batch, num_key_value_heads * n_rep, slen, head_dim)
-        return hidden_states
 
+    # Attention over multiple caches, one sequence per cache with its own past_len. New keys/values are written to each
+    # cache, then gathered with the cache contents into K/V tensors padded to the longest sequence, and attention is
+    # computed for the whole batch at once by a masking attention backend, with a mask covering both the causal part
+    # and the padding. Returns the attention output with shape (batch_size, q_len, num_attention_heads, head_dim)
+    #
+    # The caches are separate allocations, so there is no view spanning them and the gather copies every sequence's
+    # K/V history on every layer: O(total context) extra memory traffic per layer, in exchange for one kernel launch
+    # sequence instead of one per cache. This pays off for many short or similar-length sequences, where launch
+    # overhead dominates, and costs most for few long ragged ones. tests/test_multi_cache_attn.py times both against
+    # a per-cache loop
+
+    def multi_cache_attn(self, q_states, k_states, v_states, cache, attn_params, past_len):
+
+        head_dim = self.model.config.head_dim
+
+        batch_size, q_len, num_key_value_heads, _ = k_states.shape
+        max_len = max(past_len) + q_len
+
+        keys = torch.empty((batch_size, max_len, num_key_value_heads, head_dim), dtype = k_states.dtype, device = k_states.device)
+        values = torch.empty_like(keys)
+
+        for i in range(len(cache)):
+
+            # Add keys and values to cache
+
+            batch_keys, batch_values = cache[i].get_kv_state(self.layer_idx, 1, 0, past_len[i])
+            batch_keys.narrow(1, past_len[i], q_len).copy_(k_states.narrow(0, i, 1))
+            batch_values.narrow(1, past_len[i], q_len).copy_(v_states.narrow(0, i, 1))
+            cache[i].store_kv_state(self.layer_idx, 1, past_len[i], q_len)
+
+            # Gather key/value tensors with past. Padding is masked out but must be finite, so zero it
+
+            seq_len = past_len[i] + q_len
+            keys[i, :seq_len].copy_(batch_keys[0, :seq_len])
+            values[i, :seq_len].copy_(batch_values[0, :seq_len])
+            if seq_len < max_len:
+                keys[i, seq_len:].zero_()
+                values[i, seq_len:].zero_()
+
+        backend = select_attn_backend(self.model.config, q_states, keys, True)
+        return backend.forward(q_states, keys, values, attn_params.get_multi_cache_mask(q_states.device))
 
-    def forward(self, hidden_states, cache = None, attn_params = None, past_len = None, intermediates = False, loras = None):
-        global has_flash_attn
 
+    def forward(self, hidden_states, cache = None, attn_params = None, past_len = None, intermediates = False, loras = None):
         if self.q_handle is None or intermediates:
             return self.forward_torch(hidden_states, cache, attn_params, past_len, intermediates, loras = loras)
 
@@ -440,59 +602,19 @@ class ExLlamaV2Attention(ExLlamaV2Module):
                     k_states = batch_keys.narrow(0, 0, batch_size).narrow(1, 0, past_len + q_len)
                     v_states = batch_values.narrow(0, 0, batch_size).narrow(1, 0, past_len + q_len)
 
-            # Torch matmul attention
-
-            if self.model.config.no_flash_attn or not has_flash_attn or not attn_params.is_causal():
-
-                q_states = q_states.transpose(1, 2)
-                k_states = k_states.transpose(1, 2)
-                v_states = v_states.transpose(1, 2)
-
-                k_states = self.repeat_kv(k_states, num_key_value_groups)
-                k_states = k_states.transpose(-1, -2)
-
-                attn_weights = torch.matmul(q_states, k_states)
-                k_states = None
-                q_states = None
-
-                attn_weights /= math.sqrt(head_dim)
-                attn_mask = attn_params.get_attn_mask(hidden_states.device)
-                if attn_mask is not None: attn_weights = attn_weights + attn_mask
-                attn_weights = nn.functional.softmax(attn_weights, dim = -1, dtype = torch.float16)
-
-                v_states = self.repeat_kv(v_states, num_key_value_groups)
-                attn_output = torch.matmul(attn_weights, v_states)
-                v_states = None
+            # Attention backend selected by capability, see attn_backend.py
 
-                attn_output = attn_output.transpose(1, 2)
-                attn_output = attn_output.reshape((batch_size, q_len, hidden_size))
-
-            # Flash Attention 2
-
-            else:
-
-                # TODO: Enable flash-attn with input mask
-                attn_output = flash_attn_func(q_states, k_states, v_states, causal = True)
-                attn_output = attn_output.reshape((batch_size, q_len, hidden_size))
+            backend = select_attn_backend(self.model.config, q_states, k_states, not attn_params.is_causal())
+            attn_mask = attn_params.get_attn_mask(hidden_states.device) if backend.supports_mask else None
+            attn_output = backend.forward(q_states, k_states, v_states, attn_mask)
+            attn_output = attn_output.reshape((batch_size, q_len, hidden_size))
+            attn_mask = None
 
             # xformers memory_efficient_attention
 
             # attn_output = xops.memory_efficient_attention(q_states, k_states, v_states, attn_bias = xops.LowerTriangularMask())
             # attn_output = attn_output.reshape((batch_size, q_len, hidden_size));
 
-            # Torch SDP attention:
-
-            # q_states = q_states.transpose(1, 2)
-            # k_states = k_states.transpose(1, 2)
-            # v_states = v_states.transpose(1, 2)
-            #
-            # # k_states = self.repeat_kv(k_states, num_key_value_groups)
-            # # v_states = self.repeat_kv(v_states, num_key_value_groups)
-            #
-            # attn_output = F.scaled_dot_product_attention(q_states, k_states, v_states, attn_mask = attn_mask, is_causal = False)
-            # attn_output = attn_output.transpose(1, 2)
-            # attn_output = attn_output.reshape((batch_size, q_len, hidden_size))
-
             # Update 8-bit cache
 
             if cache is not None:
@@ -503,61 +625,11 @@ class ExLlamaV2Attention(ExLlamaV2Module):
         else:
 
             assert attn_params.multi_cache
-            attn_masks = attn_params.get_attn_masks(hidden_states.device)
-
-            attn_outputs = []
-            for i in range(len(cache)):
-
-                # TODO: Once nested tensors are finalized in Torch, this could all be batched, probably
-
-                # Add keys and values to cache
-
-                batch_keys, batch_values = cache[i].get_kv_state(self.layer_idx, 1, 0, past_len[i])
-                new_keys = batch_keys.narrow(1, past_len[i], q_len)
-                new_values = batch_values.narrow(1, past_len[i], q_len)
-                new_keys.copy_(k_states.narrow(0, i, 1))
-                new_values.copy_(v_states.narrow(0, i, 1))
-
-                # Store updated cache values
-
-                cache[i].store_kv_state(self.layer_idx, 1, past_len[i], q_len)
-
-                # Key/value tensors with past
-
-                k_states_b = batch_keys.narrow(1, 0, past_len[i] + q_len)
-                v_states_b = batch_values.narrow(1, 0, past_len[i] + q_len)
-
-                # Torch matmul attention
-
-                # TODO: enable flash-attn
-
-                q_states_b = q_states.transpose(1, 2).narrow(0, i, 1)
-                k_states_b = k_states_b.transpose(1, 2)
-                v_states_b = v_states_b.transpose(1, 2)
-
-                k_states_b = self.repeat_kv(k_states_b, num_key_value_groups)
-                k_states_b = k_states_b.transpose(-1, -2)
-
-                attn_weights = torch.matmul(q_states_b, k_states_b)
-                q_states_b = None
-                k_states_b = None
-
-                attn_weights /= math.sqrt(head_dim)
-                if attn_masks[i] is not None: attn_weights = attn_weights + attn_masks[i]
-                attn_weights = nn.functional.softmax(attn_weights, dim = -1, dtype = torch.float16)
-
-                v_states_b = self.repeat_kv(v_states_b, num_key_value_groups)
-                attn_output_b = torch.matmul(attn_weights, v_states_b)
-                v_states_b = None
-
-                attn_outputs.append(attn_output_b)
-
+            attn_output = self.multi_cache_attn(q_states, k_states, v_states, cache, attn_params, past_len)
             q_states = None
             k_states = None
             v_states = None
 
-            attn_output = torch.cat(attn_outputs, dim = 0)
-            attn_output = attn_output.transpose(1, 2)
             attn_output = attn_output.reshape((batch_size, q_len, hidden_size))
 
         # Output projection
@@ -640,35 +712,12 @@ class ExLlamaV2Attention(ExLlamaV2Module):
             key_states = batch_keys.narrow(1, 0, past_len + q_len).narrow(0, 0, batch_size)
             value_states = batch_values.narrow(1, 0, past_len + q_len).narrow(0, 0, batch_size)
 
-        # Torch matmul attention
-
-        if self.model.config.no_flash_attn or not has_flash_attn or not attn_params.is_causal():
-
-            query_states = query_states.transpose(1, 2)
-            key_states = key_states.transpose(1, 2)
-            value_states = value_states.transpose(1, 2)
-
-            key_states = self.repeat_kv(key_states, self.model.config.num_key_value_groups)
-            key_states = key_states.transpose(-1, -2)
-
-            attn_weights = torch.matmul(query_states, key_states)
-            attn_weights /= math.sqrt(head_dim)
-            attn_mask = attn_params.get_attn_mask(hidden_states.device)
-            if attn_mask is not None: attn_weights = attn_weights + attn_mask
-            attn_weights = nn.functional.softmax(attn_weights, dim = -1, dtype = torch.float16)
+        # Attention backend selected by capability, see attn_backend.py
 
-            value_states = self.repeat_kv(value_states, self.model.config.num_key_value_groups)
-            attn_output = torch.matmul(attn_weights, value_states)
-
-            attn_output = attn_output.transpose(1, 2)
-            attn_output = attn_output.reshape((batch_size, q_len, hidden_size))
-
-        # Flash Attention 2
-
-        else:
-
-            attn_output = flash_attn_func(query_states, key_states, value_states, causal = True)
-            attn_output = attn_output.reshape((batch_size, q_len, hidden_size))
+        backend = select_attn_backend(self.model.config, query_states, key_states, not attn_params.is_causal())
+        attn_mask = attn_params.get_attn_mask(hidden_states.device) if backend.supports_mask else None
+        attn_output = backend.forward(query_states, key_states, value_states, attn_mask)
+        attn_output = attn_output.reshape((batch_size, q_len, hidden_size))
 
         # Update 8-bit cache
         # TODO: Only update changed positions of the cache
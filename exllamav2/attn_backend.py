@@ -0,0 +1,289 @@
+import torch
+from torch import nn
+import torch.nn.functional as F
+import inspect
+import math
+
+# Attention backends. Each backend computes softmax(Q K^T / sqrt(head_dim) + mask) V for tensors in the layout the
+# attention module produces them in:
+#
+#   q: (batch_size, q_len, num_attention_heads, head_dim)
+#   k, v: (batch_size, kv_len, num_key_value_heads, head_dim), with the last q_len positions matching the queries
+#   attn_mask: additive mask broadcastable to (batch_size, 1, q_len, kv_len), or None
+#
+# and returns the output as (batch_size, q_len, num_attention_heads, head_dim). Backends that support masks are passed
+# the full mask from the attention params (causal part included, None for unmasked single-token passes). Backends
+# without mask support apply causal masking aligned to the end of the keys themselves, and are only selected when
+# there is no padding mask.
+#
+# Backends are tried in registration order and the first one that is available and supports the call (mask, grouped
+# K/V heads, dtype, device) is used. config.attn_backend forces a backend by name, and config.no_flash_attn skips
+# flash-attn. Selections are cached per combination of capabilities.
+
+# Detect flash-attn. Deferred until first needed so importing this module doesn't initialize CUDA
+
+has_flash_attn = None
+flash_attn_func = None
+
+def detect_flash_attn():
+    global has_flash_attn, flash_attn_func
+
+    if has_flash_attn is not None: return has_flash_attn
+
+    has_flash_attn = False
+    try:
+        import flash_attn
+        flash_attn_ver = [int(t) for t in flash_attn.__version__.split(".") if t.isdigit()]
+        is_ampere_or_newer_gpu = any(torch.cuda.get_device_properties(i).major >= 8 for i in range(torch.cuda.device_count()))
+
+        if flash_attn_ver >= [2, 2, 1] and is_ampere_or_newer_gpu:
+            from flash_attn import flash_attn_func
+            has_flash_attn = True
+    except ModuleNotFoundError:
+        pass
+
+    return has_flash_attn
+
+
+class ExLlamaV2AttnBackend:
+
+    name: str = None
+    supports_mask: bool = True              # Accepts an additive mask (otherwise causal only)
+    supports_gqa: bool = True               # Handles num_key_value_heads < num_attention_heads
+    device_types: set = { "cuda", "cpu" }
+    dtypes: set = { torch.float16, torch.bfloat16, torch.float32 }
+
+    def available(self):
+
+        return True
+
+
+    def supports(self, q, k, masked):
+
+        return self.supports_caps(masked, q.shape[2] != k.shape[2], q.device.type, q.dtype)
+
+
+    def supports_caps(self, masked, gqa, device_type, dtype):
+
+        if masked and not self.supports_mask: return False
+        if gqa and not self.supports_gqa: return False
+        if device_type not in self.device_types: return False
+        if dtype not in self.dtypes: return False
+        return True
+
+
+    # Scratch space for one call attending over att_max query/key pairs per head: attention weights and softmax
+    # output in FP16
+
+    def temp_size(self, config, att_max, masked):
+
+        return 2 * att_max * config.num_attention_heads * 2 + 128
+
+
+    def forward(self, q, k, v, attn_mask = None):
+
+        raise NotImplementedError
+
+
+# Reference implementation: matmul, softmax and matmul in FP16, with K/V repeated to the number of query heads
+
+class ExLlamaV2AttnMatmul(ExLlamaV2AttnBackend):
+
+    name = "matmul"
+
+    @staticmethod
+    def repeat_kv(hidden_states, n_rep):
+
+        if n_rep == 1: return hidden_states
+
+        batch, num_key_value_heads, slen, head_dim = hidden_states.shape
+        hidden_states = hidden_states[:, :, None, :, :].expand(batch, num_key_value_heads, n_rep, slen, head_dim)
+        hidden_states = hidden_states.reshape(batch, num_key_value_heads * n_rep, slen, head_dim)
+        return hidden_states
+
+
+    def forward(self, q, k, v, attn_mask = None):
+
+        num_key_value_groups = q.shape[2] // k.shape[2]
+        head_dim = q.shape[3]
+
+        q = q.transpose(1, 2)
+        k = self.repeat_kv(k.transpose(1, 2), num_key_value_groups)
+        k = k.transpose(-1, -2)
+
+        attn_weights = torch.matmul(q, k)
+        k = None
+        q = None
+
+        attn_weights /= math.sqrt(head_dim)
+        if attn_mask is not None: attn_weights = attn_weights + attn_mask
+        attn_weights = nn.functional.softmax(attn_weights, dim = -1, dtype = attn_weights.dtype)
+
+        v = self.repeat_kv(v.transpose(1, 2), num_key_value_groups)
+        attn_output = torch.matmul(attn_weights, v)
+        return attn_output.transpose(1, 2)
+
+
+# Flash Attention 2, causal only
+
+class ExLlamaV2AttnFlash(ExLlamaV2AttnBackend):
+
+    name = "flash_attn"
+    supports_mask = False
+    device_types = { "cuda" }
+    dtypes = { torch.float16, torch.bfloat16 }
+
+    def available(self):
+
+        return detect_flash_attn()
+
+
+    def temp_size(self, config, att_max, masked):
+
+        eff = config.max_attention_size ** 0.5 / 190  # based on supposed memory savings listed in flash-attn repo + some fudging
+        return super().temp_size(config, att_max // eff, masked)
+
+
+    def forward(self, q, k, v, attn_mask = None):
+
+        return flash_attn_func(q, k, v, causal = True)
+
+
+# torch.nn.functional.scaled_dot_product_attention. With grouped K/V heads, torch versions that support enable_gqa
+# handle them directly. Otherwise the query heads sharing a K/V head are folded into the sequence dimension, so each
+# K/V head is attended to by groups * q_len query rows and K/V never has to be repeated. Folding copies Q and the
+# mask, if any. Q is small next to K/V for the decode passes where it matters most, but the folded mask is groups
+# times the size of the mask, which temp_size reserves for
+
+class ExLlamaV2AttnSDPA(ExLlamaV2AttnBackend):
+
+    name = "sdpa"
+    enable_gqa: bool = None
+
+    def available(self):
+
+        if not hasattr(F, "scaled_dot_product_attention"): return False
+        if ExLlamaV2AttnSDPA.enable_gqa is None:
+            try:
+                ExLlamaV2AttnSDPA.enable_gqa = "enable_gqa" in inspect.signature(F.scaled_dot_product_attention).parameters
+            except (TypeError, ValueError):
+                ExLlamaV2AttnSDPA.enable_gqa = False
+        return True
+
+
+    # The fused CUDA kernels don't materialize the attention weights, so only the mask needs scratch space: one copy
+    # if it has to be converted to the input dtype, and groups more when it is folded
+
+    def temp_size(self, config, att_max, masked):
+
+        if not masked: return 128
+        groups = config.num_attention_heads // config.num_key_value_heads
+        copies = 1 + (groups if groups > 1 and not self.enable_gqa else 0)
+        return copies * att_max * 2 + 128
+
+
+    def forward(self, q, k, v, attn_mask = None):
+
+        batch_size, q_len, num_attention_heads, head_dim = q.shape
+        num_key_value_heads = k.shape[2]
+        groups = num_attention_heads // num_key_value_heads
+
+        k = k.transpose(1, 2)
+        v = v.transpose(1, 2)
+        if attn_mask is not None and attn_mask.dtype != q.dtype: attn_mask = attn_mask.to(q.dtype)
+
+        if groups == 1 or self.enable_gqa:
+            q = q.transpose(1, 2)
+            if groups == 1:
+                attn_output = F.scaled_dot_product_attention(q, k, v, attn_mask = attn_mask)
+            else:
+                attn_output = F.scaled_dot_product_attention(q, k, v, attn_mask = attn_mask, enable_gqa = True)
+            return attn_output.transpose(1, 2)
+
+        q = q.view(batch_size, q_len, num_key_value_heads, groups, head_dim)
+        q = q.permute(0, 2, 3, 1, 4).reshape(batch_size, num_key_value_heads, groups * q_len, head_dim)
+
+        if attn_mask is not None:
+            mask_batch, _, mask_q_len, kv_len = attn_mask.shape
+            attn_mask = attn_mask.unsqueeze(2).expand(mask_batch, 1, groups, mask_q_len, kv_len)
+            attn_mask = attn_mask.reshape(mask_batch, 1, groups * mask_q_len, kv_len)
+
+        attn_output = F.scaled_dot_product_attention(q, k, v, attn_mask = attn_mask)
+        attn_output = attn_output.view(batch_size, num_key_value_heads, groups, q_len, head_dim)
+        attn_output = attn_output.permute(0, 3, 1, 2, 4).reshape(batch_size, q_len, num_attention_heads, head_dim)
+        return attn_output
+
+
+_backends = []
+_selected = {}
+
+
+def register_attn_backend(backend, first = False):
+
+    global _selected
+    assert backend.name is not None, "Attention backend must have a name"
+    _backends[:] = [b for b in _backends if b.name != backend.name]
+    if first: _backends.insert(0, backend)
+    else: _backends.append(backend)
+    _selected = {}
+
+
+def get_attn_backend(name):
+
+    for backend in _backends:
+        if backend.name == name: return backend
+    raise ValueError(f"Unknown attention backend: {name}")
+
+
+def attn_backends():
+
+    return list(_backends)
+
+
+def select_attn_backend(config, q, k, masked):
+
+    return select_attn_backend_caps(config, masked, q.shape[2] != k.shape[2], q.device.type, q.dtype)
+
+
+def select_attn_backend_caps(config, masked, gqa, device_type, dtype):
+
+    key = (config.attn_backend, config.no_flash_attn, masked, gqa, device_type, dtype)
+    backend = _selected.get(key)
+    if backend is not None: return backend
+
+    if config.attn_backend is not None:
+        backend = get_attn_backend(config.attn_backend)
+        assert backend.available(), f"Attention backend {backend.name} is not available"
+        assert backend.supports_caps(masked, gqa, device_type, dtype), f"Attention backend {backend.name} does not support this input"
+
+    else:
+        for b in _backends:
+            if config.no_flash_attn and b.name == "flash_attn": continue
+            if b.available() and b.supports_caps(masked, gqa, device_type, dtype):
+                backend = b
+                break
+        assert backend is not None, "No attention backend supports this input"
+
+    _selected[key] = backend
+    return backend
+
+
+# Scratch space to reserve per device for attention over att_max query/key pairs per head, FP16 on the GPU. Masked
+# and unmasked calls may select different backends, so reserve for the larger of the two
+
+def attn_temp_size(config, att_max):
+
+    gqa = config.num_key_value_heads != config.num_attention_heads
+    forced = get_attn_backend(config.attn_backend) if config.attn_backend is not None else None
+
+    size = 0
+    for masked in [False, True]:
+        if forced is not None and not forced.supports_caps(masked, gqa, "cuda", torch.float16): continue
+        backend = select_attn_backend_caps(config, masked, gqa, "cuda", torch.float16)
+        size = max(size, backend.temp_size(config, att_max, masked))
+    return size
+
+
+register_attn_backend(ExLlamaV2AttnFlash())
+register_attn_backend(ExLlamaV2AttnSDPA())
+register_attn_backend(ExLlamaV2AttnMatmul())
@@ -1,7 +1,67 @@
 import torch
 from exllamav2.fasttensors import STFile
+from exllamav2.ready import find_ready
 import os, glob, json
 
+tensor_index_filename = "exllamav2_tensor_index.json"
+tensor_index_version = 1
+
+
+# Fingerprint of each .safetensors file (size and mtime), to tell if a cached tensor index is still valid
+
+def _file_stats(tensor_files):
+
+    stats = {}
+    for filename in tensor_files:
+        st = os.stat(filename)
+        stats[os.path.basename(filename)] = [st.st_size, st.st_mtime_ns]
+    return stats
+
+
+# Return dict of tensor key: filename (relative to model_dir) from a cached index written by _write_tensor_index or
+# from model.safetensors.index.json, whichever is valid for the files present, or None
+
+def _read_tensor_index(model_dir, tensor_files):
+
+    basenames = set(os.path.basename(f) for f in tensor_files)
+
+    cached_filename = os.path.join(model_dir, tensor_index_filename)
+    if os.path.exists(cached_filename):
+        try:
+            with open(cached_filename, encoding = "utf8") as f:
+                index = json.load(f)
+            if index["version"] == tensor_index_version and index["files"] == _file_stats(tensor_files):
+                return index["weight_map"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    hf_filename = os.path.join(model_dir, "model.safetensors.index.json")
+    if os.path.exists(hf_filename):
+        try:
+            with open(hf_filename, encoding = "utf8") as f:
+                weight_map = json.load(f)["weight_map"]
+            if set(weight_map.values()) == basenames:
+                return weight_map
+        except (OSError, ValueError, KeyError):
+            pass
+
+    return None
+
+
+def _write_tensor_index(model_dir, tensor_files, tensor_file_map):
+
+    index = { "version": tensor_index_version,
+              "files": _file_stats(tensor_files),
+              "weight_map": { k: os.path.basename(v) for k, v in tensor_file_map.items() } }
+    filename = os.path.join(model_dir, tensor_index_filename)
+    try:
+        with open(filename + ".tmp", "w", encoding = "utf8") as f:
+            json.dump(index, f)
+        os.replace(filename + ".tmp", filename)
+    except OSError:
+        print(f" !! Warning, unable to write tensor index to {filename}")
+
+
 class ExLlamaV2Config:
 
     debug_mode = False
@@ -16,6 +76,7 @@ class ExLlamaV2Config:
     scale_alpha_value: float = 1.0              # Alpha value for NTK RoPE scaling. Similar to compress_pos_emb but works without finetuned model
 
     no_flash_attn: bool = False                 # Implementation will automatically use flash-attn-2 when available
+    attn_backend: str = None                    # Force attention backend by name ("flash_attn", "sdpa", "matmul"), otherwise selected per call, see attn_backend.py
 
     # Loaded/set by .prepare():
 
@@ -23,6 +84,7 @@ class ExLlamaV2Config:
 
     model_config: str
     tensor_file_map: dict
+    tensor_key_index: dict                      # Tensor keys grouped under every dotted prefix, e.g. "model.layers.0.self_attn.q_proj"
     tensor_files: list
 
     tokenizer_path: str
@@ -48,6 +110,16 @@ class ExLlamaV2Config:
     checkpoint_fused_mlp: bool = False
 
     fasttensors: bool = False   # Experimental, Linux only
+    load_threads: int = 8                       # Threads reading tensors ahead of module loading, 0 to read sequentially
+    load_max_inflight: int = 1024 ** 3          # Max. number of bytes read ahead of module loading
+    mmap_cpu_tensors: bool = True               # Load CPU-resident tensors as views into memory-mapped .safetensors files
+    load_pinned: bool = True                    # Read ahead into pinned memory (when CUDA is available) for async uploads
+    cache_tensor_index: bool = False            # Save the resolved tensor map next to the model files to speed up .prepare() next time
+    use_decode_plan: bool = True                # Run single-token forward passes from a precomputed execution plan, see ExLlamaV2DecodePlan
+    use_ready_file: bool = True                 # Load from a ready-to-load container in model_dir if there is one, see ready.py
+
+    ready_file: str = None                      # Set by .prepare() when loading from a ready-to-load container
+    ready_layout: list = None                   # Manifest entry (key, name, tensors, range) for each module, in load order
 
 
     def __init__(self):
@@ -198,6 +270,22 @@ class ExLlamaV2Config:
         if no_tensors: return
 
         self.tensor_file_map = {}
+        self.ready_file = None
+        self.ready_layout = None
+
+        # Take the tensor map from the manifest of a ready-to-load container. The container was checked for missing
+        # layers when it was exported, and fused MLP weights are already split
+
+        if self.use_ready_file:
+            ready_file, manifest = find_ready(self.model_dir, fast = self.fasttensors)
+            if ready_file is not None:
+                self.ready_file = ready_file
+                self.ready_layout = manifest["modules"]
+                self.tensor_files = [ready_file]
+                self.checkpoint_fused_mlp = False
+                for m in self.ready_layout:
+                    for key in m["tensors"]: self.tensor_file_map[key] = ready_file
+                return
 
         st_pattern = os.path.join(self.model_dir, "*.safetensors")
         self.tensor_files = glob.glob(st_pattern)
@@ -205,10 +293,20 @@ class ExLlamaV2Config:
         if len(self.tensor_files) == 0:
             raise ValueError(f" ## No .safetensors files found in {self.model_dir}")
 
-        for st_file in self.tensor_files:
-            f = STFile.open(st_file, fast = self.fasttensors)
-            for key in f.get_dict():
-                self.tensor_file_map[key] = st_file
+        # Resolve tensor map from a previously cached index or the checkpoint's own index if either matches the
+        # files present, otherwise read every header
+
+        weight_map = _read_tensor_index(self.model_dir, self.tensor_files)
+        if weight_map is not None:
+            for key, filename in weight_map.items():
+                self.tensor_file_map[key] = os.path.join(self.model_dir, filename)
+        else:
+            for st_file in self.tensor_files:
+                f = STFile.open(st_file, fast = self.fasttensors)
+                for key in f.get_dict():
+                    self.tensor_file_map[key] = st_file
+            if self.cache_tensor_index:
+                _write_tensor_index(self.model_dir, self.tensor_files, self.tensor_file_map)
 
         # For loading checkpoints with fused MLP layers
 
@@ -226,9 +324,19 @@ class ExLlamaV2Config:
                 prefixes = [f"model.layers.{layer_idx}.{k}" for k in ks]
                 expect_keys.append(prefixes)
 
+        # Index every dotted prefix of every key so each expected module is a single lookup. The model also uses the
+        # index to list the tensors each module loads
+
+        self.tensor_key_index = {}
+        for key in self.tensor_file_map:
+            idx = key.find(".")
+            while idx != -1:
+                self.tensor_key_index.setdefault(key[:idx], []).append(key)
+                idx = key.find(".", idx + 1)
+
         for prefixes in expect_keys:
             for prefix in prefixes:
-                if any(key.startswith(prefix) for key in self.tensor_file_map):
+                if prefix in self.tensor_key_index:
                     break
             else:
                 raise ValueError(f" ## Could not find {prefix}.* in model")
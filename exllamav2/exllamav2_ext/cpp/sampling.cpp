@@ -375,6 +375,40 @@ int sort_descending
     return pre;
 }
 
+// Extract the num_probs most likely tokens, in descending order, without modifying the distribution
+
+void top_n_cpu
+(
+    const int num_candidates,
+    const float* probs,
+    const int num_probs,
+    int64_t* out_tokens,
+    float* out_probs
+)
+{
+    std::priority_queue<std::pair<float, int>, std::vector<std::pair<float, int>>, std::greater<std::pair<float, int>>> min_heap;
+
+    for (int i = 0; i < num_probs; ++i) min_heap.push({probs[i], i});
+
+    for (int i = num_probs; i < num_candidates; i++)
+    {
+        if (probs[i] > min_heap.top().first)
+        {
+            min_heap.pop();
+            min_heap.push({probs[i], i});
+        }
+    }
+
+    int j = num_probs;
+    for (int i = 0; i < num_probs; i++)
+    {
+        j--;
+        out_probs[j] = min_heap.top().first;
+        out_tokens[j] = min_heap.top().second;
+        min_heap.pop();
+    }
+}
+
 int top_k_cpu
 (
     const int num_candidates,
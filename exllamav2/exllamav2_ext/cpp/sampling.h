@@ -49,6 +49,15 @@ int sort_descending
     int max_index
 );
 
+void top_n_cpu
+(
+    const int num_candidates,
+    const float* probs,
+    const int num_probs,
+    int64_t* out_tokens,
+    float* out_probs
+);
+
 int top_k_cpu
 (
     const int num_candidates,
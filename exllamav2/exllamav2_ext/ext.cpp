@@ -984,7 +984,9 @@ std::vector<float> sample_basic
     std::vector<float>& mirostat_mu,
     float mirostat_tau,
     float mirostat_eta,
-    float post_temperature
+    float post_temperature,
+    torch::Tensor output_ktokens,   // shape [bsz, 1, num_probs] or meta
+    torch::Tensor output_kprobs     // shape [bsz, 1, num_probs] or meta
 )
 {
     TORCH_CHECK_DTYPE(logits, kFloat);
@@ -992,13 +994,22 @@ std::vector<float> sample_basic
     TORCH_CHECK_DTYPE(output_probs, kFloat);
     TORCH_CHECK_DTYPE(logits, kFloat);
     TORCH_CHECK_DTYPE(logit_filter, kBool);
+    TORCH_CHECK_DTYPE_OPT(output_ktokens, kLong);
+    TORCH_CHECK_DTYPE_OPT(output_kprobs, kFloat);
 
     TORCH_CHECK_SHAPES(logit_filter, 0, logits, 0, 1);
     TORCH_CHECK_SHAPES(logit_filter, 1, logits, 1, 1);
+    TORCH_CHECK_SHAPES_OPT(output_ktokens, 0, logits, 0, 1);
+    TORCH_CHECK_SHAPES_OPT(output_kprobs, 0, logits, 0, 1);
 
     int vocab_size = logits.size(-1);
     int bsz = logits.size(0);
 
+    int num_probs = output_kprobs.device().is_meta() ? 0 : output_kprobs.size(-1);
+    if (num_probs > vocab_size) num_probs = vocab_size;
+    int64_t* output_ktokens_ptr = num_probs ? (int64_t*) output_ktokens.data_ptr() : NULL;
+    float* output_kprobs_ptr = num_probs ? (float*) output_kprobs.data_ptr() : NULL;
+
     float* temp_probs = (float*) malloc(vocab_size * sizeof(float));
     int* temp_indices = (int*) malloc(vocab_size * sizeof(int));
 
@@ -1025,6 +1036,22 @@ std::vector<float> sample_basic
             temp_probs
         );
 
+        // Top-N alternatives. If top-K truncation keeps at least N candidates they come sorted from the truncated
+        // set at no extra cost, otherwise extract them from a copy of the full distribution
+
+        bool top_n_from_top_k = (top_k > 1 && top_k < vocab_size && top_k >= num_probs);
+        if (num_probs && !top_n_from_top_k)
+        {
+            top_n_cpu
+            (
+                vocab_size,
+                temp_probs,
+                num_probs,
+                output_ktokens_ptr + i * num_probs,
+                output_kprobs_ptr + i * num_probs
+            );
+        }
+
         if (top_k == 1)
         {
             int index = greedy_sample(vocab_size, logits_ptr + i * vocab_size, logits_filter_ptr + i * vocab_size);
@@ -1039,6 +1066,14 @@ std::vector<float> sample_basic
         if (top_k > 0 && top_k < vocab_size)
         {
             num_candidates = top_k_cpu(num_candidates, temp_probs, temp_indices, top_k);
+            if (num_probs && top_n_from_top_k)
+            {
+                for (int j = 0; j < num_probs; j++)
+                {
+                    output_ktokens_ptr[i * num_probs + j] = temp_indices[j];
+                    output_kprobs_ptr[i * num_probs + j] = temp_probs[j];
+                }
+            }
             normalize_cpu(num_candidates, temp_probs);
         }
 
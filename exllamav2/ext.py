@@ -189,9 +189,12 @@ def make_q_matrix(w: dict, temp_dq, key: str = None):
 
     if "q_weight" in w:
 
-        w["q_scale_max"] /= 256
-        w["q_perm"] = w["q_perm"].short()
-        w["q_invperm"] = w["q_invperm"].short()
+        # Tensors from a ready-to-load container are already converted, with 16-bit perms and scaled q_scale_max
+
+        if w["q_perm"].dtype != torch.short:
+            w["q_scale_max"] /= 256
+            w["q_perm"] = w["q_perm"].short()
+            w["q_invperm"] = w["q_invperm"].short()
 
         if "q_group_map" not in w:
             w["q_group_map"] = make_group_map(w["q_groups"], w["q_weight"].shape[0])
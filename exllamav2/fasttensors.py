@@ -2,8 +2,13 @@ import torch
 from safetensors import safe_open
 import numpy as np
 import json
-from exllamav2.ext import exllamav2_ext as ext_c
 import os
+import mmap
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# The extension is imported where needed, so reading headers (e.g. in ExLlamaV2Config.prepare) doesn't load it
 
 def convert_dtype(dt: str):
     if dt == "I32": return torch.int, 4
@@ -15,10 +20,16 @@ def convert_dtype(dt: str):
 
 global_stfiles = []
 global_cm = {}
+global_ext_loaded = False
+global_prefetch = {}
+global_prefetchers = []
 
 def cleanup_stfiles():
     global global_stfiles, global_cm
 
+    for p in list(global_prefetchers):
+        p.close()
+
     for stf in global_stfiles:
         stf.close()
     global_stfiles = []
@@ -27,7 +38,9 @@ def cleanup_stfiles():
         f.__exit__(None, None, None)
     global_cm = {}
 
-    ext_c.safetensors_free_pinned_buffer()
+    if global_ext_loaded:
+        from exllamav2.ext import exllamav2_ext as ext_c
+        ext_c.safetensors_free_pinned_buffer()
 
 
 class STFile:
@@ -39,9 +52,10 @@ class STFile:
     handle: int = 0
     fast: bool
     st_context = None
+    mmap_data: memoryview = None
 
     def __init__(self, filename: str, fast = True):
-        global global_stfiles
+        global global_stfiles, global_ext_loaded
 
         self.filename = filename
         self.read_dict()
@@ -52,6 +66,8 @@ class STFile:
 
         self.fast = fast
         if self.fast:
+            from exllamav2.ext import exllamav2_ext as ext_c
+            global_ext_loaded = True
             self.handle = ext_c.safetensors_open(filename)
 
         global_stfiles.append(self)
@@ -66,7 +82,10 @@ class STFile:
 
 
     def close(self):
+        # Mapping stays alive as long as any tensors still reference it
+        self.mmap_data = None
         if not self.fast: return
+        from exllamav2.ext import exllamav2_ext as ext_c
         ext_c.safetensors_close(self.handle)
 
 
@@ -110,7 +129,61 @@ class STFile:
         return f
 
 
-    def get_tensor(self, key, device, not_fast = False):
+    def tensor_range(self, key):
+        v = self.header[key]
+        data_offsets = v["data_offsets"]
+        offset = data_offsets[0] + self.header_size
+        length = data_offsets[1] - data_offsets[0]
+        return offset, length
+
+
+    def get_mmap(self):
+        if self.mmap_data is None:
+            with open(self.filename, "rb") as fp:
+                mm = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_COPY)
+            self.mmap_data = memoryview(mm)
+        return self.mmap_data
+
+
+    # Return CPU tensor as a view into the memory-mapped file. The mapping is copy-on-write, so pages are shared with
+    # the page cache (and other processes mapping the same file) until written to
+
+    def get_tensor_mmap(self, key):
+        v = self.header[key]
+        dtt, dts = convert_dtype(v["dtype"])
+        sh = v["shape"]
+        offset, length = self.tensor_range(key)
+        if length == 0: return torch.empty(sh, dtype = dtt)
+
+        data = self.get_mmap()
+        if offset % dts != 0:
+            tensor = torch.frombuffer(data, dtype = torch.uint8, count = length, offset = offset).clone()
+            return tensor.view(dtt).reshape(sh)
+
+        return torch.frombuffer(data, dtype = dtt, count = length // dts, offset = offset).reshape(sh)
+
+
+    def get_tensor(self, key, device, not_fast = False, mmap_cpu = False):
+
+        # Memory-mapped CPU tensors don't use the read-ahead copy. The model doesn't schedule them, but drop any entry
+        # another caller's prefetcher may hold so it isn't left waiting
+
+        if mmap_cpu and device == "cpu":
+            entry = global_prefetch.pop((self.filename, key), None)
+            if entry is not None: entry.prefetch.release(entry)
+            return self.get_tensor_mmap(key)
+
+        # Tensor may have been read ahead by an STPrefetch
+
+        entry = global_prefetch.pop((self.filename, key), None)
+        if entry is not None:
+            data = entry.take()
+            v = self.header[key]
+            dtt, dts = convert_dtype(v["dtype"])
+            time_begin = time.time()
+            tensor = data.view(dtt).reshape(v["shape"]).to(device, non_blocking = data.is_pinned())
+            entry.prefetch.upload_time += time.time() - time_begin
+            return tensor
 
         if not_fast or not self.fast:
             f = self.get_cm(device)
@@ -125,6 +198,178 @@ class STFile:
         length = data_offsets[1] - data_offsets[0]
         assert np.prod(sh) * dts == length, f"Tensor shape doesn't match storage size: {key}"
 
+        from exllamav2.ext import exllamav2_ext as ext_c
         tensor = torch.empty(sh, device = device, dtype = dtt)
         ext_c.safetensors_load(self.handle, tensor, offset, length)
         return tensor
+
+
+# Reads tensors ahead of module loading on a thread pool. Tensors are given as an ordered list of groups (one per
+# module) of (filename, key) pairs and are read in that order, large tensors split into chunks read concurrently. At
+# most max_inflight bytes are read but not yet consumed at any time. Reads are picked up by STFile.get_tensor, which
+# waits for the tensor if it isn't ready yet, or reads it immediately (ignoring the limit) if it hasn't been started.
+# With pin_memory, tensors are read into pinned buffers so uploads to the GPU can run asynchronously.
+#
+# Timing stats: read_time is the total time spent in reads across all threads, wait_time is time the consumer spent
+# waiting for reads to finish and upload_time is time spent copying tensors to their target device
+
+class STPrefetch:
+
+    class Entry:
+
+        def __init__(self, prefetch, filename, key, offset, length):
+            self.prefetch = prefetch
+            self.filename = filename
+            self.key = key
+            self.offset = offset
+            self.length = length
+            self.started = False
+            self.released = False
+            self.data = None
+            self.chunks_left = 0
+            self.error = None
+            self.done = threading.Event()
+
+        def take(self):
+            self.prefetch.start(self)
+            time_begin = time.time()
+            self.done.wait()
+            self.prefetch.wait_time += time.time() - time_begin
+            data, error = self.data, self.error
+            self.prefetch.release(self)
+            if error is not None: raise error
+            return data
+
+
+    def __init__(self, groups, num_threads = 8, max_inflight = 1024 ** 3, chunk_size = 64 * 1024 ** 2, fast = False,
+                 pin_memory = False):
+
+        self.pin_memory = pin_memory
+        self.read_time = 0.0
+        self.wait_time = 0.0
+        self.upload_time = 0.0
+        self.bytes_read = 0
+        self.num_threads = num_threads
+        self.max_inflight = max_inflight
+        self.chunk_size = chunk_size
+        self.inflight = 0
+        self.closed = False
+        self.lock = threading.Condition()
+        self.local = threading.local()
+        self.handles = []
+
+        self.groups = []
+        for group in groups:
+            entries = []
+            for filename, key in group:
+                if (filename, key) in global_prefetch: continue
+                offset, length = STFile.open(filename, fast = fast).tensor_range(key)
+                entry = STPrefetch.Entry(self, filename, key, offset, length)
+                global_prefetch[(filename, key)] = entry
+                entries.append(entry)
+            self.groups.append(entries)
+
+        self.pool = ThreadPoolExecutor(max_workers = num_threads)
+        self.scheduler = threading.Thread(target = self.schedule, daemon = True)
+        self.scheduler.start()
+        global_prefetchers.append(self)
+
+
+    def schedule(self):
+
+        for entries in self.groups:
+            for entry in entries:
+                with self.lock:
+                    while not self.closed and not entry.started and not entry.released and \
+                            self.inflight > 0 and self.inflight + entry.length > self.max_inflight:
+                        self.lock.wait()
+                    if self.closed: return
+                self.start(entry)
+
+
+    def start(self, entry):
+
+        with self.lock:
+            if entry.started or entry.released: return
+            entry.started = True
+            self.inflight += entry.length
+
+        try:
+            entry.data = torch.empty((entry.length,), dtype = torch.uint8, pin_memory = self.pin_memory)
+            chunks = [(a, min(a + self.chunk_size, entry.length)) for a in range(0, entry.length, self.chunk_size)]
+            if len(chunks) == 0:
+                entry.done.set()
+                return
+            entry.chunks_left = len(chunks)
+            buffer = memoryview(entry.data.numpy())
+            for a, b in chunks:
+                self.pool.submit(self.read_chunk, entry, buffer[a : b], entry.offset + a)
+
+        except Exception as e:
+            entry.error = e
+            entry.done.set()
+
+
+    def read_chunk(self, entry, buffer, offset):
+
+        try:
+            handles = getattr(self.local, "handles", None)
+            if handles is None:
+                handles = {}
+                self.local.handles = handles
+            f = handles.get(entry.filename)
+            if f is None:
+                f = open(entry.filename, "rb", buffering = 0)
+                handles[entry.filename] = f
+                with self.lock: self.handles.append(f)
+
+            time_begin = time.time()
+            f.seek(offset)
+            pos = 0
+            while pos < len(buffer):
+                n = f.readinto(buffer[pos:])
+                if not n: raise IOError(f"Unexpected end of file reading {entry.key} from {entry.filename}")
+                pos += n
+            read_time = time.time() - time_begin
+            with self.lock:
+                self.read_time += read_time
+                self.bytes_read += pos
+
+        except Exception as e:
+            entry.error = e
+
+        with self.lock:
+            entry.chunks_left -= 1
+            if entry.chunks_left == 0: entry.done.set()
+
+
+    def release(self, entry):
+
+        with self.lock:
+            if entry.released: return
+            entry.released = True
+            if entry.started: self.inflight -= entry.length
+            self.lock.notify_all()
+        entry.data = None
+
+
+    # Discard any tensors in a group that weren't consumed, e.g. after its module is loaded
+
+    def release_group(self, idx):
+
+        for entry in self.groups[idx]:
+            global_prefetch.pop((entry.filename, entry.key), None)
+            self.release(entry)
+
+
+    def close(self):
+
+        if self in global_prefetchers: global_prefetchers.remove(self)
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.scheduler.join()
+        for idx in range(len(self.groups)): self.release_group(idx)
+        self.pool.shutdown(wait = True)
+        for f in self.handles: f.close()
+        self.handles = []
@@ -1,10 +1,23 @@
 from exllamav2.version import __version__
+import importlib
 
-from exllamav2.generator.sampler import ExLlamaV2Sampler
-from exllamav2.generator.base import ExLlamaV2BaseGenerator
-from exllamav2.generator.streaming import ExLlamaV2StreamingGenerator
-
+# Imported on first access, see exllamav2/__init__.py
 
+_lazy_imports = \
+{
+    "ExLlamaV2Sampler": "exllamav2.generator.sampler",
+    "ExLlamaV2BaseGenerator": "exllamav2.generator.base",
+    "ExLlamaV2StreamingGenerator": "exllamav2.generator.streaming",
+}
 
+__all__ = list(_lazy_imports.keys())
 
+def __getattr__(name):
+    if name not in _lazy_imports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_lazy_imports[name]), name)
+    globals()[name] = value
+    return value
 
+def __dir__():
+    return sorted(list(globals().keys()) + list(_lazy_imports.keys()))
@@ -22,6 +22,11 @@ class ExLlamaV2BaseGenerator:
 
     sequence_ids: torch.tensor = None
 
+    # If > 0, evaluate the head layer only for the allowed tokens when filters or token healing restrict the next
+    # token to at most this many candidates. Only applies to FP16 heads, see ExLlamaV2Linear.forward_rows
+
+    sparse_head_max_tokens: int = 0
+
     def __init__(self, model, cache, tokenizer):
 
         self.model = model
@@ -52,7 +57,11 @@ class ExLlamaV2BaseGenerator:
                         encode_special_tokens = False,
                         decode_special_tokens = False,
                         loras = None,
-                        stop_token = -1):
+                        stop_token = -1,
+                        return_top_tokens = 0):
+
+        # If return_top_tokens > 0, also returns tensors of shape (batch_size, num_generated, return_top_tokens) with
+        # the most likely candidates and their log-probabilities for every generated position
 
         # Default stop token
 
@@ -68,9 +77,14 @@ class ExLlamaV2BaseGenerator:
 
         # Tokenize input and produce padding mask if needed
 
-        batch_size = 1 if isinstance(prompt, str) else len(prompt)
-        ids, position_offsets = self.tokenizer.encode(prompt, encode_special_tokens = encode_special_tokens, return_offsets = True)
-        if batch_size == 1: position_offsets = None
+        if isinstance(prompt, str):
+            batch_size = 1
+            ids = self.tokenizer.cached_encode_str(prompt, encode_special_tokens = encode_special_tokens)
+            position_offsets = None
+        else:
+            batch_size = len(prompt)
+            ids, position_offsets = self.tokenizer.encode(prompt, encode_special_tokens = encode_special_tokens, return_offsets = True)
+            if batch_size == 1: position_offsets = None
 
         overflow = ids.shape[-1] + num_tokens - self.model.config.max_seq_len
         if overflow > 0: ids = ids[:, overflow:]
@@ -102,11 +116,21 @@ class ExLlamaV2BaseGenerator:
         # Generate tokens
 
         batch_eos = [False] * batch_size
+        top_tokens = []
+        top_logprobs = []
 
         for i in range(num_tokens):
 
-            logits = self.model.forward(self.sequence_ids[:, -1:], self.cache, input_mask = mask, loras = loras, position_offsets = position_offsets).float().cpu()
-            token, _, _ = ExLlamaV2Sampler.sample(logits, gen_settings, self.sequence_ids, random.random(), self.tokenizer, prefix_token = unhealed_token)
+            logit_ids = self._sparse_logit_ids(gen_settings, unhealed_token)
+            logits = self.model.forward(self.sequence_ids[:, -1:], self.cache, input_mask = mask, loras = loras, position_offsets = position_offsets, logit_ids = logit_ids).float().cpu()
+            if logit_ids is not None: logits = self._expand_sparse_logits(logits, logit_ids)
+
+            if return_top_tokens > 0:
+                token, _, _, ktokens, klogprobs = ExLlamaV2Sampler.sample(logits, gen_settings, self.sequence_ids, random.random(), self.tokenizer, prefix_token = unhealed_token, return_top_tokens = return_top_tokens)
+                top_tokens.append(ktokens)
+                top_logprobs.append(klogprobs)
+            else:
+                token, _, _ = ExLlamaV2Sampler.sample(logits, gen_settings, self.sequence_ids, random.random(), self.tokenizer, prefix_token = unhealed_token)
 
             eos = False
             if stop_token is not None:
@@ -126,11 +150,57 @@ class ExLlamaV2BaseGenerator:
         # Decode
 
         text = self.tokenizer.decode(self.sequence_ids, decode_special_tokens = decode_special_tokens)
+        if isinstance(prompt, str): text = text[0]
 
-        if isinstance(prompt, str): return text[0]
+        if return_top_tokens > 0:
+            if len(top_tokens) == 0:
+                return text, torch.empty((batch_size, 0, return_top_tokens), dtype = torch.long), \
+                             torch.empty((batch_size, 0, return_top_tokens), dtype = torch.float)
+            return text, torch.cat(top_tokens, dim = 1), torch.cat(top_logprobs, dim = 1)
         return text
 
 
+    # Collect a superset of the tokens the sampler can pick given filters and healing, or None if the set is too large
+    # (or unconstrained) to be worth a sparse head evaluation. Constraints that are individually too large are skipped
+    # since the sampler applies them anyway
+
+    def _sparse_logit_ids(self, gen_settings, prefix_token = None):
+
+        max_tokens = self.sparse_head_max_tokens
+        if max_tokens <= 0 or gen_settings.cfg_scale is not None: return None
+        if not self.model.modules[self.model.head_layer_idx].supports_sparse_rows(): return None
+
+        allowed = None
+        for pt, _ in gen_settings.next_filters():
+            if isinstance(pt, torch.Tensor):
+                pt = pt.nonzero().flatten()
+                if pt.numel() > max_tokens: continue
+                pt = set(pt.tolist())
+            elif len(pt) > max_tokens:
+                continue
+            allowed = pt if allowed is None else allowed & pt
+
+        if prefix_token is not None:
+            prefix_id_to_ids = self.tokenizer.get_prefix_id_to_ids_dict()
+            heal = set()
+            for t in prefix_token.flatten().tolist(): heal.update(prefix_id_to_ids[t].tolist())
+            if len(heal) <= max_tokens:
+                allowed = heal if allowed is None else allowed & heal
+
+        if allowed is None or len(allowed) == 0: return None
+        return torch.tensor(sorted(allowed), dtype = torch.long)
+
+
+    # Scatter compact logits from a sparse head evaluation into a full-vocabulary tensor
+
+    def _expand_sparse_logits(self, logits, logit_ids):
+
+        head_size = self.model.modules[self.model.head_layer_idx].out_features
+        full_logits = torch.full(logits.shape[:-1] + (head_size,), float("-inf"), dtype = logits.dtype)
+        full_logits[..., logit_ids] = logits
+        return full_logits
+
+
     def _gen_begin_base(self, input_ids, mask = None, loras = None, position_offsets = None):
 
         self.cache.current_seq_len = 0
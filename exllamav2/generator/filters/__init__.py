@@ -2,3 +2,5 @@ from exllamav2.version import __version__
 
 from exllamav2.generator.filters.base import ExLlamaV2Filter
 from exllamav2.generator.filters.select import ExLlamaV2SelectFilter
+from exllamav2.generator.filters.regex import ExLlamaV2RegexFilter
+from exllamav2.generator.filters.json_schema import ExLlamaV2JSONSchemaFilter
@@ -34,6 +34,9 @@ class ExLlamaV2Filter:
         pass
 
 
+    # Return (pass_tokens, end_tokens). Each may be a set of token IDs or a boolean tensor of shape (vocab_size,),
+    # where a mask is preferable for filters that allow a large part of the vocabulary
+
     def next(self):
         pass
 
@@ -0,0 +1,141 @@
+from exllamav2 import (
+    ExLlamaV2,
+    ExLlamaV2Tokenizer
+)
+
+from exllamav2.generator.filters.regex import ExLlamaV2RegexFilter
+import json, re
+
+# Whitespace allowed between JSON tokens. Kept to a single optional space so the model can't stall the output with
+# endless padding
+
+json_ws = "[ ]?"
+
+json_string_char = r'(?:[^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})'
+json_patterns = \
+{
+    "string": '"' + json_string_char + '*"',
+    "integer": r"-?(?:0|[1-9][0-9]*)",
+    "number": r"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+\-]?[0-9]+)?",
+    "boolean": r"(?:true|false)",
+    "null": r"null",
+}
+
+
+def _escape(text):
+
+    return re.sub(r"([\\.^$|?*+()\[\]{}\-])", r"\\\1", text)
+
+
+def _literal(value):
+
+    return _escape(json.dumps(value, ensure_ascii = False))
+
+
+def _object_regex(schema):
+
+    properties = schema.get("properties", {})
+    required = set(schema.get("required", []))
+    keys = list(properties.keys())
+
+    if len(keys) == 0:
+        return r"\{" + json_ws + r"\}"
+
+    # Properties are emitted in the order they're declared. As in JSON Schema, only those listed in "required" must be
+    # present. Optional properties may be omitted, which only affects where the separating commas go, so
+    # build the tail both for "no property emitted yet" and "some property emitted"
+
+    tail_first = ""
+    tail_next = ""
+    for key in reversed(keys):
+        kv = _literal(key) + json_ws + ":" + json_ws + json_schema_to_regex(properties[key])
+        sep_kv = json_ws + "," + json_ws + kv
+        if key in required:
+            tail_first = kv + tail_next
+            tail_next = sep_kv + tail_next
+        else:
+            tail_first = "(?:" + kv + tail_next + "|" + tail_first + ")"
+            tail_next = "(?:" + sep_kv + ")?" + tail_next
+
+    return r"\{" + json_ws + tail_first + json_ws + r"\}"
+
+
+def _array_regex(schema):
+
+    item = json_schema_to_regex(schema.get("items", {}))
+    min_items = schema.get("minItems", 0)
+    max_items = schema.get("maxItems", None)
+
+    sep_item = json_ws + "," + json_ws + item
+    if max_items == 0:
+        inner = ""
+    elif min_items == 0:
+        rep = "*" if max_items is None else "{0," + str(max_items - 1) + "}"
+        inner = "(?:" + item + "(?:" + sep_item + ")" + rep + ")?"
+    else:
+        rep = "{" + str(min_items - 1) + "," + ("" if max_items is None else str(max_items - 1)) + "}"
+        inner = item + "(?:" + sep_item + ")" + rep
+
+    return r"\[" + json_ws + inner + json_ws + r"\]"
+
+
+def _string_regex(schema):
+
+    if "pattern" in schema:
+        return '"' + schema["pattern"].lstrip("^").rstrip("$") + '"'
+
+    min_length = schema.get("minLength", 0)
+    max_length = schema.get("maxLength", None)
+    if min_length == 0 and max_length is None:
+        return json_patterns["string"]
+
+    rep = "{" + str(min_length) + "," + ("" if max_length is None else str(max_length)) + "}"
+    return '"' + json_string_char + rep + '"'
+
+
+# Convert a JSON schema to a regular expression matching (compact) JSON documents that conform to it. Supports the
+# type, properties, required, items, minItems, maxItems, enum, const, anyOf, oneOf, pattern, minLength and maxLength
+# keywords. An empty schema accepts any scalar value
+
+def json_schema_to_regex(schema):
+
+    if isinstance(schema, str): schema = json.loads(schema)
+
+    if "const" in schema:
+        return _literal(schema["const"])
+
+    if "enum" in schema:
+        return "(?:" + "|".join(_literal(v) for v in schema["enum"]) + ")"
+
+    for k in ("anyOf", "oneOf"):
+        if k in schema:
+            return "(?:" + "|".join(json_schema_to_regex(s) for s in schema[k]) + ")"
+
+    if "$ref" in schema or "allOf" in schema:
+        raise ValueError("JSON schema references and allOf are not supported")
+
+    schema_type = schema.get("type", None)
+    if schema_type is None:
+        if "properties" in schema: schema_type = "object"
+        elif "items" in schema: schema_type = "array"
+        else: schema_type = ["string", "number", "boolean", "null"]
+
+    if isinstance(schema_type, list):
+        return "(?:" + "|".join(json_schema_to_regex(dict(schema, type = t)) for t in schema_type) + ")"
+
+    if schema_type == "object": return _object_regex(schema)
+    if schema_type == "array": return _array_regex(schema)
+    if schema_type == "string": return _string_regex(schema)
+    if schema_type in json_patterns: return json_patterns[schema_type]
+
+    raise ValueError(f"Unsupported JSON schema type: {schema_type}")
+
+
+class ExLlamaV2JSONSchemaFilter(ExLlamaV2RegexFilter):
+
+    schema: dict
+
+    def __init__(self, model, tokenizer, schema):
+
+        self.schema = json.loads(schema) if isinstance(schema, str) else schema
+        super().__init__(model, tokenizer, json_schema_to_regex(self.schema))
@@ -0,0 +1,538 @@
+from exllamav2 import (
+    ExLlamaV2,
+    ExLlamaV2Tokenizer
+)
+
+from exllamav2.generator.filters.base import ExLlamaV2Filter
+import torch
+import weakref
+
+# Character-level automaton for a subset of regex syntax: literals, escapes (\d \w \s \D \W \S \xNN \uNNNN), character
+# classes with ranges and negation, ".", groups "(...)" and "(?:...)", alternation and the quantifiers * + ? {m}, {m,}
+# and {m,n}. Patterns always match the entire generated string, so ^ and $ are accepted but ignored. The NFA is
+# determinized lazily, so only states actually reached during generation are ever constructed.
+
+class _CharSet:
+
+    def __init__(self, chars = (), ranges = (), negated = False):
+
+        self.chars = frozenset(chars)
+        self.ranges = tuple(ranges)
+        self.negated = negated
+
+
+    def match(self, c):
+
+        m = c in self.chars
+        if not m:
+            o = ord(c)
+            for a, b in self.ranges:
+                if a <= o <= b:
+                    m = True
+                    break
+        return m != self.negated
+
+
+_digit = ((ord("0"), ord("9")),)
+_word = ((ord("0"), ord("9")), (ord("a"), ord("z")), (ord("A"), ord("Z")))
+_space = " \t\n\r\f\v"
+
+# Ranges covering every code point not in the given set, for negated escapes inside a class, e.g. [\D]
+
+def _complement(chars, ranges):
+
+    spans = sorted([(ord(c), ord(c)) for c in chars] + list(ranges))
+    out = []
+    start = 0
+    for a, b in spans:
+        if a > start: out.append((start, a - 1))
+        start = max(start, b + 1)
+    if start <= 0x10FFFF: out.append((start, 0x10FFFF))
+    return out
+
+
+_class_escapes = \
+{
+    "d": ((), _digit, False),
+    "D": ((), _digit, True),
+    "w": (("_",), _word, False),
+    "W": (("_",), _word, True),
+    "s": (_space, (), False),
+    "S": (_space, (), True),
+}
+
+_char_escapes = \
+{
+    "n": "\n",
+    "t": "\t",
+    "r": "\r",
+    "f": "\f",
+    "v": "\v",
+    "0": "\0",
+}
+
+
+class _RegexParser:
+
+    def __init__(self, pattern):
+
+        self.pattern = pattern
+        self.pos = 0
+
+
+    def error(self, msg):
+
+        raise ValueError(f"Invalid regex at position {self.pos}: {msg}: {self.pattern}")
+
+
+    def peek(self):
+
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+
+    def take(self):
+
+        c = self.peek()
+        if c is None: self.error("Unexpected end of pattern")
+        self.pos += 1
+        return c
+
+
+    def parse(self):
+
+        node = self.parse_alt()
+        if self.pos < len(self.pattern): self.error("Unbalanced parenthesis")
+        return node
+
+
+    def parse_alt(self):
+
+        branches = [self.parse_concat()]
+        while self.peek() == "|":
+            self.pos += 1
+            branches.append(self.parse_concat())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+
+    def parse_concat(self):
+
+        items = []
+        while self.peek() is not None and self.peek() not in "|)":
+            items.append(self.parse_repeat())
+        return ("cat", items)
+
+
+    def parse_repeat(self):
+
+        node = self.parse_atom()
+        while True:
+            c = self.peek()
+            if c == "*": self.pos += 1; node = ("rep", node, 0, None)
+            elif c == "+": self.pos += 1; node = ("rep", node, 1, None)
+            elif c == "?": self.pos += 1; node = ("rep", node, 0, 1)
+            elif c == "{" and self.is_counted_repeat():
+                self.pos += 1
+                min_count, max_count = self.parse_counts()
+                node = ("rep", node, min_count, max_count)
+            else:
+                break
+            if self.peek() == "?": self.pos += 1  # Lazy quantifiers match the same language
+        return node
+
+
+    def is_counted_repeat(self):
+
+        end = self.pattern.find("}", self.pos)
+        if end == -1: return False
+        body = self.pattern[self.pos + 1 : end]
+        return body != "" and all(c.isdigit() or c == "," for c in body) and body.count(",") <= 1 and body[0] != ","
+
+
+    def parse_counts(self):
+
+        end = self.pattern.index("}", self.pos)
+        body = self.pattern[self.pos : end]
+        self.pos = end + 1
+        if "," not in body: return int(body), int(body)
+        a, b = body.split(",")
+        min_count = int(a)
+        max_count = int(b) if b != "" else None
+        if max_count is not None and max_count < min_count: self.error("Invalid repeat range")
+        return min_count, max_count
+
+
+    def parse_atom(self):
+
+        c = self.take()
+
+        if c == "(":
+            if self.pattern.startswith("?:", self.pos): self.pos += 2
+            elif self.peek() == "?": self.error("Unsupported group type")
+            node = self.parse_alt()
+            if self.take() != ")": self.error("Expected )")
+            return node
+
+        if c == "[": return ("char", self.parse_class())
+        if c == ".": return ("char", _CharSet("\n", negated = True))
+        if c in "^$": return ("cat", [])
+        if c == "\\": return ("char", self.parse_escape())
+        if c in "*+?": self.error("Nothing to repeat")
+        return ("char", _CharSet(c))
+
+
+    def parse_escape_char(self):
+
+        c = self.take()
+        if c in _char_escapes: return _char_escapes[c]
+        if c == "x": return chr(int(self.take() + self.take(), 16))
+        if c == "u": return chr(int(self.take() + self.take() + self.take() + self.take(), 16))
+        return c
+
+
+    def parse_escape(self):
+
+        c = self.peek()
+        if c in _class_escapes:
+            self.pos += 1
+            chars, ranges, negated = _class_escapes[c]
+            return _CharSet(chars, ranges, negated)
+        return _CharSet(self.parse_escape_char())
+
+
+    def parse_class(self):
+
+        negated = False
+        if self.peek() == "^":
+            negated = True
+            self.pos += 1
+
+        chars = set()
+        ranges = []
+        first = True
+        while True:
+            c = self.take()
+            if c == "]" and not first: break
+            first = False
+
+            if c == "\\":
+                e = self.peek()
+                if e in _class_escapes:
+                    self.pos += 1
+                    e_chars, e_ranges, e_negated = _class_escapes[e]
+                    if e_negated:
+                        ranges += _complement(e_chars, e_ranges)
+                    else:
+                        chars.update(e_chars)
+                        ranges += e_ranges
+                    continue
+                c = self.parse_escape_char()
+
+            if self.peek() == "-" and self.pattern[self.pos + 1 : self.pos + 2] not in ("]", ""):
+                self.pos += 1
+                d = self.take()
+                if d == "\\": d = self.parse_escape_char()
+                if ord(d) < ord(c): self.error("Invalid class range")
+                ranges.append((ord(c), ord(d)))
+            else:
+                chars.add(c)
+
+        return _CharSet(chars, ranges, negated)
+
+
+class _RegexAutomaton:
+
+    def __init__(self, pattern):
+
+        self.pattern = pattern
+
+        # Thompson NFA
+
+        self.nfa_trans = []
+        self.nfa_eps = []
+        ast = _RegexParser(pattern).parse()
+        self.nfa_start, self.nfa_accept = self._compile(ast)
+
+        # Lazily built DFA. State -1 is the dead state
+
+        self.dfa_states = []
+        self.dfa_index = {}
+        self.dfa_trans = {}
+        self.dfa_accepting = []
+        self.dfa_continues = []
+        self.start = self._dfa_state(self._closure({self.nfa_start}))
+
+
+    def _new_state(self):
+
+        self.nfa_trans.append([])
+        self.nfa_eps.append([])
+        return len(self.nfa_trans) - 1
+
+
+    def _compile(self, node):
+
+        kind = node[0]
+
+        if kind == "char":
+            s = self._new_state()
+            e = self._new_state()
+            self.nfa_trans[s].append((node[1], e))
+            return s, e
+
+        if kind == "cat":
+            s = e = self._new_state()
+            for item in node[1]:
+                a, b = self._compile(item)
+                self.nfa_eps[e].append(a)
+                e = b
+            return s, e
+
+        if kind == "alt":
+            s = self._new_state()
+            e = self._new_state()
+            for item in node[1]:
+                a, b = self._compile(item)
+                self.nfa_eps[s].append(a)
+                self.nfa_eps[b].append(e)
+            return s, e
+
+        if kind == "rep":
+            _, item, min_count, max_count = node
+            s = e = self._new_state()
+            for _ in range(min_count):
+                a, b = self._compile(item)
+                self.nfa_eps[e].append(a)
+                e = b
+            if max_count is None:
+                a, b = self._compile(item)
+                self.nfa_eps[e].append(a)
+                self.nfa_eps[b].append(a)
+                f = self._new_state()
+                self.nfa_eps[e].append(f)
+                self.nfa_eps[b].append(f)
+                e = f
+            else:
+                f = self._new_state()
+                for _ in range(max_count - min_count):
+                    a, b = self._compile(item)
+                    self.nfa_eps[e].append(a)
+                    self.nfa_eps[e].append(f)
+                    e = b
+                self.nfa_eps[e].append(f)
+                e = f
+            return s, e
+
+        raise ValueError(f"Unknown regex node: {kind}")
+
+
+    def _closure(self, states):
+
+        stack = list(states)
+        closure = set(states)
+        while stack:
+            s = stack.pop()
+            for t in self.nfa_eps[s]:
+                if t not in closure:
+                    closure.add(t)
+                    stack.append(t)
+        return frozenset(closure)
+
+
+    def _dfa_state(self, nfa_states):
+
+        if len(nfa_states) == 0: return -1
+        idx = self.dfa_index.get(nfa_states)
+        if idx is not None: return idx
+
+        idx = len(self.dfa_states)
+        self.dfa_states.append(nfa_states)
+        self.dfa_index[nfa_states] = idx
+        self.dfa_accepting.append(self.nfa_accept in nfa_states)
+        self.dfa_continues.append(any(len(self.nfa_trans[s]) > 0 for s in nfa_states))
+        return idx
+
+
+    def step(self, state, c):
+
+        if state == -1: return -1
+        key = (state, c)
+        next_state = self.dfa_trans.get(key)
+        if next_state is not None: return next_state
+
+        targets = set()
+        for s in self.dfa_states[state]:
+            for charset, t in self.nfa_trans[s]:
+                if charset.match(c): targets.add(t)
+
+        next_state = self._dfa_state(self._closure(targets))
+        self.dfa_trans[key] = next_state
+        return next_state
+
+
+    def walk(self, state, text):
+
+        for c in text:
+            state = self.step(state, c)
+            if state == -1: break
+        return state
+
+
+    def accepting(self, state):
+
+        return state != -1 and self.dfa_accepting[state]
+
+
+    def final(self, state):
+
+        return state != -1 and self.dfa_accepting[state] and not self.dfa_continues[state]
+
+
+# Compiled automata and per-state token sets are shared by all filters using the same pattern and tokenizer, so
+# repeated requests with the same grammar only ever pay for each DFA state once
+
+_compiled_patterns = weakref.WeakKeyDictionary()
+
+class _CompiledPattern:
+
+    def __init__(self, tokenizer, pattern):
+
+        self.tokenizer = weakref.proxy(tokenizer)
+        self.automaton = _RegexAutomaton(pattern)
+        self.state_tokens = {}
+        self.special_tokens = set(tokenizer.extended_id_to_piece.keys())
+
+
+    def walk_trie(self, node, state, pass_tokens, end_tokens):
+
+        automaton = self.automaton
+        stack = [(node, state)]
+        while stack:
+            node, state = stack.pop()
+            for c, child in node.children.items():
+                child_state = automaton.step(state, c)
+                if child_state == -1: continue
+                if len(child.leaf) > 0:
+                    pass_tokens.update(child.leaf)
+                    if automaton.final(child_state): end_tokens.update(child.leaf)
+                if len(child.children) > 0: stack.append((child, child_state))
+
+
+    def to_mask(self, tokens):
+
+        mask = torch.zeros((self.tokenizer.get_vocab_size(),), dtype = torch.bool)
+        if len(tokens) > 0: mask[torch.tensor(list(tokens), dtype = torch.long)] = True
+        return mask
+
+
+    # Token sets per state are stored as boolean masks, so the sampler can apply them without conversion
+
+    def tokens_for_state(self, state):
+
+        tokens = self.state_tokens.get(state)
+        if tokens is not None: return tokens
+
+        pass_tokens = set()
+        end_tokens = set()
+        if state != -1:
+            self.walk_trie(self.tokenizer.get_char_trie(), state, pass_tokens, end_tokens)
+            pass_tokens -= self.special_tokens
+            end_tokens -= self.special_tokens
+            if self.automaton.accepting(state):
+                pass_tokens.add(self.tokenizer.eos_token_id)
+                end_tokens.add(self.tokenizer.eos_token_id)
+
+        tokens = (self.to_mask(pass_tokens), self.to_mask(end_tokens))
+        self.state_tokens[state] = tokens
+        return tokens
+
+
+    def tokens_for_prefix(self, prefix, state):
+
+        # Tokens must either be a prefix of the remaining text or begin with all of it, followed by text the automaton
+        # accepts. Only happens for the first token(s) after token healing, so the result is not cached
+
+        pass_tokens = set()
+        end_tokens = set()
+
+        w = self.tokenizer.get_char_trie()
+        for c in prefix:
+            w = w.children.get(c)
+            if w is None: break
+            pass_tokens.update(w.leaf)
+        else:
+            if self.automaton.final(state): end_tokens.update(w.leaf)
+            self.walk_trie(w, state, pass_tokens, end_tokens)
+
+        pass_tokens -= self.special_tokens
+        end_tokens -= self.special_tokens
+        return pass_tokens, end_tokens
+
+
+def _get_compiled_pattern(tokenizer, pattern):
+
+    patterns = _compiled_patterns.get(tokenizer)
+    if patterns is None:
+        patterns = {}
+        _compiled_patterns[tokenizer] = patterns
+
+    compiled = patterns.get(pattern)
+    if compiled is None:
+        compiled = _CompiledPattern(tokenizer, pattern)
+        patterns[pattern] = compiled
+    return compiled
+
+
+class ExLlamaV2RegexFilter(ExLlamaV2Filter):
+
+    pattern: str
+    compiled: _CompiledPattern
+    state: int
+    prefix: str
+    offset: int
+
+    def __init__(self, model, tokenizer, pattern):
+        super().__init__(model, tokenizer)
+
+        self.pattern = pattern
+        self.compiled = _get_compiled_pattern(tokenizer, pattern)
+        self.state = self.compiled.automaton.start
+        self.prefix = ""
+        self.offset = 0
+
+
+    def clone(self):
+
+        c = ExLlamaV2RegexFilter.__new__(type(self))
+        c.__dict__.update(self.__dict__)
+        return c
+
+
+    def begin(self, prefix_str = ""):
+
+        self.sequence_str = ""
+        self.state = self.compiled.automaton.start
+        self.prefix = prefix_str or ""
+        self.offset = 0
+
+
+    def feed(self, token):
+
+        if token == self.tokenizer.eos_token_id: return
+
+        id_to_piece = self.tokenizer.get_id_to_piece_list()
+        piece = id_to_piece[token]
+        self.sequence_str += piece
+
+        # Consume what remains of the healed prefix before advancing the automaton
+
+        split = max(len(self.prefix) - self.offset, 0)
+        self.offset += len(piece)
+        self.state = self.compiled.automaton.walk(self.state, piece[split:])
+
+
+    def next(self):
+
+        if self.offset < len(self.prefix):
+            return self.compiled.tokens_for_prefix(self.prefix[self.offset:], self.state)
+
+        return self.compiled.tokens_for_state(self.state)
@@ -12,6 +12,7 @@ class ExLlamaV2SelectFilter(ExLlamaV2Filter):
     prefix: str
     case_insensitive: bool
     sequence_str_cmp: str
+    next_cache: dict
 
     def __init__(self, model, tokenizer, options, case_insensitive = False):
         super().__init__(model, tokenizer)
@@ -21,6 +22,14 @@ class ExLlamaV2SelectFilter(ExLlamaV2Filter):
         self.offset = 0
         self.prefix = ""
         self.sequence_str_cmp = ""
+        self.next_cache = {}
+
+
+    def clone(self):
+
+        c = ExLlamaV2SelectFilter.__new__(ExLlamaV2SelectFilter)
+        c.__dict__.update(self.__dict__)
+        return c
 
 
     def begin(self, prefix_str = ""):
@@ -46,10 +55,21 @@ class ExLlamaV2SelectFilter(ExLlamaV2Filter):
         self.offset += len(piece)
 
 
-    # TODO: Evaluate overhead and maybe move to extension
+    # Result only depends on the prefix and the (compared) string matched so far, so memoize per state. The cache is
+    # shared with clones since the options are fixed
 
     def next(self):
 
+        key = (self.prefix, self.sequence_str_cmp)
+        tokens = self.next_cache.get(key)
+        if tokens is None:
+            tokens = self._next()
+            self.next_cache[key] = tokens
+        return tokens
+
+
+    def _next(self):
+
         # prefix_to_ids = self.tokenizer.get_prefix_to_ids_dict()
         id_to_piece = self.tokenizer.get_id_to_piece_list()
         # pass_str = set()
@@ -33,6 +33,7 @@ class ExLlamaV2Sampler:
         cfg_scale = None
 
         filters = []
+        filter_state = None     # Filter results for the current position, see next_filters
 
 
         def clone(self):
@@ -91,16 +92,33 @@ class ExLlamaV2Sampler:
 
         def begin_filters(self, prefix_str = ""):
 
+            self.filter_state = None
             for f in self.filters: f.begin(prefix_str)
 
 
         def feed_filters(self, feed_token):
 
+            self.filter_state = None
             for f in self.filters: f.feed(feed_token)
 
 
+        # (pass_tokens, end_tokens) from each filter for the current position. Kept until the next sample() or until
+        # the filters are fed, so a generator can inspect the constraints before the forward pass (e.g. to pick a
+        # sparse head) without the filters being evaluated twice
+
+        def next_filters(self):
+
+            if self.filter_state is None:
+                self.filter_state = [f.next() for f in self.filters]
+            return self.filter_state
+
+
     @staticmethod
-    def sample(logits: torch.tensor, settings: Settings, sequence_ids: torch.tensor, random: float, tokenizer: ExLlamaV2Tokenizer, prefix_token = None):
+    def sample(logits: torch.tensor, settings: Settings, sequence_ids: torch.tensor, random: float, tokenizer: ExLlamaV2Tokenizer, prefix_token = None, return_top_tokens = 0):
+
+        # Returns (tokens, probs, end_filter), or (tokens, probs, end_filter, top_tokens, top_logprobs) if
+        # return_top_tokens > 0. Top tokens are the N most likely candidates after penalties, bias, filters and
+        # temperature (unless temperature_last is set), with log-probabilities over the whole vocabulary
 
         batch_size, _, vocab_size = logits.shape
 
@@ -145,20 +163,32 @@ class ExLlamaV2Sampler:
             # logits = logits + settings.token_bias
             ext_c.fast_fadd_cpu(logits, settings.token_bias)
 
-        # Evaluate filters
+        # Evaluate filters. Filters return either sets of token IDs or boolean masks over the vocabulary. Masks are
+        # applied directly to the logit filter, sets are intersected and applied as one sorted list
 
+        end_tokens = []
         if len(settings.filters) > 0:
 
+            filter_state = settings.next_filters()
+            settings.filter_state = None
+
             pass_tokens = None
-            end_tokens = None
-            for f in settings.filters:
+            for pt, et in filter_state:
 
-                pt, et = f.next()
-                pass_tokens = pt if pass_tokens is None else pass_tokens & pt
-                end_tokens = et if end_tokens is None else end_tokens | et
+                end_tokens.append(et)
 
-            assert pass_tokens, "Filter excluded all tokens"
-            ext_c.logit_filter_exclusive(logit_filter, [sorted(list(pass_tokens))])
+                if isinstance(pt, torch.Tensor):
+                    mask_width = min(pt.shape[-1], vocab_size)
+                    logit_filter[0, :mask_width] &= pt[:mask_width]
+                    logit_filter[0, mask_width:] = False
+                else:
+                    pass_tokens = pt if pass_tokens is None else pass_tokens & pt
+
+            if pass_tokens is not None:
+                assert pass_tokens, "Filter excluded all tokens"
+                ext_c.logit_filter_exclusive(logit_filter, [sorted(list(pass_tokens))])
+
+            assert logit_filter.any(), "Filter excluded all tokens"
 
         # Healing
 
@@ -166,11 +196,12 @@ class ExLlamaV2Sampler:
 
             prefix_id_to_ids = tokenizer.get_prefix_id_to_ids_dict()
 
-            valid_token_lists = []
+            heal_filter = torch.zeros_like(logit_filter)
             for i in range(batch_size):
-                valid_token_lists.append(prefix_id_to_ids[prefix_token[i, 0].item()])
+                valid_ids = prefix_id_to_ids[prefix_token[i, 0].item()].long()
+                heal_filter[i, valid_ids[valid_ids < vocab_size]] = True
 
-            ext_c.logit_filter_exclusive(logit_filter, valid_token_lists)
+            logit_filter &= heal_filter
 
         # for i in range(logit_filter.shape[-1]):
         #     if logit_filter[0, i].item():
@@ -195,6 +226,14 @@ class ExLlamaV2Sampler:
         output_tokens = torch.empty((batch_size, 1), device = "cpu", dtype = torch.long)
         output_probs = torch.empty((batch_size, 1), device = "cpu", dtype = torch.float)
 
+        if return_top_tokens > 0:
+            return_top_tokens = min(return_top_tokens, logits.shape[-1])
+            output_ktokens = torch.empty((batch_size, 1, return_top_tokens), device = "cpu", dtype = torch.long)
+            output_kprobs = torch.empty((batch_size, 1, return_top_tokens), device = "cpu", dtype = torch.float)
+        else:
+            output_ktokens = none_tensor
+            output_kprobs = none_tensor
+
         m = ext_c.sample_basic(logits,
                                1.0 if settings.temperature_last else settings.temperature,
                                settings.top_k,
@@ -211,13 +250,24 @@ class ExLlamaV2Sampler:
                                settings.mirostat_mu if settings.mirostat else [],
                                settings.mirostat_tau,
                                settings.mirostat_eta,
-                               settings.temperature if settings.temperature_last else 1.0)
+                               settings.temperature if settings.temperature_last else 1.0,
+                               output_ktokens,
+                               output_kprobs)
 
         if settings.mirostat: settings.mirostat_mu = m
 
         # Stop condition from filters
 
         end_filter = False
-        if len(settings.filters) > 0 and output_tokens[0].item() in end_tokens: end_filter = True
-
-        return output_tokens, output_probs, end_filter
+        if len(settings.filters) > 0:
+            token = output_tokens[0].item()
+            for et in end_tokens:
+                if isinstance(et, torch.Tensor):
+                    if token < et.shape[-1] and et[token]: end_filter = True
+                elif token in et:
+                    end_filter = True
+
+        if return_top_tokens > 0:
+            return output_tokens, output_probs, end_filter, output_ktokens, output_kprobs.log()
+        else:
+            return output_tokens, output_probs, end_filter
@@ -24,12 +24,16 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
     expect_utf8: int = 0
     held_tokens: torch.Tensor or None = None
     held_probs: torch.Tensor or None = None
+    held_top_tokens: torch.Tensor or None = None
+    held_top_logprobs: torch.Tensor or None = None
     settings: ExLlamaV2Sampler.Settings = None
     stop_strings: set = set()
     stop_tokens: set = set()
 
     no_tokens: torch.Tensor = None
     no_probs: torch.Tensor = None
+    no_top_tokens: torch.Tensor = None
+    no_top_logprobs: torch.Tensor = None
 
     first_token = False
     heal_next_token = False
@@ -45,6 +49,7 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
     total_tokens: int = 0
     accepted_draft_tokens: int = 0
     return_probabilities: bool = False
+    return_top_tokens: int = 0
 
     active_loras = []
     position_offsets = None
@@ -101,25 +106,32 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
         self.expect_utf8 = 0
         self.held_tokens = self.no_tokens
         self.held_probs = self.no_probs
+        self.no_top_tokens = torch.empty((1, 0, self.return_top_tokens), dtype = torch.long)
+        self.no_top_logprobs = torch.empty((1, 0, self.return_top_tokens), dtype = torch.float)
+        self.held_top_tokens = self.no_top_tokens
+        self.held_top_logprobs = self.no_top_logprobs
         self.settings = gen_settings
         self._gen_begin_reuse(input_ids, gen_settings)
 
         self.heal_next_token = (token_healing and self.sequence_ids.shape[-1] >= 2)
 
 
-    def stream(self) -> Union[Tuple[str, bool, torch.Tensor], Tuple[str, bool, torch.Tensor, torch.Tensor]]:
+    # Returns (chunk, eos, chunk_token_ids), followed by probs if return_probabilities is set and by top_tokens,
+    # top_logprobs, each of shape (1, len(chunk_token_ids), return_top_tokens), if return_top_tokens > 0
 
-            chunk, eos, chunk_token_ids, probs = self._stream()
+    def stream(self) -> Tuple:
 
-            if self.return_probabilities:
-                return chunk, eos, chunk_token_ids, probs
-            else:
-                return chunk, eos, chunk_token_ids
+            chunk, eos, chunk_token_ids, probs, top_tokens, top_logprobs = self._stream()
+
+            ret = (chunk, eos, chunk_token_ids)
+            if self.return_probabilities: ret += (probs,)
+            if self.return_top_tokens > 0: ret += (top_tokens, top_logprobs)
+            return ret
 
 
     # Get the next chunk of text in the stream. Returns eos if stop condition has been met but does not count tokens
 
-    def _stream(self) -> (str, bool, torch.Tensor, torch.Tensor):
+    def _stream(self) -> (str, bool, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor):
 
         # Token healing
 
@@ -141,7 +153,7 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
 
             # Regenerate the last token again, with prefix
 
-            healed_token, _, eos = self._gen_single_token(self.settings, prefix_token = last_token)
+            healed_token, _, eos, _, _ = self._gen_single_token(self.settings, prefix_token = last_token)
             new_tail = self.tokenizer.decode(self.sequence_ids[:, -self.tail_decode_tokens:])[0]
             self.held_text += new_tail[len(old_tail):]
 
@@ -149,7 +161,7 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
 
             # In case we only needed the healed token
 
-            if eos: return self.held_text, True, self.no_tokens, self.no_probs
+            if eos: return self.held_text, True, self.no_tokens, self.no_probs, self.no_top_tokens, self.no_top_logprobs
 
         # Start filters when not healing
 
@@ -167,12 +179,12 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
 
         # Generate a single token and append to the sequence
 
-        next_token, next_prob, eos = self._gen_single_token(self.settings)
+        next_token, next_prob, eos, next_top_tokens, next_top_logprobs = self._gen_single_token(self.settings)
 
         # End immediately if it was a stop token
 
         if next_token.item() in self.stop_tokens:
-            return self.held_text, True, self.no_tokens, self.no_probs
+            return self.held_text, True, self.no_tokens, self.no_probs, self.no_top_tokens, self.no_top_logprobs
 
         # Decode the tail end of the sequence with the added token to get (actual) characters added
 
@@ -184,10 +196,13 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
         self.held_text += new_text
         self.held_tokens = torch.cat([self.held_tokens, next_token], dim = -1)
         self.held_probs = torch.cat([self.held_probs, next_prob], dim = -1)
+        if self.return_top_tokens > 0:
+            self.held_top_tokens = torch.cat([self.held_top_tokens, next_top_tokens], dim = 1)
+            self.held_top_logprobs = torch.cat([self.held_top_logprobs, next_top_logprobs], dim = 1)
 
         # Return now if newly added token ends a filter
 
-        if eos: return self.held_text, True, self.held_tokens, self.held_probs
+        if eos: return self.held_text, True, self.held_tokens, self.held_probs, self.held_top_tokens, self.held_top_logprobs
 
         # Hold text as long as it contains part of a stop string
 
@@ -198,7 +213,7 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
 
             position = self.held_text.find(ss)
             if position != -1:
-                return self.held_text[:position], True, self.no_tokens, self.no_probs
+                return self.held_text[:position], True, self.no_tokens, self.no_probs, self.no_top_tokens, self.no_top_logprobs
 
             # Check for overlap between end of held_text and start of stop string
 
@@ -210,17 +225,21 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
         # If holding text because of a partial stop condition, return nothing but also EOS = False
 
         if partial_ss:
-            return "", False, self.no_tokens, self.no_probs
+            return "", False, self.no_tokens, self.no_probs, self.no_top_tokens, self.no_top_logprobs
 
         # No stop condition, so return whatever is being held
 
         stream_text = self.held_text
         stream_tokens = self.held_tokens
         stream_probs = self.held_probs
+        stream_top_tokens = self.held_top_tokens
+        stream_top_logprobs = self.held_top_logprobs
         self.held_text = ""
         self.held_tokens = self.no_tokens
         self.held_probs = self.no_probs
-        return stream_text, False, stream_tokens, stream_probs
+        self.held_top_tokens = self.no_top_tokens
+        self.held_top_logprobs = self.no_top_logprobs
+        return stream_text, False, stream_tokens, stream_probs, stream_top_tokens, stream_top_logprobs
     
 
     def _decode_utf8(self):
@@ -338,12 +357,14 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
 
         if self.draft_model is None:
 
-            logits = self.model.forward(self.sequence_ids[:, -1:], self.cache, loras = self.active_loras, input_mask = self.input_mask, position_offsets = self.position_offsets).float().cpu()
-            token, prob, eos = ExLlamaV2Sampler.sample(logits, gen_settings, self.sequence_ids[:1, :], random.random(), self.tokenizer, prefix_token)
+            logit_ids = self._sparse_logit_ids(gen_settings, prefix_token)
+            logits = self.model.forward(self.sequence_ids[:, -1:], self.cache, loras = self.active_loras, input_mask = self.input_mask, position_offsets = self.position_offsets, logit_ids = logit_ids).float().cpu()
+            if logit_ids is not None: logits = self._expand_sparse_logits(logits, logit_ids)
+            token, prob, eos, top_tokens, top_logprobs = self._sample(logits, gen_settings, prefix_token)
 
         else:
 
-            token, prob, eos = self._gen_single_token_speculative(gen_settings, prefix_token)
+            token, prob, eos, top_tokens, top_logprobs = self._gen_single_token_speculative(gen_settings, prefix_token)
 
         if self.sequence_ids.shape[0] > 1 and token.shape[0] == 1:
             self.sequence_ids = torch.cat([self.sequence_ids, token.repeat(self.sequence_ids.shape[0], 1)], dim = 1)
@@ -351,7 +372,16 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
             self.sequence_ids = torch.cat([self.sequence_ids, token], dim = 1)
 
         gen_settings.feed_filters(token)
-        return token, prob, eos
+        return token, prob, eos, top_tokens, top_logprobs
+
+
+    def _sample(self, logits, gen_settings, prefix_token = None):
+
+        if self.return_top_tokens == 0:
+            token, prob, eos = ExLlamaV2Sampler.sample(logits, gen_settings, self.sequence_ids[:1, :], random.random(), self.tokenizer, prefix_token)
+            return token, prob, eos, None, None
+
+        return ExLlamaV2Sampler.sample(logits, gen_settings, self.sequence_ids[:1, :], random.random(), self.tokenizer, prefix_token, return_top_tokens = self.return_top_tokens)
 
 
     def _gen_single_token_speculative(self, gen_settings, prefix_token = None):
@@ -396,7 +426,7 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
 
         # Sample the first future logits
 
-        token, prob, eos = ExLlamaV2Sampler.sample(self.future_logits[:, :1, :], gen_settings, self.sequence_ids[:1, :], random.random(), self.tokenizer, prefix_token)
+        token, prob, eos, top_tokens, top_logprobs = self._sample(self.future_logits[:, :1, :], gen_settings, prefix_token)
         self.future_logits = self.future_logits[:, 1:, :]
         self.future_tokens = self.future_tokens[:, 1:]
         self.cache.current_seq_len += 1
@@ -411,7 +441,7 @@ class ExLlamaV2StreamingGenerator(ExLlamaV2BaseGenerator):
             self.accepted_draft_tokens += 1
         self.total_tokens += 1
 
-        return token, prob, eos
+        return token, prob, eos, top_tokens, top_logprobs
 
 
     def reset_sd_stats(self):
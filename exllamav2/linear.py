@@ -25,6 +25,9 @@ class ExLlamaV2Linear(ExLlamaV2Module):
     lora_a_tensors: dict
     lora_b_tensors: dict
 
+    row_cache: dict
+    max_cached_rows = 4
+
     def __init__(self, model, key, in_features, out_features, has_bias, pad32 = True):
         super().__init__(model, key)
 
@@ -38,6 +41,7 @@ class ExLlamaV2Linear(ExLlamaV2Module):
 
         self.lora_a_tensors = {}
         self.lora_b_tensors = {}
+        self.row_cache = {}
 
 
     def load(self, w = None):
@@ -81,6 +85,7 @@ class ExLlamaV2Linear(ExLlamaV2Module):
             self.q_tensors = None
 
         self.temp_dq = None
+        self.row_cache = {}
 
 
     def get_weight(self):
@@ -146,6 +151,57 @@ class ExLlamaV2Linear(ExLlamaV2Module):
             return hidden_states_out
 
 
+    # Evaluate only the given output features (e.g. the vocabulary rows of the head layer allowed by a filter),
+    # returning a compact tensor whose last dimension follows row_ids. Quantized weights are shuffled for the kernel
+    # when loaded and can't be gathered by row without reconstructing the whole matrix, which costs more than the
+    # dense product, so quantized layers run the regular kernel and select the outputs afterwards
+
+    def forward_rows(self, hidden_states, row_ids, loras = None):
+
+        if not self.supports_sparse_rows():
+            hidden_states_out = self.forward(hidden_states, loras = loras)
+            return hidden_states_out.index_select(-1, row_ids.to(hidden_states_out.device))
+
+        weight = self.get_weight_rows(row_ids)
+        hidden_states_out = torch.matmul(hidden_states, weight)
+
+        if loras is not None:
+            for lora in loras:
+                lora_a = self.lora_a_tensors.get(lora)
+                lora_b = self.lora_b_tensors.get(lora)
+                if lora_a is not None:
+                    assert lora_b is not None
+                    temp = torch.matmul(hidden_states, lora_a)
+                    hidden_states_out += torch.matmul(temp, lora_b.index_select(1, row_ids.to(lora_b.device)))
+
+        return hidden_states_out
+
+
+    def supports_sparse_rows(self):
+
+        return self.linear is not None
+
+
+    # Gather rows of the FP16 weight as an (in_features, len(row_ids)) matrix, keeping the last few gathered matrices
+    # around for repeated constraints
+
+    def get_weight_rows(self, row_ids):
+
+        assert self.supports_sparse_rows(), "Row gather requires FP16 weights"
+
+        key = row_ids.cpu().numpy().tobytes()
+        weight = self.row_cache.get(key)
+        if weight is not None: return weight
+
+        row_ids = row_ids.to(self.device())
+        weight = self.linear.weight.data.index_select(0, row_ids).T.contiguous()
+
+        while len(self.row_cache) >= self.max_cached_rows:
+            del self.row_cache[next(iter(self.row_cache))]
+        self.row_cache[key] = weight
+        return weight
+
+
     # def dump_group_info(self):
     #
     #     if "q_groups" in self.q_tensors:
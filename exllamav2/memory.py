@@ -0,0 +1,173 @@
+import torch
+from torch import nn
+from exllamav2.module import ExLlamaV2Module
+from exllamav2.attn import ExLlamaV2Attention
+from exllamav2.planner import sincos_bytes, cache_layer_bytes, cache_device_bytes
+
+# Per-device memory accounting for a loaded model. Every tensor held by the model's modules, device tensors and any
+# given caches is attributed to a category, counting each storage once:
+#
+# - weights: module weights, by top-level module type (Attention, MLP, Embedding etc.)
+# - lora: LoRA tensors attached to linear layers
+# - scratch: fixed scratch buffer from ExLlamaV2DeviceTensors (all temp_* buffers of modules are views into it)
+# - sincos: RoPE sin/cos tables
+# - caches: K/V tensors of each cache, plus FP16 staging tensors of 8-bit caches
+# - other: any other tensors modules hold on to, e.g. cached head rows, and the model's attention mask cache
+#
+# Next to the accounted totals are the predicted sizes from the planner's formulas for the current config, and for
+# CUDA devices the allocator's counters: allocated but not accounted for is mostly temp buffers still alive (or
+# leaked), reserved but not allocated is held by the caching allocator, of which inactive_split is fragmentation
+
+_skip_attrs = { "model", "submodules" }
+_lora_attrs = { "lora_a_tensors", "lora_b_tensors" }
+_other_attrs = { "row_cache" }
+
+
+def _storage_key(tensor):
+
+    return tensor.untyped_storage().data_ptr(), str(tensor.device)
+
+
+def _storage_bytes(tensor):
+
+    return tensor.untyped_storage().nbytes()
+
+
+def _collect(value, out):
+
+    if isinstance(value, torch.Tensor):
+        out.append(value)
+    elif isinstance(value, nn.Module):
+        out += list(value.parameters())
+        out += list(value.buffers())
+    elif isinstance(value, dict):
+        for v in value.values(): _collect(v, out)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            if not isinstance(v, ExLlamaV2Module): _collect(v, out)
+
+
+# Tensors held by a module and its submodules, as lists of (category, tensor). Views into the scratch buffer are
+# included here but skipped by memory_report since the scratch storage is counted first
+
+def _module_tensors(module):
+
+    tensors = []
+    objs = [module] + list(getattr(module, "submodules", []))
+    for obj in objs:
+        for name, value in vars(obj).items():
+            if name in _skip_attrs or isinstance(value, ExLlamaV2Module): continue
+            category = "lora" if name in _lora_attrs else "other" if name in _other_attrs else "weights"
+            collected = []
+            _collect(value, collected)
+            tensors += [(category, t) for t in collected]
+    return tensors
+
+
+def memory_report(model, caches = None):
+
+    caches = caches or []
+    devices = {}
+    seen = set()
+
+    def device_entry(device):
+        if device not in devices:
+            devices[device] = { "weights": {}, "lora": 0, "scratch": 0, "sincos": 0, "caches": [0] * len(caches),
+                                "other": 0, "accounted": 0, "predicted": {} }
+        return devices[device]
+
+    def add(tensor, category, sub = None):
+        key = _storage_key(tensor)
+        if key in seen: return
+        seen.add(key)
+        size = _storage_bytes(tensor)
+        d = device_entry(str(tensor.device))
+        if category == "weights": d["weights"][sub] = d["weights"].get(sub, 0) + size
+        elif category == "caches": d["caches"][sub] += size
+        else: d[category] += size
+        d["accounted"] += size
+
+    # Device tensors first, so views into the scratch buffer are never counted as anything else
+
+    for dt in model.device_tensors:
+        if dt.scratch is not None: add(dt.scratch, "scratch")
+        if dt.ready:
+            add(dt.sin, "sincos")
+            add(dt.cos, "sincos")
+
+    for idx, cache in enumerate(caches):
+        for t in cache.key_states + cache.value_states:
+            if t is not None: add(t, "caches", idx)
+        for temp in getattr(cache, "temp_tensors", {}).values():
+            for t in temp: add(t, "caches", idx)
+
+    for module in model.modules:
+        for category, t in _module_tensors(module):
+            add(t, category, module.name)
+
+    if model.attn_mask_cache is not None:
+        for t in model.attn_mask_cache.tensors(): add(t, "other")
+
+    # Predicted sizes
+
+    for module in model.modules:
+        if getattr(module, "device_idx", None) is None: continue
+        d = device_entry(module.device())
+        p = d["predicted"]
+        p["weights"] = p.get("weights", 0) + module.weight_footprint()
+        if isinstance(module, ExLlamaV2Attention):
+            for cache in caches:
+                c = cache_layer_bytes(model.config, cache.max_seq_len, cache.batch_size, cache.dtype == torch.uint8)
+                p["caches"] = p.get("caches", 0) + c
+
+    for cache in caches:
+        if cache.dtype != torch.uint8: continue
+        for device in model.get_cache_devices():
+            p = device_entry(device)["predicted"]
+            p["caches"] = p.get("caches", 0) + cache_device_bytes(model.config, cache.max_seq_len, cache.batch_size, True)
+
+    for dt in model.device_tensors:
+        if dt.scratch_bytes == 0 and not dt.ready: continue
+        d = device_entry("cpu" if dt.device_idx < 0 else f"cuda:{dt.device_idx}")
+        d["predicted"]["scratch"] = dt.scratch_bytes
+        d["predicted"]["sincos"] = sincos_bytes(model.config)
+
+    # Allocator stats
+
+    for device, d in devices.items():
+        if not device.startswith("cuda"): continue
+        stats = torch.cuda.memory_stats(device)
+        d["allocator"] = { "allocated": stats.get("allocated_bytes.all.current", 0),
+                           "reserved": stats.get("reserved_bytes.all.current", 0),
+                           "peak_allocated": stats.get("allocated_bytes.all.peak", 0),
+                           "inactive_split": stats.get("inactive_split_bytes.all.current", 0) }
+        d["allocator"]["unaccounted"] = d["allocator"]["allocated"] - d["accounted"]
+
+    return devices
+
+
+def format_memory_report(report):
+
+    mb = lambda b: f"{b / 1024 ** 2:10.2f}"
+    lines = []
+    for device, d in sorted(report.items()):
+        p = d["predicted"]
+        lines.append(f" -- {device}")
+        for name, size in sorted(d["weights"].items()):
+            lines.append(f"    weights ({name}):{' ' * max(0, 20 - len(name))}{mb(size)} MB")
+        lines.append(f"    weights total:            {mb(sum(d['weights'].values()))} MB   predicted {mb(p.get('weights', 0))} MB")
+        lines.append(f"    lora:                     {mb(d['lora'])} MB")
+        lines.append(f"    scratch:                  {mb(d['scratch'])} MB   predicted {mb(p.get('scratch', 0))} MB")
+        lines.append(f"    sin/cos:                  {mb(d['sincos'])} MB   predicted {mb(p.get('sincos', 0))} MB")
+        for idx, size in enumerate(d["caches"]):
+            lines.append(f"    cache {idx}:                  {mb(size)} MB")
+        if d["caches"]:
+            lines.append(f"    caches total:             {mb(sum(d['caches']))} MB   predicted {mb(p.get('caches', 0))} MB")
+        lines.append(f"    other:                    {mb(d['other'])} MB")
+        lines.append(f"    accounted:                {mb(d['accounted'])} MB")
+        if "allocator" in d:
+            a = d["allocator"]
+            lines.append(f"    allocated:                {mb(a['allocated'])} MB   (unaccounted {mb(a['unaccounted'])} MB)")
+            lines.append(f"    reserved:                 {mb(a['reserved'])} MB   (fragmented {mb(a['inactive_split'])} MB)")
+            lines.append(f"    peak allocated:           {mb(a['peak_allocated'])} MB")
+    return "\n".join(lines)
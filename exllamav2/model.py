@@ -19,15 +19,17 @@ from exllamav2.linear import ExLlamaV2Linear
 from exllamav2.module import ExLlamaV2Module
 from exllamav2.rmsnorm import ExLlamaV2RMSNorm
 from exllamav2.layernorm import ExLlamaV2LayerNorm
-from exllamav2.attn import ExLlamaV2Attention
+from exllamav2.attn import ExLlamaV2Attention, ExLlamaV2AttnMaskCache
 from exllamav2.lora import ExLlamaV2Lora
 from exllamav2.mlp import ExLlamaV2MLP
 from exllamav2.moe_mlp import ExLlamaV2MoEMLP
 from exllamav2.embedding import ExLlamaV2Embedding
 # from exllamav2.util import list_live_tensors, print_vram_usage, set_snapshot, diff_snapshot, print_vram_usage_peak
 from exllamav2.compat import safe_move_tensor
-from exllamav2.fasttensors import cleanup_stfiles
+from exllamav2.fasttensors import cleanup_stfiles, STPrefetch
+from exllamav2.offload import ExLlamaV2Offload
 import gc
+import time
 
 def _torch_device(idx):
     if idx == -1: return "cpu"
@@ -106,6 +108,81 @@ class ExLlamaV2DeviceTensors:
         self.cos = emb.cos()[None, None, :, :].half()
 
 
+# Precomputed execution plan for single-token forward passes with a single cache. Device transitions between modules
+# are worked out once, the attention params object is reused with only past_len updated, and hidden states moving
+# from system RAM to a device are copied into preallocated buffers. Built on first use and discarded whenever modules
+# are placed on devices again
+
+class ExLlamaV2DecodePlan:
+
+    model = None
+    steps: list                 # (module, device to move the hidden state to before the module, or None)
+    kv_steps: list              # Steps up to and including the last layer that updates the cache
+    head_padding: int
+    params: dict                # Reusable ExLlamaV2Attention.Params per batch size
+    buffers: dict               # Preallocated device buffers per (device, shape, dtype)
+
+    def __init__(self, model):
+
+        self.model = model
+        self.steps = []
+
+        prev_device = None
+        for module in model.modules:
+            device = _torch_device(module.device_idx)
+            self.steps.append((module, device if device != prev_device else None))
+            prev_device = device
+
+        self.kv_steps = self.steps[:model.last_kv_layer_idx + 1]
+        self.head_padding = model.modules[-1].padding
+        self.params = {}
+        self.buffers = {}
+
+
+    def get_params(self, batch_size, past_len):
+
+        params = self.params.get(batch_size)
+        if params is None:
+            params = ExLlamaV2Attention.Params(batch_size, 1, past_len, None, None)
+            self.params[batch_size] = params
+        else:
+            params.past_len = past_len
+        return params
+
+
+    def move(self, x, device):
+
+        if x.device.type != "cpu" or device == "cpu":
+            return safe_move_tensor(x, device)
+
+        key = (device, x.shape, x.dtype)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = torch.empty(x.shape, dtype = x.dtype, device = device)
+            self.buffers[key] = buffer
+        buffer.copy_(x)
+        return buffer
+
+
+    def forward(self, input_ids, cache, preprocess_only = False, loras = None):
+
+        past_len = cache.current_seq_len
+        assert past_len + 1 <= cache.max_seq_len, "Total sequence length exceeds cache size in model.forward"
+
+        params = self.get_params(input_ids.shape[0], past_len)
+
+        x = input_ids
+        for module, device in (self.kv_steps if preprocess_only else self.steps):
+            if device is not None: x = self.move(x, device)
+            x = module.forward(x, cache = cache, attn_params = params, past_len = past_len, loras = loras)
+
+        cache.current_seq_len += 1
+
+        if preprocess_only: return None
+        if self.head_padding > 0: x[:, :, -self.head_padding:] = -65504.
+        return x
+
+
 class ExLlamaV2:
 
     config: ExLlamaV2Config
@@ -117,6 +194,12 @@ class ExLlamaV2:
     head_layer_idx: int
     loaded: bool
 
+    load_timings: list = []                     # Per-module timing of the last load, see _record_load_timing
+    load_stats: dict = {}                       # Totals for the last load
+    offload = None                              # ExLlamaV2Offload when loaded with load_offload()
+    decode_plan: ExLlamaV2DecodePlan = None     # Built on first single-token forward pass, see ExLlamaV2DecodePlan
+    attn_mask_cache: ExLlamaV2AttnMaskCache = None
+
 
     def __init__(self, config: ExLlamaV2Config, lazy_load = False):
 
@@ -126,6 +209,7 @@ class ExLlamaV2:
         self.device_tensors = []
         self.cache_map = {}
         self.loaded = False
+        self.attn_mask_cache = ExLlamaV2AttnMaskCache()
 
         # Build model
 
@@ -243,27 +327,145 @@ class ExLlamaV2:
         return [(ab - rb - rba) / 1024**3 for (ab, rb, rba) in zip(allocation_bytes, reserve_bytes, reserve_bytes_attn)]
 
 
-    def load(self, gpu_split = None, lazy = False, stats = False, callback = None, callback_gen = None):
-        f = self.load_gen(gpu_split, lazy, stats, callback, callback_gen)
+    # List the tensors a module loads, from the prefix index built by config.prepare(). Attention and MLP modules share
+    # their key with the layer, so look up their submodules' keys instead. A ready-to-load container lists the tensors
+    # for each module in its manifest
+
+    def module_tensor_keys(self, module):
+
+        if self.config.ready_layout is not None:
+            idx = self.modules.index(module)
+            assert len(self.config.ready_layout) == len(self.modules), \
+                f"Ready-to-load container has {len(self.config.ready_layout)} modules, model has {len(self.modules)}"
+            entry = self.config.ready_layout[idx]
+            assert entry["key"] == module.key and entry["name"] == module.name, \
+                f"Ready-to-load container doesn't match model: expected {module.key} ({module.name}), found {entry['key']} ({entry['name']})"
+            return entry["tensors"]
+
+        submodules = getattr(module, "submodules", [])
+        if len(submodules) > 0:
+            prefixes = [m.key for m in submodules]
+            if isinstance(module, ExLlamaV2MLP) and self.config.checkpoint_fused_mlp:
+                prefixes.append(module.key + ".mlp.swiglu")
+        else:
+            prefixes = [module.key]
+
+        index = self.config.tensor_key_index
+        return [key for prefix in prefixes for key in index.get(prefix, [])]
+
+
+    # Start reading the tensors for a list of modules in the background, in order, one group per module. Modules
+    # placed on the CPU are left out (with an empty group) when CPU tensors are memory-mapped, since they never use
+    # the read-ahead copy
+
+    def prefetch_modules(self, modules):
+
+        if self.config.load_threads <= 0: return None
+
+        groups = []
+        for module in modules:
+            if self.config.mmap_cpu_tensors and getattr(module, "device_idx", None) == -1:
+                groups.append([])
+                continue
+            group = [(self.config.tensor_file_map[key], key) for key in self.module_tensor_keys(module)]
+            groups.append(group)
+
+        return STPrefetch(groups,
+                          num_threads = self.config.load_threads,
+                          max_inflight = self.config.load_max_inflight,
+                          fast = self.config.fasttensors,
+                          pin_memory = self.config.load_pinned and torch.cuda.is_available())
+
+
+    # Record how long a module took to load, split into time waiting for reads, uploading tensors and initializing
+    # (everything else: conversion, make_q_matrix etc., and the test forward pass when autosplitting)
+
+    def _begin_load_timing(self):
+
+        self.load_timings = []
+        self.load_stats = {}
+        return time.time()
+
+
+    def _record_load_timing(self, module, time_begin, prefetch, wait_begin, upload_begin):
+
+        if module.device_idx >= 0: torch.cuda.synchronize(module.device_idx)
+        total = time.time() - time_begin
+        io_wait = prefetch.wait_time - wait_begin if prefetch is not None else 0.0
+        upload = prefetch.upload_time - upload_begin if prefetch is not None else 0.0
+        self.load_timings.append({ "module": module.key,
+                                   "device": module.device(),
+                                   "io_wait": io_wait,
+                                   "upload": upload,
+                                   "init": total - io_wait - upload,
+                                   "total": total })
+
+
+    def _end_load_timing(self, prefetch, load_begin):
+
+        self.load_stats = { "wall": time.time() - load_begin,
+                            "io_wait": sum(t["io_wait"] for t in self.load_timings),
+                            "upload": sum(t["upload"] for t in self.load_timings),
+                            "init": sum(t["init"] for t in self.load_timings),
+                            "read": prefetch.read_time if prefetch is not None else 0.0,
+                            "bytes_read": prefetch.bytes_read if prefetch is not None else 0 }
+
+
+    # Place modules on devices according to a list of device indices, one per module (-1 for CPU), e.g. from
+    # ExLlamaV2SplitPlan.device_map
+
+    def apply_device_map(self, device_map):
+
+        assert len(device_map) == len(self.modules), "Device map doesn't match model"
+
+        self.cache_map = {}
+        num_devices = max(device_map) + 1
+        fixed_bytes = [0] * num_devices
+        for module, device_idx in zip(self.modules, device_map):
+            module.set_device_idx(device_idx)
+            if device_idx >= 0: fixed_bytes[device_idx] = max(fixed_bytes[device_idx], module.scratch_space_fixed())
+
+        self.device_tensors = []
+        for idx, scratch_bytes in enumerate(fixed_bytes):
+            self.device_tensors.append(ExLlamaV2DeviceTensors(self, idx, scratch_bytes))
+
+        self.set_cache_map()
+
+
+    def load(self, gpu_split = None, lazy = False, stats = False, callback = None, callback_gen = None, device_map = None):
+        f = self.load_gen(gpu_split, lazy, stats, callback, callback_gen, device_map)
         for item in f: return item
 
 
-    def load_gen(self, gpu_split = None, lazy = False, stats = False, callback = None, callback_gen = None):
+    def load_gen(self, gpu_split = None, lazy = False, stats = False, callback = None, callback_gen = None, device_map = None):
 
         with torch.inference_mode():
 
-            stats_ = self.set_device_map(gpu_split or [99999])
+            if device_map is not None:
+                self.apply_device_map(device_map)
+                stats_ = None
+            else:
+                stats_ = self.set_device_map(gpu_split or [99999])
 
             # Load module weights
 
             if not lazy:
 
+                prefetch = self.prefetch_modules(self.modules)
+                load_begin = self._begin_load_timing()
+
                 for idx, module in enumerate(self.modules):
 
                     if callback is not None: callback(idx, len(self.modules))
                     if callback_gen is not None: yield from callback_gen(idx, len(self.modules))
 
+                    time_begin = time.time()
+                    wait_begin, upload_begin = (prefetch.wait_time, prefetch.upload_time) if prefetch is not None else (0, 0)
                     module.load()
+                    if prefetch is not None: prefetch.release_group(idx)
+                    self._record_load_timing(module, time_begin, prefetch, wait_begin, upload_begin)
+
+                self._end_load_timing(prefetch, load_begin)
 
                 if callback is not None: callback(len(self.modules), len(self.modules))
                 if callback_gen is not None: yield from callback_gen(len(self.modules), len(self.modules))
@@ -319,7 +521,11 @@ class ExLlamaV2:
             for module in self.modules:
                 scratch_fixed = max(scratch_fixed, module.scratch_space_fixed())
 
-            # Load modules and create cache tensors sequentially
+            # Load modules and create cache tensors sequentially. The embedding layer goes on the CPU
+
+            self.modules[0].set_device_idx(-1)
+            prefetch = self.prefetch_modules(self.modules)
+            load_begin = self._begin_load_timing()
 
             self.cache_map = {}
             for idx, module in enumerate(self.modules):
@@ -327,12 +533,17 @@ class ExLlamaV2:
                 if callback is not None: callback(idx, len(self.modules))
                 if callback_gen is not None: yield from callback_gen(idx, len(self.modules))
 
+                time_begin = time.time()
+                wait_begin, upload_begin = (prefetch.wait_time, prefetch.upload_time) if prefetch is not None else (0, 0)
+
                 # Embedding layer on CPU
 
                 if idx == 0:
 
                     module.set_device_idx(-1)
                     module.load()
+                    if prefetch is not None: prefetch.release_group(idx)
+                    self._record_load_timing(module, time_begin, prefetch, wait_begin, upload_begin)
                     hidden_state = module.forward(hidden_state)
                     continue
 
@@ -406,6 +617,11 @@ class ExLlamaV2:
 
                     break
 
+                if prefetch is not None: prefetch.release_group(idx)
+                self._record_load_timing(module, time_begin, prefetch, wait_begin, upload_begin)
+
+            self._end_load_timing(prefetch, load_begin)
+
             if callback is not None: callback(len(self.modules), len(self.modules))
             if callback_gen is not None: yield from callback_gen(len(self.modules), len(self.modules))
 
@@ -415,6 +631,7 @@ class ExLlamaV2:
 
             gc.collect()
             torch.cuda.empty_cache()
+            self.decode_plan = None
             self.loaded = True
             cleanup_stfiles()
 
@@ -422,18 +639,68 @@ class ExLlamaV2:
             yield
 
 
+    # Load for layer streaming (see offload.py): all weights are read into host memory and modules are loaded onto
+    # device_idx as the forward pass reaches them, keeping at most max_resident bytes of weights on the device. Use
+    # device_idx = -1 to run on the CPU
+
+    def load_offload(self, device_idx = 0, max_resident = 4 * 1024 ** 3, pinned = None, prefetch = 1,
+                     host_memory = "pinned", callback = None):
+
+        with torch.inference_mode():
+
+            self.cache_map = {}
+            fixed_bytes = 0
+            for idx, module in enumerate(self.modules):
+                module.set_device_idx(-1 if idx == 0 else device_idx)
+                if idx > 0: fixed_bytes = max(fixed_bytes, module.scratch_space_fixed())
+
+            if device_idx >= 0:
+                self.device_tensors = [ExLlamaV2DeviceTensors(self, idx, fixed_bytes if idx == device_idx else 0)
+                                       for idx in range(device_idx + 1)]
+            else:
+                self.device_tensors = [ExLlamaV2DeviceTensors(self, -1, fixed_bytes)]
+
+            self.set_cache_map()
+
+            self.offload = ExLlamaV2Offload(self,
+                                            device_idx = device_idx,
+                                            max_resident = max_resident,
+                                            pinned = pinned,
+                                            prefetch = prefetch,
+                                            host_memory = host_memory,
+                                            callback = callback)
+            self.offload.load_pinned()
+            self.loaded = True
+
+
     def unload(self):
 
+        if self.offload is not None:
+            self.offload.close()
+            self.offload = None
+
         for module in self.modules:
             module.unload()
 
+        self.decode_plan = None
+        if self.attn_mask_cache is not None: self.attn_mask_cache.clear()
         self.modules = []
         self.modules_dict = {}
         self.device_tensors = []
 
 
+    # Per-device breakdown of memory held by the model and the given caches, with predicted sizes and allocator stats
+    # (see memory.py). Format with exllamav2.memory.format_memory_report
+
+    def memory_report(self, caches = None):
+
+        from exllamav2.memory import memory_report
+        return memory_report(self, caches)
+
+
     def set_cache_map(self):
 
+        self.decode_plan = None
         for module in self.modules:
             if isinstance(module, ExLlamaV2Attention): self.cache_map[module.layer_idx] = module.device()
 
@@ -489,9 +756,23 @@ class ExLlamaV2:
                 last_id_only = False,
                 loras = None,
                 return_last_state = False,
-                position_offsets = None):
+                position_offsets = None,
+                logit_ids = None):
+
+        # If logit_ids (1D tensor of token IDs) is given, the head layer is only evaluated for those rows and the
+        # last dimension of the output follows logit_ids instead of the vocabulary
 
         q_len = input_ids.shape[-1]
+
+        # Single-token pass with a single cache, e.g. a decode step
+
+        if q_len == 1 and self.config.use_decode_plan and isinstance(cache, ExLlamaV2CacheBase) and \
+                input_mask is None and position_offsets is None and logit_ids is None and not return_last_state and \
+                self.offload is None:
+
+            if self.decode_plan is None: self.decode_plan = ExLlamaV2DecodePlan(self)
+            return self.decode_plan.forward(input_ids, cache, preprocess_only = preprocess_only, loras = loras)
+
         remaining_q_len = q_len
         bsz = input_ids.shape[0]
 
@@ -514,7 +795,10 @@ class ExLlamaV2:
                                                last_id_only = last_id_only,
                                                loras = loras,
                                                return_last_state = return_last_state,
-                                               position_offsets = position_offsets)
+                                               position_offsets = position_offsets,
+                                               logit_ids = logit_ids)
+
+            if q_len > 1 and self.attn_mask_cache is not None: self.attn_mask_cache.release_prefill()
 
             if last_state is None:
                 return result
@@ -563,7 +847,8 @@ class ExLlamaV2:
                                   last_id_only = _last_id_only,
                                   loras = loras,
                                   return_last_state = return_last_state and remaining_q_len <= chunk_size,
-                                  position_offsets = position_offsets)
+                                  position_offsets = position_offsets,
+                                  logit_ids = logit_ids)
 
             if not _preprocess_only:
                 result = r if result is None else torch.cat((result, r), dim = 1)
@@ -573,6 +858,8 @@ class ExLlamaV2:
             remaining_q_len -= chunk_size
             last_state = ls
 
+        if q_len > 1 and self.attn_mask_cache is not None: self.attn_mask_cache.release_prefill()
+
         if last_state is None:
             return result
         else:
@@ -588,7 +875,8 @@ class ExLlamaV2:
                  last_id_only = False,
                  loras = None,
                  return_last_state = False,
-                 position_offsets = None):
+                 position_offsets = None,
+                 logit_ids = None):
 
         batch_size, seq_len = input_ids.shape
         past_len = 0
@@ -601,7 +889,7 @@ class ExLlamaV2:
         # assert cache is None or isinstance(cache, list) or batch_size <= cache.batch_size
 
         x = input_ids
-        attn_params = ExLlamaV2Attention.Params(batch_size, seq_len, past_len, input_mask, position_offsets)
+        attn_params = ExLlamaV2Attention.Params(batch_size, seq_len, past_len, input_mask, position_offsets, self.attn_mask_cache)
         last_state = None
 
         for idx, module in enumerate(self.modules):
@@ -619,8 +907,13 @@ class ExLlamaV2:
                 elif return_last_state:
                     last_state = x.narrow(-2, -1, 1)
 
+            if self.offload is not None: self.offload.acquire(idx)
+
             x = safe_move_tensor(x, device)
-            x = module.forward(x, cache = cache, attn_params = attn_params, past_len = past_len, loras = loras)
+            if idx == self.head_layer_idx and logit_ids is not None:
+                x = module.forward_rows(x, logit_ids, loras = loras)
+            else:
+                x = module.forward(x, cache = cache, attn_params = attn_params, past_len = past_len, loras = loras)
 
             if preprocess_only and idx == self.last_kv_layer_idx:
                 x = None
@@ -636,7 +929,7 @@ class ExLlamaV2:
 
         # Set padding logits to -inf
 
-        if x is not None:
+        if x is not None and logit_ids is None:
             head_padding = self.modules[-1].padding
             if head_padding > 0:
                 x[:, :, -head_padding:] = -65504.
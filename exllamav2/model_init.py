@@ -15,8 +15,10 @@ def add_args(parser):
     parser.add_argument("-rs", "--rope_scale", type = float, help = "RoPE scaling factor")
     parser.add_argument("-ra", "--rope_alpha", type = float, help = "RoPE alpha value (NTK)")
     parser.add_argument("-nfa", "--no_flash_attn", action = "store_true", help = "Disable Flash Attention")
+    parser.add_argument("-ab", "--attn_backend", type = str, help = "Force attention backend: flash_attn, sdpa or matmul")
     parser.add_argument("-lm", "--low_mem", action = "store_true", help = "Enable VRAM optimizations, potentially trading off speed")
     parser.add_argument("-ept", "--experts_per_token", type = int, help = "Override MoE model's default number of experts per token")
+    parser.add_argument("-ol", "--offload_layers", type = float, help = "Stream layers from system RAM, keeping at most this many GB of weights in VRAM")
     if os.name != "nt":
         parser.add_argument("-fst", "--fast_safetensors", action = "store_true", help = "Optimized safetensors loading with direct I/O (experimental!)")
 
@@ -31,9 +33,11 @@ def print_options(args):
     if args.rope_scale is not None: print_opts += [f"rope_scale: {args.rope_scale}"]
     if args.rope_alpha is not None: print_opts += [f"rope_alpha: {args.rope_alpha}"]
     if args.no_flash_attn: print_opts += ["no_flash_attn"]
+    if args.attn_backend is not None: print_opts += [f"attn_backend: {args.attn_backend}"]
     if args.low_mem: print_opts += ["low_mem"]
     if hasattr(args, "fast_safetensors") and args.fast_safetensors: print_opts += ["fast_safetensors"]
     if args.experts_per_token is not None: print_opts += [f"experts_per_token: {args.experts_per_token}"]
+    if args.offload_layers is not None: print_opts += [f"offload_layers: {args.offload_layers}"]
     print(f" -- Options: {print_opts}")
 
 
@@ -79,6 +83,7 @@ def init(args, quiet = False, allow_auto_split = False, skip_load = False, bench
     if args.rope_scale: config.scale_pos_emb = args.rope_scale
     if args.rope_alpha: config.scale_alpha_value = args.rope_alpha
     config.no_flash_attn = args.no_flash_attn
+    if args.attn_backend: config.attn_backend = args.attn_backend
     if args.experts_per_token: config.num_experts_per_token = args.experts_per_token
 
     # Set low-mem options
@@ -95,13 +100,21 @@ def init(args, quiet = False, allow_auto_split = False, skip_load = False, bench
     if args.gpu_split and args.gpu_split != "auto":
         split = [float(alloc) for alloc in args.gpu_split.split(",")]
 
-    if args.gpu_split != "auto" and not skip_load:
+    if args.offload_layers is not None and not skip_load:
+        if not quiet: print(" -- Loading model for layer streaming...")
+        model.load_offload(max_resident = int(args.offload_layers * 1024**3))
+
+    elif args.gpu_split != "auto" and not skip_load:
         if not quiet: print(" -- Loading model...")
         t = time.time()
         model.load(split)
         t = time.time() - t
         if benchmark and not quiet:
             print(f" -- Loaded model in {t:.4f} seconds")
+            ls = model.load_stats
+            if ls:
+                print(f" -- Load stages: I/O wait {ls['io_wait']:.4f} s, upload {ls['upload']:.4f} s, init {ls['init']:.4f} s, "
+                      f"read {ls['bytes_read'] / 1024**3:.2f} GB in {ls['read']:.4f} s (all threads)")
     else:
         assert allow_auto_split, "Auto split not allowed."
 
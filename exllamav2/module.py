@@ -58,6 +58,9 @@ class ExLlamaV2Module:
 
         key = self.key if override_key is None else override_key
 
+        if self.model.offload is not None and not measure:
+            return self.model.offload.get_tensors(key, keys, self.device())
+
         for k in keys:
             ck = key + "." + k
             if ck in self.model.config.tensor_file_map:
@@ -74,7 +77,7 @@ class ExLlamaV2Module:
                 if measure:
                     size += stfile.measure(key + "." + k)
                 else:
-                    tensors[k] = stfile.get_tensor(key + "." + k, device = self.device())
+                    tensors[k] = stfile.get_tensor(key + "." + k, device = self.device(), mmap_cpu = self.model.config.mmap_cpu_tensors)
 
             # with safe_open(v, framework="pt", device="cpu") as st:
             #     for k in ks:
@@ -93,6 +96,12 @@ class ExLlamaV2Module:
         # EXL2
 
         if key + ".q_weight" in self.model.config.tensor_file_map:
+
+            # Ready-to-load container has q_perm and the remaining derived tensors precomputed
+
+            if key + ".q_group_map" in self.model.config.tensor_file_map:
+                return self.load_multi(["q_weight", "q_invperm", "q_scale", "q_scale_max", "q_groups", "q_perm", "q_group_map"], override_key = override_key)
+
             qtensors = self.load_multi(["q_weight", "q_invperm", "q_scale", "q_scale_max", "q_groups", "q_perm"], override_key = override_key)
             qtensors["q_perm"] = torch.argsort(qtensors["q_invperm"]).to(torch.int)
             return qtensors
@@ -0,0 +1,244 @@
+import torch
+from collections import OrderedDict
+from exllamav2.fasttensors import STFile
+import time
+
+# Layer-streaming execution for models that don't fit on the device. All weights are held in host memory (pinned, or
+# as views into the memory-mapped model files) and modules are loaded onto the device when the forward pass reaches
+# them. At most max_resident bytes of module weights stay loaded; beyond that the least recently used module is
+# unloaded. Pinned modules (by default the embeddings, final norm, head and as many leading layers as fit in half the
+# budget) are never unloaded. Since the forward pass visits modules cyclically, unpinned modules beyond the budget are
+# streamed in on every pass, so the pinned set is what determines the hit rate.
+#
+# While a module runs, the weights of the next prefetch modules are uploaded on a separate CUDA stream so transfers
+# overlap with compute. Modules still go through their regular load(), which picks up the staged tensors via
+# ExLlamaV2Module.load_multi. Staged bytes count against max_resident along with loaded modules: staging evicts
+# least recently used modules to make room, and is skipped if there isn't room. With device_idx = -1 everything runs
+# on the CPU, which exercises the same residency logic without transfers.
+#
+# Stats: hits and loads count acquire() calls that found the module loaded or had to load it, bytes_uploaded is the
+# total size of streamed weights, wait_time is time spent waiting for staged uploads and load_time is total time
+# spent loading modules (including the waits)
+
+class ExLlamaV2Offload:
+
+    model = None
+    device_idx: int
+    max_resident: int
+    prefetch: int
+
+    host_tensors: dict
+    footprints: list
+    pinned: set
+    resident: OrderedDict
+    resident_bytes: int
+    staged: dict                # Tensor key -> (device tensor, upload event, bytes)
+    staged_bytes: int
+
+    def __init__(self, model, device_idx = 0, max_resident = 4 * 1024 ** 3, pinned = None, prefetch = 1,
+                 host_memory = "pinned", callback = None):
+
+        assert host_memory in ["pinned", "mmap"], "host_memory must be 'pinned' or 'mmap'"
+
+        self.model = model
+        self.device_idx = device_idx
+        self.max_resident = max_resident
+        self.prefetch = prefetch
+        self.cuda = device_idx >= 0
+        self.stream = torch.cuda.Stream(device = device_idx) if self.cuda else None
+
+        self.hits = 0
+        self.loads = 0
+        self.bytes_uploaded = 0
+        self.wait_time = 0.0
+        self.load_time = 0.0
+
+        # Read all weights into host memory
+
+        modules = model.modules
+        self.host_tensors = {}
+        self.module_keys = []
+        self.footprints = []
+        pin = host_memory == "pinned" and torch.cuda.is_available()
+
+        for idx, module in enumerate(modules):
+            if callback is not None: callback(idx, len(modules))
+            keys = model.module_tensor_keys(module)
+            size = 0
+            for key in keys:
+                stfile = STFile.open(model.config.tensor_file_map[key], fast = False)
+                tensor = stfile.get_tensor_mmap(key)
+                if pin: tensor = tensor.pin_memory()
+                self.host_tensors[key] = tensor
+                size += tensor.numel() * tensor.element_size()
+            self.module_keys.append(keys)
+            self.footprints.append(size)
+
+        # Modules to keep loaded
+
+        if pinned is None:
+            pinned = { 0, len(modules) - 2, model.head_layer_idx }
+            budget = max_resident // 2 - sum(self.footprints[i] for i in pinned)
+            for idx in range(1, len(modules)):
+                if idx in pinned: continue
+                if self.footprints[idx] > budget: break
+                pinned.add(idx)
+                budget -= self.footprints[idx]
+
+        self.pinned = set(pinned)
+        self.resident = OrderedDict()
+        self.resident_bytes = 0
+        self.staged = {}
+        self.staged_bytes = 0
+
+        if callback is not None: callback(len(modules), len(modules))
+
+
+    def load_pinned(self):
+
+        for idx in sorted(self.pinned):
+            if idx not in self.resident: self.load_module(idx)
+
+
+    # Embeddings stay on the CPU as with a regular load
+
+    def module_device_idx(self, idx):
+
+        return -1 if idx == 0 else self.device_idx
+
+
+    def device(self, idx):
+
+        return self.model.modules[idx].device()
+
+
+    # Return tensors for key + "." + k for each k in keys that the module has, taking staged uploads if available
+
+    def get_tensors(self, key, keys, device):
+
+        tensors = {}
+        for k in keys:
+            ck = key + "." + k
+            if ck not in self.host_tensors: continue
+
+            staged = self.staged.pop(ck, None)
+            if staged is not None:
+                tensor, event, nbytes = staged
+                self.staged_bytes -= nbytes
+                time_begin = time.time()
+                torch.cuda.current_stream(device).wait_event(event)
+                tensor.record_stream(torch.cuda.current_stream(device))
+                self.wait_time += time.time() - time_begin
+                tensors[k] = tensor
+                continue
+
+            # Tensors are updated in place by some modules as they're loaded, so never hand out the host copy
+
+            host = self.host_tensors[ck]
+            if device == "cpu":
+                tensors[k] = host.clone()
+            else:
+                tensors[k] = host.to(device, non_blocking = host.is_pinned())
+                self.bytes_uploaded += host.numel() * host.element_size()
+
+        return tensors
+
+
+    def staged_size(self, idx):
+
+        return sum(self.staged[key][2] for key in self.module_keys[idx] if key in self.staged)
+
+
+    # Unload least recently used unpinned modules, other than exclude, until nbytes more fit in the budget. Returns
+    # False if they don't fit even then
+
+    def make_room(self, nbytes, exclude = None):
+
+        for victim in list(self.resident.keys()):
+            if self.resident_bytes + self.staged_bytes + nbytes <= self.max_resident: break
+            if victim in self.pinned or victim == exclude: continue
+            self.unload_module(victim)
+
+        return self.resident_bytes + self.staged_bytes + nbytes <= self.max_resident
+
+
+    # Start uploading the weights of a module on the transfer stream, if they fit in the budget
+
+    def stage(self, idx, exclude = None):
+
+        if not self.cuda or self.module_device_idx(idx) < 0: return
+        keys = [key for key in self.module_keys[idx] if key not in self.staged]
+        nbytes = sum(self.host_tensors[key].numel() * self.host_tensors[key].element_size() for key in keys)
+        if nbytes == 0 or not self.make_room(nbytes, exclude): return
+
+        device = self.device(idx)
+        with torch.cuda.stream(self.stream):
+            for key in keys:
+                host = self.host_tensors[key]
+                size = host.numel() * host.element_size()
+                tensor = host.to(device, non_blocking = host.is_pinned())
+                event = torch.cuda.Event()
+                event.record(self.stream)
+                self.staged[key] = (tensor, event, size)
+                self.staged_bytes += size
+                self.bytes_uploaded += size
+
+
+    def load_module(self, idx):
+
+        time_begin = time.time()
+        self.model.modules[idx].load()
+        self.resident[idx] = True
+        self.resident_bytes += self.footprints[idx]
+        self.load_time += time.time() - time_begin
+
+
+    def unload_module(self, idx):
+
+        self.model.modules[idx].unload()
+        del self.resident[idx]
+        self.resident_bytes -= self.footprints[idx]
+
+
+    # Make sure module idx is loaded before running it, evicting least recently used modules as needed, and start
+    # uploading the modules that follow it
+
+    def acquire(self, idx):
+
+        if idx in self.resident:
+            self.resident.move_to_end(idx)
+            self.hits += 1
+
+        else:
+            # Staged tensors of this module move from staged to resident as it loads
+
+            self.make_room(self.footprints[idx] - self.staged_size(idx))
+            self.load_module(idx)
+            self.loads += 1
+
+        num_modules = len(self.model.modules)
+        for i in range(1, self.prefetch + 1):
+            next_idx = (idx + i) % num_modules
+            if next_idx not in self.resident: self.stage(next_idx, exclude = idx)
+
+
+    def get_stats(self):
+
+        return { "hits": self.hits,
+                 "loads": self.loads,
+                 "bytes_uploaded": self.bytes_uploaded,
+                 "wait_time": self.wait_time,
+                 "load_time": self.load_time,
+                 "resident_bytes": self.resident_bytes,
+                 "staged_bytes": self.staged_bytes,
+                 "resident_modules": len(self.resident),
+                 "pinned_modules": len(self.pinned) }
+
+
+    def close(self):
+
+        for idx in list(self.resident.keys()):
+            self.unload_module(idx)
+        self.staged = {}
+        self.staged_bytes = 0
+        self.host_tensors = {}
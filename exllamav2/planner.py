@@ -0,0 +1,181 @@
+from exllamav2.attn import ExLlamaV2Attention, ExLlamaV2AttnMaskCache
+
+# Analytical device split planning. Computes what load_autosplit would do, without allocating anything: module weight
+# footprints are measured from the .safetensors headers, scratch and temp sizes come from the modules' own size
+# functions for the current config, and cache sizes from the cache dimensions. Modules are placed on devices in
+# order, moving to the next device when the next module (plus its share of the cache and the device's peak temp
+# usage) doesn't fit, as with load_autosplit. The resulting device_map can be passed to ExLlamaV2.load().
+#
+# Per-device accounting:
+#
+# - weights: sum of weight footprints of modules on the device
+# - cache: K/V tensors for attention layers on the device, plus FP16 staging tensors for an 8-bit cache
+# - fixed: scratch buffer shared by all modules on the device (largest scratch_space_fixed())
+# - constants: sin/cos tables
+# - temp: peak transient allocations during a forward pass: the largest non-fixed scratch requirement of any module
+#   on the device, the attention weights (temp_attn_size) and the hidden state and mask for a full-length chunk
+# - reserve: headroom left for the CUDA context, allocator fragmentation etc.
+
+
+def sincos_bytes(config):
+
+    return config.head_dim * config.max_seq_len * 2 * 2
+
+
+# Hidden state and attention mask for a full-size chunk. Chunking keeps q_len * (past_len + q_len) within
+# max_attention_size, and mask buffers are rounded up to 256 columns. Single-token masks stay in the model's mask
+# cache between passes (see ExLlamaV2AttnMaskCache), at most max_entries of max_seq_len columns
+
+def state_bytes(config):
+
+    state_size = config.hidden_size * config.max_input_len * config.max_batch_size * 2
+    mask_cols = min(config.max_input_len * config.max_seq_len, config.max_attention_size) + 256 * config.max_input_len
+    mask_size = config.max_batch_size * mask_cols * 2
+    decode_mask_size = ExLlamaV2AttnMaskCache.max_entries * config.max_batch_size * (config.max_seq_len + 256) * 2
+    return state_size + mask_size + decode_mask_size
+
+
+def cache_layer_bytes(config, max_seq_len = None, batch_size = 1, cache_8bit = False):
+
+    max_seq_len = max_seq_len or config.max_seq_len
+    numel = batch_size * max_seq_len * config.num_key_value_heads * config.head_dim
+    return 2 * numel * (1 if cache_8bit else 2)
+
+
+def cache_device_bytes(config, max_seq_len = None, batch_size = 1, cache_8bit = False):
+
+    if not cache_8bit: return 0
+    max_seq_len = max_seq_len or config.max_seq_len
+    return 2 * batch_size * max_seq_len * config.num_key_value_heads * config.head_dim * 2
+
+
+def default_reserve(num_devices):
+
+    return [192 * 1024 ** 2] + [64 * 1024 ** 2] * (num_devices - 1)
+
+
+class ExLlamaV2SplitPlan:
+
+    device_map: list                # Device index for each module, -1 for CPU
+    devices: list                   # Per-device breakdown, dicts of bytes
+    device_memory: list             # Bytes available per device
+    fits: bool
+    module_names: list
+
+    def __init__(self, device_memory):
+
+        self.device_map = []
+        self.device_memory = device_memory
+        self.devices = [ExLlamaV2SplitPlan.empty_device() for _ in device_memory]
+        self.fits = True
+        self.module_names = []
+
+
+    @staticmethod
+    def empty_device():
+
+        return { "weights": 0, "cache": 0, "fixed": 0, "constants": 0, "temp": 0, "reserve": 0, "modules": 0 }
+
+
+    @staticmethod
+    def device_total(d):
+
+        return d["weights"] + d["cache"] + d["fixed"] + d["constants"] + d["temp"] + d["reserve"]
+
+
+    def gpu_split(self):
+
+        return [ExLlamaV2SplitPlan.device_total(d) / 1024 ** 3 for d in self.devices if d["modules"] > 0]
+
+
+    def report(self):
+
+        lines = []
+        gb = lambda b: f"{b / 1024 ** 3:8.2f}"
+        lines.append(f" -- Split plan: {'fits' if self.fits else 'DOES NOT FIT'}")
+        lines.append(f"    {'device':>8} {'weights':>8} {'cache':>8} {'fixed':>8} {'const':>8} {'temp':>8} {'reserve':>8} "
+                     f"{'total':>8} {'avail':>8}   modules")
+
+        for idx, d in enumerate(self.devices):
+            on_device = [i for i, dev in enumerate(self.device_map) if dev == idx]
+            span = f"{on_device[0]}-{on_device[-1]} ({self.module_names[on_device[0]]} .. {self.module_names[on_device[-1]]})" \
+                   if on_device else "-"
+            lines.append(f"    {'cuda:' + str(idx):>8} {gb(d['weights'])} {gb(d['cache'])} {gb(d['fixed'])} {gb(d['constants'])} "
+                         f"{gb(d['temp'])} {gb(d['reserve'])} {gb(ExLlamaV2SplitPlan.device_total(d))} "
+                         f"{gb(self.device_memory[idx])}   {span}")
+
+        on_cpu = [i for i, dev in enumerate(self.device_map) if dev == -1]
+        if on_cpu: lines.append(f"    {'cpu':>8}   modules: {', '.join(self.module_names[i] for i in on_cpu)}")
+        lines.append("    (GB)")
+        return "\n".join(lines)
+
+
+# Plan a split for model (created but not loaded) across devices with device_memory bytes each. The cache is
+# described by its length, batch size and type since it doesn't exist yet
+
+def plan_autosplit(model, device_memory, max_seq_len = None, batch_size = 1, cache_8bit = False, reserve = None,
+                   embed_cpu = True):
+
+    config = model.config
+    num_devices = len(device_memory)
+    if reserve is None: reserve = default_reserve(num_devices)
+
+    plan = ExLlamaV2SplitPlan(device_memory)
+    layer_cache = cache_layer_bytes(config, max_seq_len, batch_size, cache_8bit)
+    scratch_fixed = max(module.scratch_space_fixed() for module in model.modules)
+
+    # Usage of a device given its current accounting plus one more module
+
+    def usage(d, weights, cache, temp):
+        return d["weights"] + weights + d["cache"] + cache + d["fixed"] + d["constants"] + max(d["temp"], temp) + d["reserve"]
+
+    current = 0
+    for idx, module in enumerate(model.modules):
+
+        plan.module_names.append(f"{module.key} ({module.name})")
+
+        if idx == 0 and embed_cpu:
+            plan.device_map.append(-1)
+            continue
+
+        weights = module.weight_footprint()
+        cache = layer_cache if isinstance(module, ExLlamaV2Attention) else 0
+        temp = max(module.scratch_space() - module.scratch_space_fixed(), 0) + state_bytes(config)
+        if isinstance(module, ExLlamaV2Attention): temp += module.temp_attn_size()
+
+        while True:
+
+            if current >= num_devices:
+                plan.fits = False
+                current = num_devices - 1
+                break
+
+            d = plan.devices[current]
+            if d["modules"] == 0:
+                d = dict(d)
+                d["fixed"] = scratch_fixed
+                d["constants"] = sincos_bytes(config)
+                d["cache"] = cache_device_bytes(config, max_seq_len, batch_size, cache_8bit)
+                d["reserve"] = reserve[current]
+
+            if usage(d, weights, cache, temp) <= device_memory[current]:
+                plan.devices[current] = d
+                break
+
+            # Module doesn't fit on the last device even when empty, so place it there and report the overflow
+
+            if plan.devices[current]["modules"] == 0 and current == num_devices - 1:
+                plan.devices[current] = d
+                plan.fits = False
+                break
+
+            current += 1
+
+        d = plan.devices[current]
+        d["weights"] += weights
+        d["cache"] += cache
+        d["temp"] = max(d["temp"], temp)
+        d["modules"] += 1
+        plan.device_map.append(current)
+
+    return plan
@@ -0,0 +1,251 @@
+import torch
+from exllamav2.fasttensors import STFile
+import os, glob, json, struct, hashlib
+
+# Ready-to-load container: a single safetensors file holding every tensor in the form the loader consumes it, in
+# module load order, so loading is a sequential read with no per-tensor post-processing:
+#
+# - EXL2 matrices carry q_perm (argsort of q_invperm), 16-bit permutations, q_scale_max pre-divided by 256 and the
+#   q_group_map otherwise built at load time
+# - GPTQ scales are stored as half, and g_idx is dropped when it's all zeros (no act-order)
+# - Unquantized weights are stored as half
+# - Fused swiglu.w12/w3 tensors are stored as separate gate_proj/up_proj/down_proj weights
+#
+# Each module's tensors start on a page boundary, and each tensor is aligned to tensor_alignment bytes. Gaps are
+# filled with U8 padding tensors so the file stays readable by the safetensors library. The __metadata__ entry holds
+# a JSON manifest with the tensor list of every module (the module-to-file layout) and a fingerprint of the source
+# files, so ExLlamaV2Config.prepare can take the tensor map from the manifest instead of scanning every header
+
+ready_filename = "model.ready"
+ready_format_version = 1
+manifest_key = "exllamav2_ready"
+
+page_alignment = 4096
+tensor_alignment = 256
+
+_dtypes = \
+{
+    torch.float16: "F16",
+    torch.int: "I32",
+    torch.short: "I16",
+    torch.uint8: "U8",
+}
+
+
+# Fingerprint of the source checkpoint: names, sizes and modification times of the .safetensors files and the
+# contents of config.json. Cheap enough to check on every prepare() without reading any tensor headers. Sizes alone
+# don't catch a model quantized again at the same bitrate, and headers don't either since they only describe shapes
+
+def source_fingerprint(model_dir):
+
+    h = hashlib.sha256()
+    h.update(f"v{ready_format_version}".encode("utf-8"))
+    with open(os.path.join(model_dir, "config.json"), "rb") as f:
+        h.update(f.read())
+    for filename in sorted(glob.glob(os.path.join(model_dir, "*.safetensors"))):
+        h.update(b"\x00" + os.path.basename(filename).encode("utf-8"))
+        stat = os.stat(filename)
+        h.update(struct.pack("<qq", stat.st_size, stat.st_mtime_ns))
+    return h.hexdigest()
+
+
+# Return (filename, manifest) for a usable ready-to-load container in model_dir, or (None, None). A container built
+# from different source files is ignored, unless the source files have been removed
+
+def find_ready(model_dir, fast = False):
+
+    filename = os.path.join(model_dir, ready_filename)
+    if not os.path.exists(filename): return None, None
+
+    stfile = STFile.open(filename, fast = fast)
+    metadata = stfile.get_metadata() or {}
+    if manifest_key not in metadata: return None, None
+    manifest = json.loads(metadata[manifest_key])
+
+    if manifest["version"] != ready_format_version:
+        print(f" !! Warning, ignoring {filename}: built with format version {manifest['version']}")
+        return None, None
+
+    if len(glob.glob(os.path.join(model_dir, "*.safetensors"))) > 0 and \
+            manifest["source"] != source_fingerprint(model_dir):
+        print(f" !! Warning, ignoring {filename}: model files have changed since it was exported")
+        return None, None
+
+    return filename, manifest
+
+
+def _read(config, key):
+
+    filename = config.tensor_file_map[key]
+    return STFile.open(filename, fast = False).get_tensor(key, device = "cpu", mmap_cpu = True)
+
+
+def _half(config, key):
+
+    return lambda: _read(config, key).half()
+
+
+# Plan the output tensors for one module as a list of (key, dtype, shape, fn) where fn produces the CPU tensor. Small
+# derived tensors are computed here, large ones are read again when writing
+
+def _plan_module(model, module, keys):
+
+    from exllamav2.ext import make_group_map
+    from exllamav2.mlp import ExLlamaV2MLP
+
+    config = model.config
+    header = lambda k: STFile.open(config.tensor_file_map[k], fast = False).get_dict()[k]
+    plan = []
+
+    def add(k, t):
+        plan.append((k, _dtypes[t.dtype], list(t.shape), lambda: t))
+
+    def add_half(k, src = None):
+        src = src or k
+        plan.append((k, "F16", header(src)["shape"], _half(config, src)))
+
+    def add_raw(k):
+        h = header(k)
+        plan.append((k, h["dtype"], h["shape"], lambda: _read(config, k)))
+
+    done = set()
+    for k in keys:
+        if k in done: continue
+        prefix, name = k.rsplit(".", 1)
+
+        # EXL2
+
+        if name == "q_weight":
+            q_invperm = _read(config, prefix + ".q_invperm")
+            q_groups = _read(config, prefix + ".q_groups")
+            q_scale_max = _read(config, prefix + ".q_scale_max")
+            qrows = header(k)["shape"][0]
+            add_raw(k)
+            add(prefix + ".q_invperm", q_invperm.short())
+            add(prefix + ".q_perm", torch.argsort(q_invperm).short())
+            add_raw(prefix + ".q_scale")
+            add(prefix + ".q_scale_max", q_scale_max.half() / 256)
+            add(prefix + ".q_groups", q_groups.clone())
+            add(prefix + ".q_group_map", make_group_map(q_groups, qrows))
+            done.update(prefix + "." + n for n in ["q_weight", "q_invperm", "q_perm", "q_scale", "q_scale_max", "q_groups"])
+            continue
+
+        # GPTQ
+
+        if name == "qweight":
+            add_raw(k)
+            add_raw(prefix + ".qzeros")
+            add_half(prefix + ".scales")
+            if prefix + ".g_idx" in config.tensor_file_map:
+                g_idx = _read(config, prefix + ".g_idx")
+                if not (g_idx == 0).all().item(): add(prefix + ".g_idx", g_idx.clone())
+            done.update(prefix + "." + n for n in ["qweight", "qzeros", "scales", "g_idx"])
+            continue
+
+        # Remaining parts of quantized matrices are added along with q_weight/qweight
+
+        if name in ["q_invperm", "q_perm", "q_scale", "q_scale_max", "q_groups", "qzeros", "scales", "g_idx"]:
+            continue
+
+        # Fused MLP
+
+        if isinstance(module, ExLlamaV2MLP) and k == module.key + ".mlp.swiglu.w12.weight":
+            h = header(k)
+            rows = config.intermediate_size
+            plan.append((module.gate_proj.key + ".weight", "F16", [rows] + h["shape"][1:], lambda k = k: _read(config, k)[:rows].half()))
+            plan.append((module.up_proj.key + ".weight", "F16", [h["shape"][0] - rows] + h["shape"][1:], lambda k = k: _read(config, k)[rows:].half()))
+            continue
+
+        if isinstance(module, ExLlamaV2MLP) and k == module.key + ".mlp.swiglu.w3.weight":
+            add_half(module.down_proj.key + ".weight", k)
+            continue
+
+        # Unquantized
+
+        if header(k)["dtype"] in ["F32", "BF16"]: add_half(k)
+        else: add_raw(k)
+
+    return plan
+
+
+# Write a ready-to-load container for the checkpoint model was created from (lazily, i.e. without loading any weights)
+# to filename, by default next to the model files. Returns the filename
+
+def export_ready(model, filename = None, callback = None):
+
+    config = model.config
+    if filename is None: filename = os.path.join(config.model_dir, ready_filename)
+    assert config.ready_file is None, "Model was configured from a ready-to-load container"
+
+    # Plan the layout
+
+    header = {}
+    plans = []
+    layout = []
+    pos = 0
+    pad_idx = 0
+
+    def pad(alignment):
+        nonlocal pos, pad_idx
+        n = -pos % alignment
+        if n == 0: return
+        header[f"__padding__.{pad_idx}"] = { "dtype": "U8", "shape": [n], "data_offsets": [pos, pos + n] }
+        plans.append((None, n))
+        pad_idx += 1
+        pos += n
+
+    with torch.inference_mode():
+
+        for idx, module in enumerate(model.modules):
+
+            if callback is not None: callback(idx, len(model.modules))
+
+            pad(page_alignment)
+            begin = pos
+            keys = model.module_tensor_keys(module)
+            tensors = []
+            for k, dtype, shape, fn in _plan_module(model, module, keys):
+                pad(tensor_alignment)
+                numel = 1
+                for x in shape: numel *= x
+                length = numel * { "F16": 2, "I16": 2, "I32": 4, "F32": 4, "BF16": 2, "U8": 1 }[dtype]
+                header[k] = { "dtype": dtype, "shape": shape, "data_offsets": [pos, pos + length] }
+                plans.append((fn, length))
+                tensors.append(k)
+                pos += length
+
+            layout.append({ "key": module.key, "name": module.name, "tensors": tensors, "range": [begin, pos] })
+
+        manifest = { "version": ready_format_version,
+                     "source": source_fingerprint(config.model_dir),
+                     "modules": layout }
+        header["__metadata__"] = { "format": "pt", manifest_key: json.dumps(manifest) }
+
+        # Pad header so tensor data starts on a page boundary
+
+        header_json = json.dumps(header).encode("utf-8")
+        header_json += b" " * (-(len(header_json) + 8) % page_alignment)
+
+        # Write
+
+        temp_filename = filename + ".tmp"
+        try:
+            with open(temp_filename, "wb") as f:
+                f.write(struct.pack("<q", len(header_json)))
+                f.write(header_json)
+                for fn, length in plans:
+                    if fn is None:
+                        f.write(b"\x00" * length)
+                        continue
+                    t = fn().contiguous()
+                    data = t.reshape(-1).view(torch.uint8).numpy()
+                    assert len(data) == length, "Tensor size doesn't match planned layout"
+                    f.write(memoryview(data))
+            os.replace(temp_filename, filename)
+        except:
+            if os.path.exists(temp_filename): os.remove(temp_filename)
+            raise
+
+        if callback is not None: callback(len(model.modules), len(model.modules))
+
+    return filename
@@ -166,7 +166,7 @@ async def infer(request, ws, server, response):
         full_ctx = request["text"]
         num_tokens = request["max_new_tokens"]
 
-        ids = server.tokenizer.cached_encode_str(full_ctx)
+        ids = server.tokenizer.encode_incremental(full_ctx)
         overflow = ids.shape[-1] + num_tokens - server.model.config.max_seq_len
         if overflow > 0:
             ids = ids[:, overflow:]
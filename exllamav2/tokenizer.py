@@ -1,22 +1,183 @@
 from exllamav2.config import ExLlamaV2Config
 import torch
-import os, json, re
+import os, json, re, hashlib
+from collections import OrderedDict
+from array import array
+from bisect import bisect_left
 from exllamav2.tokenizers import (
     ExLlamaV2TokenizerBase,
     ExLlamaV2TokenizerSPM,
     ExLlamaV2TokenizerHF
 )
+from exllamav2 import tokenizer_cache
 
 class ExLlamaV2Tokenizer:
 
+    # Character trie stored as flat arrays, with nodes in breadth-first order so the children of each node are
+    # contiguous and sorted by character. Node k has children child_offsets[k] .. child_offsets[k + 1] - 1, reached
+    # via the characters in edge_chars, and ends the pieces leaf_ids[leaf_offsets[k] : leaf_offsets[k + 1]]
+
+    class TrieArrays:
+
+        child_offsets: array
+        edge_chars: array
+        leaf_offsets: array
+        leaf_ids: array
+
+        def __init__(self, pieces, ids):
+
+            # pieces must be sorted and non-empty, with ids in the same order
+
+            self.child_offsets = array("i", [1])
+            self.edge_chars = array("I", [0])
+            self.leaf_offsets = array("i", [0])
+            self.leaf_ids = array("i")
+
+            nodes = [(0, len(pieces))]
+            depth = [0]
+            k = 0
+            while k < len(nodes):
+
+                lo, hi = nodes[k]
+                d = depth[k]
+
+                # Pieces ending at this node sort before any longer ones sharing the same prefix
+
+                i = lo
+                while i < hi and len(pieces[i]) == d:
+                    self.leaf_ids.append(ids[i])
+                    i += 1
+                self.leaf_offsets.append(len(self.leaf_ids))
+
+                while i < hi:
+                    c = pieces[i][d]
+                    j = i + 1
+                    while j < hi and pieces[j][d] == c: j += 1
+                    nodes.append((i, j))
+                    depth.append(d + 1)
+                    self.edge_chars.append(ord(c))
+                    i = j
+                self.child_offsets.append(len(nodes))
+
+                nodes[k] = None
+                k += 1
+
+        @staticmethod
+        def from_arrays(child_offsets, edge_chars, leaf_offsets, leaf_ids):
+
+            arrays = ExLlamaV2Tokenizer.TrieArrays.__new__(ExLlamaV2Tokenizer.TrieArrays)
+            arrays.child_offsets = child_offsets
+            arrays.edge_chars = edge_chars
+            arrays.leaf_offsets = leaf_offsets
+            arrays.leaf_ids = leaf_ids
+            return arrays
+
+        def num_nodes(self):
+            return len(self.edge_chars)
+
+        def nbytes(self):
+            return sum(a.itemsize * len(a) for a in (self.child_offsets, self.edge_chars, self.leaf_offsets, self.leaf_ids))
+
+
+    # Children of a trie node, with the read-only interface of a dict mapping characters to nodes
+
+    class TrieChildren:
+
+        __slots__ = ("arrays", "lo", "hi")
+
+        def __init__(self, arrays, lo, hi):
+            self.arrays = arrays
+            self.lo = lo
+            self.hi = hi
+
+        def _find(self, c):
+            if not isinstance(c, str) or len(c) != 1: return -1
+            o = ord(c)
+            i = bisect_left(self.arrays.edge_chars, o, self.lo, self.hi)
+            return i if i < self.hi and self.arrays.edge_chars[i] == o else -1
+
+        def __len__(self):
+            return self.hi - self.lo
+
+        def __contains__(self, c):
+            return self._find(c) != -1
+
+        def __getitem__(self, c):
+            i = self._find(c)
+            if i == -1: raise KeyError(c)
+            return ExLlamaV2Tokenizer.Trie(self.arrays, i)
+
+        def get(self, c, default = None):
+            i = self._find(c)
+            return ExLlamaV2Tokenizer.Trie(self.arrays, i) if i != -1 else default
+
+        def keys(self):
+            return [chr(o) for o in self.arrays.edge_chars[self.lo : self.hi]]
+
+        def __iter__(self):
+            return iter(self.keys())
+
+        def values(self):
+            return [ExLlamaV2Tokenizer.Trie(self.arrays, i) for i in range(self.lo, self.hi)]
+
+        def items(self):
+            edge_chars = self.arrays.edge_chars
+            return [(chr(edge_chars[i]), ExLlamaV2Tokenizer.Trie(self.arrays, i)) for i in range(self.lo, self.hi)]
+
+
+    # Trie node. children maps characters to child nodes, leaf lists the IDs of tokens whose piece ends here
+
     class Trie:
 
-        children: dict = {}
-        leaf: list = []
+        __slots__ = ("arrays", "idx")
+
+        def __init__(self, arrays, idx = 0):
+            self.arrays = arrays
+            self.idx = idx
+
+        @property
+        def children(self):
+            a = self.arrays.child_offsets
+            return ExLlamaV2Tokenizer.TrieChildren(self.arrays, a[self.idx], a[self.idx + 1])
+
+        @property
+        def leaf(self):
+            a = self.arrays.leaf_offsets
+            return self.arrays.leaf_ids[a[self.idx] : a[self.idx + 1]]
+
+
+    # Rows of token IDs packed as CSR arrays: row r holds ids[offsets[r]:offsets[r + 1]], sorted. Rows are indexed
+    # by integer, or by string if the table has keys
 
-        def __init__(self, children = None, leaf = None):
-            self.children = children if children is not None else {}
-            self.leaf = leaf if leaf is not None else []
+    class PrefixTable:
+
+        keys: dict or None
+        offsets: torch.Tensor
+        ids: torch.Tensor
+
+        def __init__(self, offsets, ids, keys = None):
+            self.offsets = offsets
+            self.ids = ids
+            self.keys = keys
+
+        def row(self, key):
+            return self.keys[key] if self.keys is not None else key
+
+        def __getitem__(self, key):
+            r = self.row(key)
+            if r < 0 or r >= len(self): raise KeyError(key)
+            a, b = self.offsets[r : r + 2].tolist()
+            return self.ids[a : b]
+
+        def __contains__(self, key):
+            if self.keys is not None: return key in self.keys
+            return 0 <= key < len(self)
+
+        def __len__(self):
+            return self.offsets.shape[0] - 1
+
+        def get(self, key, default = None):
+            return self[key] if key in self else default
 
 
     config: ExLlamaV2Config
@@ -38,10 +199,13 @@ class ExLlamaV2Tokenizer:
     id_to_ord: list = None
     id_to_piece: list = None
     piece_to_id: dict = None
-    prefix_to_ids: dict = None
-    prefix_id_to_ids: dict = None
+    prefix_to_ids: PrefixTable = None
+    prefix_id_to_ids: PrefixTable = None
     char_trie: Trie = None
     char_trie_ci: Trie = None
+    id_to_bytes: list or bool = None
+    id_to_bytes_len: torch.Tensor = None
+    id_to_bytes_strip: bool = False
 
     unspecial_piece_to_id = {}
     unspecial_id_to_piece = {}
@@ -50,12 +214,25 @@ class ExLlamaV2Tokenizer:
     special_delimiters = None
     unspecial_delimiters = None
 
-    tokenized_str_cache = {}
-    max_cached_strings = 100
+    tokenized_str_cache: OrderedDict
+    max_cached_strings = 1024
+    max_cached_tokens = 1 << 20
+    cached_tokens: int
+    cache_hits: int
+    cache_misses: int
+    cache_evictions: int
+
+    table_cache_key: str = None
+    table_cache_tables: dict = None
+
+    incremental_states: list
+    max_incremental_states = 4
 
-    def __init__(self, config, lazy_init = False, force_json = False):
+    def __init__(self, config, lazy_init = False, force_json = False, table_cache = False):
 
         self.config = config
+        self.incremental_states = []
+        self.clear_cache()
 
         # Detect tokenizer type and initialize
 
@@ -151,6 +328,23 @@ class ExLlamaV2Tokenizer:
 
         if not lazy_init:
 
+            # With table_cache, derived tables are loaded from a cache file keyed by the tokenizer files, so they're only
+            # built once. The cache is best-effort: if the cache directory can't be read or written, tables are built as
+            # usual
+
+            if table_cache:
+                self.table_cache_key = tokenizer_cache.cache_key(
+                    [path_spm, path_hf, added_tokens_path,
+                     os.path.join(self.config.model_dir, "tokenizer_config.json"),
+                     os.path.join(self.config.model_dir, "special_tokens_map.json")],
+                    {
+                        "backend": type(self.tokenizer).__name__,
+                        "vocab_size": self.config.vocab_size,
+                        "special_ids": [self.unk_token_id, self.bos_token_id, self.eos_token_id, self.pad_token_id],
+                    }
+                )
+                if self._load_table_cache(): return
+
             self.get_id_to_ord_list()
             self.get_id_to_piece_list()
             self.get_piece_to_id_dict()
@@ -159,6 +353,8 @@ class ExLlamaV2Tokenizer:
             self.get_char_trie()
             self.get_char_trie_ci()
 
+            if table_cache: self._save_table_cache()
+
 
     # Return size of valid vocabulary
 
@@ -216,6 +412,40 @@ class ExLlamaV2Tokenizer:
         return encoded
 
 
+    # Encode list of strings, encoding all plain text between added/special tokens in one batch
+
+    def encode_batch_(self, texts, encode_special_tokens):
+
+        if encode_special_tokens:
+            if self.special_delimiters is None:
+                self.special_delimiters = re.compile("(" + "|".join(map(re.escape, self.extended_piece_to_id.keys())) + ")")
+            delimiters = self.special_delimiters
+            piece_to_id = self.extended_piece_to_id
+
+        elif self.unspecial_piece_to_id:
+            if self.unspecial_delimiters is None:
+                self.unspecial_delimiters = re.compile("(" + "|".join(map(re.escape, self.unspecial_piece_to_id.keys())) + ")")
+            delimiters = self.unspecial_delimiters
+            piece_to_id = self.unspecial_piece_to_id
+
+        else:
+            return self.tokenizer.encode_batch(texts)
+
+        splits = [delimiters.split(t) for t in texts]
+        segments = [segment for split in splits for segment in split[0::2] if segment != ""]
+        encoded_segments = iter(self.tokenizer.encode_batch(segments))
+
+        list_ids = []
+        for split in splits:
+            ids = []
+            for i in range(0, len(split), 2):
+                if split[i] != "": ids += next(encoded_segments)
+                if i + 1 < len(split): ids.append(piece_to_id[split[i + 1]])
+            list_ids.append(ids)
+
+        return list_ids
+
+
     # Encode string
     # TODO: Deal with rstrip and lstrip for control tokens
 
@@ -225,27 +455,27 @@ class ExLlamaV2Tokenizer:
 
             # text is a list of strings
 
-            list_ids = [self.encode_special(t) for t in text] if encode_special_tokens else [self.encode_unspecial(t) for t in text]
+            list_ids = self.encode_batch_(text, encode_special_tokens)
 
             if add_bos:
                 for ids in list_ids: ids.insert(0, self.bos_token_id)
             if add_eos:
                 for ids in list_ids: ids.append(self.eos_token_id)
 
-            max_length = max([len(ids) for ids in list_ids])
+            # Left-pad into one preallocated tensor. Element k of the concatenated sequences, belonging to row r,
+            # lands in column k + max_length - (end of row r in the concatenation)
 
-            padded_ids = []
-            offsets = []
-            for ids in list_ids:
-                padding_length = max_length - len(ids)
-                padding = torch.full((padding_length,), self.pad_token_id)
-                padded_ids.append(torch.cat((padding, torch.tensor(ids)), dim = 0))
-                offsets.append(-padding_length)
+            lengths = torch.tensor([len(ids) for ids in list_ids], dtype = torch.long)
+            max_length = lengths.max().item()
 
-            stacked_ids = torch.stack(padded_ids, dim=0)
+            stacked_ids = torch.full((len(list_ids), max_length), self.pad_token_id, dtype = torch.long)
+            flat_ids = torch.tensor([t for ids in list_ids for t in ids], dtype = torch.long)
+            rows = torch.repeat_interleave(torch.arange(len(list_ids)), lengths)
+            cols = torch.arange(flat_ids.shape[0]) + (max_length - torch.cumsum(lengths, 0))[rows]
+            stacked_ids[rows, cols] = flat_ids
 
             if return_offsets:
-                return stacked_ids, torch.tensor(offsets, dtype = torch.int)
+                return stacked_ids, (lengths - max_length).to(torch.int)
             else:
                 return stacked_ids
 
@@ -320,13 +550,22 @@ class ExLlamaV2Tokenizer:
 
     def decode(self, ids, decode_special_tokens = False):
 
+        if not decode_special_tokens and self.get_id_to_bytes_table() is not None and \
+                (ids.numel() == 0 or (ids.min().item() >= 0 and ids.max().item() < len(self.id_to_bytes))):
+            return self.decode_bytes_(ids)
+
         if ids.dim() > 1:
 
-            texts = []
-            for i in range(ids.shape[0]):
-                seq = ids[i].tolist()
-                texts.append(self.decode_(seq, decode_special_tokens))
-            return texts
+            seqs = ids.tolist()
+
+            # Without added or special tokens to splice in, all rows can be decoded in one batch
+
+            if not decode_special_tokens and not self.unspecial_id_to_piece:
+                max_token = self.tokenizer.vocab_size()
+                seqs = [[t for t in seq if (t != self.pad_token_id and t < max_token and t != self.eos_token_id)] for seq in seqs]
+                return self.tokenizer.decode_batch(seqs)
+
+            return [self.decode_(seq, decode_special_tokens) for seq in seqs]
 
         else:
 
@@ -335,6 +574,27 @@ class ExLlamaV2Tokenizer:
             return text
 
 
+    # Decode with the token-to-bytes table. All rows are concatenated in a single join and split by their byte
+    # lengths, gathered from the table with one tensor op
+
+    def decode_bytes_(self, ids):
+
+        table = self.id_to_bytes
+        if ids.dim() == 1: return self.decode_bytes_(ids.unsqueeze(0))[0]
+
+        row_ends = torch.cumsum(self.id_to_bytes_len[ids.long()].sum(dim = -1), dim = 0).tolist()
+        data = b"".join(map(table.__getitem__, ids.flatten().tolist()))
+
+        texts = []
+        start = 0
+        for end in row_ends:
+            row = data[start : end]
+            if self.id_to_bytes_strip and row[:1] == b" ": row = row[1:]
+            texts.append(row.decode("utf-8", errors = "replace"))
+            start = end
+        return texts
+
+
     # Create padding mask
 
     def padding_mask(self, ids):
@@ -411,74 +671,146 @@ class ExLlamaV2Tokenizer:
         return self.piece_to_id
 
 
-    # Create dictionary mapping prefixes to token IDs
+    # Build tables mapping each piece, and each token ID, to the IDs of all tokens it prefixes (including itself)
 
-    def get_prefix_to_ids_dict(self):
-
-        if self.prefix_to_ids is not None: return self.prefix_to_ids
+    def _make_prefix_tables(self):
 
         piece_to_id = self.get_piece_to_id_dict()
-        pieces = sorted(list(piece_to_id.keys()))
-        pieces = [p for p in pieces if len(p) > 0]
-        self.prefix_to_ids = {}
+        pieces = sorted(p for p in piece_to_id.keys() if len(p) > 0)
+        num_pieces = len(pieces)
+        piece_ids = torch.tensor([piece_to_id[p] for p in pieces], dtype = torch.long)
+
+        # In sorted order, all pieces starting with a given piece form a contiguous range beginning at that piece.
+        # Find the end of each range with a single pass, keeping a stack of the pieces that prefix the current one
+
+        ends = [num_pieces] * num_pieces
+        stack = []
+        for j, piece in enumerate(pieces):
+            while stack and not piece.startswith(pieces[stack[-1]]): ends[stack.pop()] = j
+            stack.append(j)
 
-        for i in range(len(pieces)):
-            piece = pieces[i]
-            if len(piece) == 0: continue
-            piece_id = piece_to_id[pieces[i]]
-            self.prefix_to_ids[piece] = [piece_id]
+        # Expand ranges into one flat list of IDs and sort each row by ID
 
-            for j in range(1, len(piece)):
-                fpiece = piece[:-j]
-                if fpiece in self.prefix_to_ids:
-                    self.prefix_to_ids[fpiece].append(piece_id)
+        starts = torch.arange(num_pieces, dtype = torch.long)
+        lengths = torch.tensor(ends, dtype = torch.long) - starts
+        offsets = torch.zeros((num_pieces + 1,), dtype = torch.long)
+        offsets[1:] = torch.cumsum(lengths, 0)
 
-        self.prefix_to_ids = { prefix: sorted(ids) for prefix, ids in self.prefix_to_ids.items() }
+        num_ids = max(self.config.vocab_size, piece_ids.max().item() + 1 if num_pieces else 0)
+        row_of = torch.repeat_interleave(starts, lengths)
+        pos = torch.arange(row_of.shape[0], dtype = torch.long) - offsets[row_of]
+        flat_ids = piece_ids[row_of + pos]
+        flat_ids = flat_ids[torch.argsort(row_of * num_ids + flat_ids)]
 
+        self.prefix_to_ids = ExLlamaV2Tokenizer.PrefixTable(offsets, flat_ids.to(torch.int), { p: j for j, p in enumerate(pieces) })
+
+        # Same rows keyed by token ID. IDs without a (unique, non-empty) piece only prefix themselves
+
+        id_lengths = torch.ones((num_ids,), dtype = torch.long)
+        id_lengths[piece_ids] = lengths
+        id_offsets = torch.zeros((num_ids + 1,), dtype = torch.long)
+        id_offsets[1:] = torch.cumsum(id_lengths, 0)
+
+        id_flat_ids = torch.empty((id_offsets[-1].item(),), dtype = torch.int)
+        id_flat_ids[id_offsets[:-1]] = torch.arange(num_ids, dtype = torch.int)
+        id_flat_ids[id_offsets[piece_ids][row_of] + pos] = flat_ids.to(torch.int)
+
+        self.prefix_id_to_ids = ExLlamaV2Tokenizer.PrefixTable(id_offsets, id_flat_ids)
+
+
+    # Table mapping prefixes to token IDs
+
+    def get_prefix_to_ids_dict(self):
+
+        if self.prefix_to_ids is None: self._make_prefix_tables()
         return self.prefix_to_ids
 
 
-    # Create dictionary mapping each ID to any IDs that it prefixes
+    # Table mapping each ID to any IDs that it prefixes
 
     def get_prefix_id_to_ids_dict(self):
 
-        if self.prefix_id_to_ids is not None: return self.prefix_id_to_ids
+        if self.prefix_id_to_ids is None: self._make_prefix_tables()
+        return self.prefix_id_to_ids
 
-        piece_to_id = self.get_piece_to_id_dict()
-        prefix_to_ids = self.get_prefix_to_ids_dict()
 
-        self.prefix_id_to_ids = { piece_to_id[piece]: ids for piece, ids in prefix_to_ids.items() }
+    # Table of the UTF-8 bytes each token decodes to (when not decoding special tokens), or None if the backend's
+    # decoding can't be reproduced that way. The table is checked against the backend decoder before use
 
-        for i in range(self.config.vocab_size):
-            if i not in self.prefix_id_to_ids:
-                self.prefix_id_to_ids[i] = [i]
+    def get_id_to_bytes_table(self):
 
-        return self.prefix_id_to_ids
+        if self.id_to_bytes is not None: return self.id_to_bytes or None
+        self.id_to_bytes = False
 
+        table = self.tokenizer.token_bytes_table()
+        if table is None: return None
 
-    # Create trie mapping chars to token IDs
+        max_token = self.tokenizer.vocab_size()
+        table = table[:max_token] + [b""] * max(len(self.get_id_to_piece_list()) - max_token, 0)
+        for idx in (self.pad_token_id, self.eos_token_id):
+            if idx is not None and 0 <= idx < len(table): table[idx] = b""
 
-    def _make_trie(self, ci):
+        # Backend decoders may strip a leading space from the output. Added tokens are decoded separately from the
+        # surrounding text, so that would apply after each of them as well. Use the fallback in that case
 
-        id_to_piece = self.get_id_to_piece_list()
-        trie = ExLlamaV2Tokenizer.Trie()
+        probe = next((idx for idx, b in enumerate(table) if len(b) > 1 and b[:1] == b" " and b[1:2] != b" " and
+                      idx not in self.unspecial_id_to_piece and idx not in self.extended_id_to_piece), None)
+        if probe is None: return None
+        probe_text = self.tokenizer.decode([probe])
+        if probe_text == table[probe].decode("utf-8", errors = "replace"): strip = False
+        elif probe_text == table[probe][1:].decode("utf-8", errors = "replace"): strip = True
+        else: return None
+
+        for idx, piece in self.unspecial_id_to_piece.items():
+            if idx < max_token:
+                if strip: return None
+                table[idx] = piece.encode("utf-8")
+
+        self.id_to_bytes_strip = strip
+
+        # Verify against the backend on some text and a sample of single tokens
 
-        for idx, piece in enumerate(id_to_piece):
+        def fast_decode(seq):
+            data = b"".join(table[t] for t in seq)
+            if strip and data[:1] == b" ": data = data[1:]
+            return data.decode("utf-8", errors = "replace")
 
-            if ci: piece = piece.lower()
+        test_texts = \
+        [
+            "Hello, world!\n  The quick brown fox jumps over the lazy dog.\n\n\tIndented line",
+            " leading space, trailing space ",
+            "naïve café, Ærøskøbing, 日本語のテキスト, 🦙 emoji, ∑ math, \"quotes\" and 'apostrophes'",
+            "def f(x):\n    return x * 2  # comment\r\n",
+        ]
 
-            w = trie
-            while piece != "":
+        def is_text(b):
+            try: b.decode("utf-8")
+            except UnicodeDecodeError: return False
+            return b != b""
 
-                p = piece[0]
-                piece = piece[1:]
+        test_seqs = [self.encode_unspecial(t) for t in test_texts]
+        test_seqs += [[idx] for idx in range(0, len(table), 97) if is_text(table[idx]) and idx not in self.unspecial_id_to_piece]
 
-                if p not in w.children: w.children[p] = ExLlamaV2Tokenizer.Trie()
-                w = w.children[p]
+        for seq in test_seqs:
+            if fast_decode(seq) != self.decode_(seq, False): return None
 
-                if piece == "": w.leaf.append(idx)
+        self.id_to_bytes = table
+        self.id_to_bytes_len = torch.tensor([len(b) for b in table], dtype = torch.long)
+        return self.id_to_bytes
 
-        return trie
+
+    # Create trie mapping chars to token IDs
+
+    def _make_trie(self, ci):
+
+        id_to_piece = self.get_id_to_piece_list()
+        if ci: id_to_piece = [piece.lower() for piece in id_to_piece]
+
+        entries = sorted((piece, idx) for idx, piece in enumerate(id_to_piece) if piece != "")
+        pieces = [e[0] for e in entries]
+        ids = [e[1] for e in entries]
+
+        return ExLlamaV2Tokenizer.Trie(ExLlamaV2Tokenizer.TrieArrays(pieces, ids))
 
 
     def get_char_trie(self):
@@ -497,16 +829,217 @@ class ExLlamaV2Tokenizer:
         return self.char_trie_ci
 
 
-    # Cached tokenization
+    # Save and load derived tables
+
+    def _table_cache_filename(self):
+
+        return os.path.join(tokenizer_cache.default_cache_dir(), self.table_cache_key + ".tables")
+
+
+    def _save_table_cache(self):
+
+        def i32(t): return array("i", t.tolist())
+        def i64(t): return array("q", t.tolist())
+
+        pieces = [p.encode("utf-8", "surrogatepass") for p in self.id_to_piece]
+        piece_offsets = array("q", [0])
+        for p in pieces: piece_offsets.append(piece_offsets[-1] + len(p))
+
+        tables = \
+        {
+            "id_to_ord": array("i", self.id_to_ord),
+            "piece_data": array("B", b"".join(pieces)),
+            "piece_offsets": piece_offsets,
+            "prefix_keys": array("i", [self.piece_to_id[p] for p in self.prefix_to_ids.keys]),
+            "prefix_offsets": i64(self.prefix_to_ids.offsets),
+            "prefix_ids": i32(self.prefix_to_ids.ids),
+            "prefix_id_offsets": i64(self.prefix_id_to_ids.offsets),
+            "prefix_id_ids": i32(self.prefix_id_to_ids.ids),
+        }
+        for name, trie in (("trie", self.char_trie), ("trie_ci", self.char_trie_ci)):
+            tables[name + ".child_offsets"] = trie.arrays.child_offsets
+            tables[name + ".edge_chars"] = trie.arrays.edge_chars
+            tables[name + ".leaf_offsets"] = trie.arrays.leaf_offsets
+            tables[name + ".leaf_ids"] = trie.arrays.leaf_ids
+
+        try:
+            tokenizer_cache.write_tables(self._table_cache_filename(), tables, { "key": self.table_cache_key })
+        except OSError:
+            pass
+
+
+    def _load_table_cache(self):
+
+        try:
+            filename = self._table_cache_filename()
+            if not os.path.exists(filename): return False
+            metadata, tables = tokenizer_cache.read_tables(filename)
+            if metadata.get("key") != self.table_cache_key: return False
+        except Exception:
+            return False
+
+        def tensor(view, dtype):
+            if len(view) == 0: return torch.empty((0,), dtype = dtype)
+            return torch.frombuffer(view, dtype = dtype)
+
+        # Python lists and dicts are rebuilt from the flat arrays. Prefix tables and tries reference the mapped file
+
+        self.id_to_ord = tables["id_to_ord"].tolist()
+        piece_data = tables["piece_data"].tobytes()
+        piece_offsets = tables["piece_offsets"].tolist()
+        self.id_to_piece = [piece_data[a : b].decode("utf-8", "surrogatepass") for a, b in zip(piece_offsets[:-1], piece_offsets[1:])]
+        self.get_piece_to_id_dict()
+
+        id_to_piece = self.id_to_piece
+        self.prefix_to_ids = ExLlamaV2Tokenizer.PrefixTable(
+            tensor(tables["prefix_offsets"], torch.long),
+            tensor(tables["prefix_ids"], torch.int),
+            { id_to_piece[t]: j for j, t in enumerate(tables["prefix_keys"]) }
+        )
+        self.prefix_id_to_ids = ExLlamaV2Tokenizer.PrefixTable(
+            tensor(tables["prefix_id_offsets"], torch.long),
+            tensor(tables["prefix_id_ids"], torch.int)
+        )
+
+        def trie(name):
+            return ExLlamaV2Tokenizer.Trie(ExLlamaV2Tokenizer.TrieArrays.from_arrays(
+                tables[name + ".child_offsets"],
+                tables[name + ".edge_chars"],
+                tables[name + ".leaf_offsets"],
+                tables[name + ".leaf_ids"]
+            ))
+
+        self.char_trie = trie("trie")
+        self.char_trie_ci = trie("trie_ci")
+        self.table_cache_tables = tables
+        return True
+
+
+    # Incremental tokenization for append-only text, e.g. a growing chat transcript. The last few encoded strings
+    # are remembered along with a split point: a line start in the text where encoding the remainder (following the
+    # preceding newline, whose tokens are dropped) reproduces the tail of the full encoding. When a new string extends
+    # a remembered one, only the text from that split point onwards is encoded again. This gives the same IDs as a
+    # full encode for tokenizers whose merges don't span line breaks, and split points are checked against the
+    # full encoding before they're used
+
+    class IncrementalState:
+
+        text: str
+        ids: list
+        encode_special_tokens: bool
+        split_char: int
+        split_token: int
+
+        def __init__(self, text, ids, encode_special_tokens, split_char, split_token):
+            self.text = text
+            self.ids = ids
+            self.encode_special_tokens = encode_special_tokens
+            self.split_char = split_char
+            self.split_token = split_token
+
+
+    def _encode_list(self, text, encode_special_tokens):
+
+        return self.encode_special(text) if encode_special_tokens else self.encode_unspecial(text)
+
+
+    def _encode_from(self, text, split_char, encode_special_tokens):
+
+        if split_char == 0: return self._encode_list(text, encode_special_tokens)
+
+        newline_ids = self._encode_list("\n", encode_special_tokens)
+        ids = self._encode_list(text[split_char - 1:], encode_special_tokens)
+        if ids[:len(newline_ids)] != newline_ids: return None
+        return ids[len(newline_ids):]
+
+
+    def _find_split(self, text, ids, encode_special_tokens, max_tries = 4):
+
+        pos = len(text)
+        for _ in range(max_tries):
+
+            pos = text.rfind("\n", 0, pos - 1)
+            if pos == -1: break
+            split_char = pos + 1
+            if split_char >= len(text) or text[split_char].isspace(): continue
+
+            tail_ids = self._encode_from(text, split_char, encode_special_tokens)
+            if tail_ids is not None and len(tail_ids) <= len(ids) and ids[len(ids) - len(tail_ids):] == tail_ids:
+                return split_char, len(ids) - len(tail_ids)
+
+        return 0, 0
+
+
+    def encode_incremental(self, text: str, add_bos = False, encode_special_tokens = False):
+
+        base = None
+        for state in self.incremental_states:
+            if state.encode_special_tokens == encode_special_tokens and text.startswith(state.text):
+                if base is None or len(state.text) > len(base.text): base = state
+
+        ids = None
+        if base is not None:
+            tail_ids = self._encode_from(text, base.split_char, encode_special_tokens)
+            if tail_ids is not None: ids = base.ids[:base.split_token] + tail_ids
+        if ids is None:
+            ids = self._encode_list(text, encode_special_tokens)
+
+        split_char, split_token = self._find_split(text, ids, encode_special_tokens)
+        if base is not None: self.incremental_states.remove(base)
+        self.incremental_states.append(ExLlamaV2Tokenizer.IncrementalState(text, ids, encode_special_tokens, split_char, split_token))
+        while len(self.incremental_states) > self.max_incremental_states: self.incremental_states.pop(0)
+
+        if add_bos: ids = [self.bos_token_id] + ids
+        return torch.tensor(ids, dtype = torch.long).unsqueeze(0)
+
+
+    # Cached tokenization. LRU cache bounded by both number of strings and total number of cached tokens, keyed by a
+    # hash of the text and the encoding options. Returned tensors are shared and must not be modified in place
+
+    def cached_encode_str(self, text: str, add_bos = False, add_eos = False, encode_special_tokens = False):
+
+        digest = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size = 16).digest()
+        key = (digest, add_bos, add_eos, encode_special_tokens)
+
+        ids = self.tokenized_str_cache.get(key)
+        if ids is not None:
+            self.tokenized_str_cache.move_to_end(key)
+            self.cache_hits += 1
+            return ids
+
+        self.cache_misses += 1
+        ids = self.encode(text, add_bos = add_bos, add_eos = add_eos, encode_special_tokens = encode_special_tokens)
+
+        num_tokens = ids.shape[-1]
+        if num_tokens > self.max_cached_tokens: return ids
+
+        while len(self.tokenized_str_cache) >= self.max_cached_strings or \
+                self.cached_tokens + num_tokens > self.max_cached_tokens:
+            _, evicted = self.tokenized_str_cache.popitem(last = False)
+            self.cached_tokens -= evicted.shape[-1]
+            self.cache_evictions += 1
+
+        self.tokenized_str_cache[key] = ids
+        self.cached_tokens += num_tokens
+        return ids
+
+
+    def clear_cache(self):
 
-    def cached_encode_str(self, text: str):
+        self.tokenized_str_cache = OrderedDict()
+        self.cached_tokens = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
 
-        if text in self.tokenized_str_cache:
-            return self.tokenized_str_cache[text]
 
-        while len(self.tokenized_str_cache) >= self.max_cached_strings:
-            del self.tokenized_str_cache[next(iter(self.tokenized_str_cache))]  # Always removes oldest entry as of Python 3.7
+    def get_cache_stats(self):
 
-        new_enc = self.encode(text)
-        self.tokenized_str_cache[text] = new_enc
-        return new_enc
+        return \
+        {
+            "strings": len(self.tokenized_str_cache),
+            "tokens": self.cached_tokens,
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "evictions": self.cache_evictions,
+        }
@@ -0,0 +1,96 @@
+import os, json, struct, hashlib, mmap, tempfile
+from array import array
+
+# Derived tokenizer tables are stored in a safetensors-style container: little-endian int64 header size, JSON header
+# describing each array, then the raw data. Arrays are aligned to 8 bytes so they can be viewed in place from a
+# memory-mapped file
+
+cache_format_version = 1
+
+_typecodes = \
+{
+    "U8": "B",
+    "I32": "i",
+    "U32": "I",
+    "I64": "q",
+}
+
+_dtypes = { v: k for k, v in _typecodes.items() }
+
+
+# Default location for cached tables, overridable with EXLLAMA_TOKENIZER_CACHE
+
+def default_cache_dir():
+
+    d = os.environ.get("EXLLAMA_TOKENIZER_CACHE", None)
+    if d is not None: return d
+    return os.path.join(os.path.expanduser("~"), ".cache", "exllamav2", "tokenizer")
+
+
+# Hash the files the tables are derived from, plus any other inputs that affect them
+
+def cache_key(files, extra):
+
+    h = hashlib.sha256()
+    h.update(f"v{cache_format_version}".encode("utf-8"))
+    for filename in files:
+        h.update(b"\x00" + os.path.basename(filename).encode("utf-8") + b"\x00")
+        if not os.path.exists(filename): continue
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""): h.update(chunk)
+    h.update(json.dumps(extra, sort_keys = True).encode("utf-8"))
+    return h.hexdigest()
+
+
+# Write dict of name: array.array (or anything exposing typecode and tobytes()) atomically to filename
+
+def write_tables(filename, tables, metadata = None):
+
+    header = {}
+    if metadata is not None: header["__metadata__"] = metadata
+
+    offset = 0
+    for name, a in tables.items():
+        length = a.itemsize * len(a)
+        header[name] = { "dtype": _dtypes[a.typecode], "shape": [len(a)], "data_offsets": [offset, offset + length] }
+        offset += (length + 7) // 8 * 8
+
+    header_json = json.dumps(header).encode("utf-8")
+    header_json += b" " * (-(len(header_json) + 8) % 8)
+
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok = True)
+    fd, temp_filename = tempfile.mkstemp(dir = directory, suffix = ".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(struct.pack("<q", len(header_json)))
+            f.write(header_json)
+            for a in tables.values():
+                data = a.tobytes()
+                f.write(data)
+                f.write(b"\x00" * (-len(data) % 8))
+        os.replace(temp_filename, filename)
+    except:
+        if os.path.exists(temp_filename): os.remove(temp_filename)
+        raise
+
+
+# Map filename and return (metadata, dict of name: memoryview). Views reference the mapping, which is copy-on-write so
+# the arrays can also be wrapped by torch.frombuffer without copying
+
+def read_tables(filename):
+
+    with open(filename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY)
+
+    header_size = struct.unpack_from("<q", mm, 0)[0]
+    header = json.loads(mm[8 : 8 + header_size].decode("utf-8"))
+    metadata = header.pop("__metadata__", None)
+    data = memoryview(mm)[8 + header_size:]
+
+    tables = {}
+    for name, v in header.items():
+        a, b = v["data_offsets"]
+        tables[name] = data[a : b].cast(_typecodes[v["dtype"]])
+
+    return metadata, tables
@@ -28,6 +28,20 @@ class ExLlamaV2TokenizerBase:
     def decode(self, ids: list) -> str: raise NotImplementedError()
     def encode(self, text: list or str) -> list: raise NotImplementedError()
 
+    # Batch versions, returning one result per input. Backends override these with native batch paths
+
+    def encode_batch(self, texts: List[str]) -> List[list]:
+        return [self.encode(t) for t in texts]
+
+    def decode_batch(self, seqs: List[List[int]]) -> List[str]:
+        return [self.decode(s) for s in seqs]
+
+    # UTF-8 bytes each token ID contributes to decoded text, or None if the backend can't describe its decoding
+    # that way. Tokens that don't decode to text (control tokens etc.) map to b""
+
+    def token_bytes_table(self) -> List[bytes] or None:
+        return None
+
     def clean_special_chars(self, p):
         p = p.replace(self.space_char(), " ")
         p = p.replace(self.newline_char(), "\n")
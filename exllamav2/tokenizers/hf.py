@@ -1,5 +1,6 @@
 from typing import List, Union
 from exllamav2.tokenizers.base import ExLlamaV2TokenizerBase
+import json
 
 has_tokenizers_library = False
 try:
@@ -9,6 +10,20 @@ try:
 except ModuleNotFoundError:
     pass
 
+# Inverse of the byte-to-unicode mapping used by byte-level BPE pre-tokenizers
+
+def _byte_level_decoder():
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return { chr(c): b for b, c in zip(bs, cs) }
+
+
 class ExLlamaV2TokenizerHF(ExLlamaV2TokenizerBase):
 
     space_char_: str = " "
@@ -64,3 +79,44 @@ class ExLlamaV2TokenizerHF(ExLlamaV2TokenizerBase):
     def encode(self, text: list or str) -> list:
         encoding = self.hf_tokenizer.encode(text, add_special_tokens = False)
         return encoding.ids
+
+    def token_bytes_table(self) -> List[bytes] or None:
+
+        tokenizer_json = json.loads(self.hf_tokenizer.to_str())
+
+        decoder_types = set()
+        decoders = [tokenizer_json.get("decoder", None)]
+        while decoders:
+            d = decoders.pop()
+            if d is None: continue
+            decoder_types.add(d["type"])
+            if d["type"] == "Replace" and d.get("pattern", {}).get("String") == "▁": decoder_types.add("Metaspace")
+            decoders += d.get("decoders", [])
+
+        byte_level = "ByteLevel" in decoder_types
+        byte_fallback = "ByteFallback" in decoder_types
+        if not byte_level and "Metaspace" not in decoder_types: return None
+
+        added_tokens = { t["id"]: t for t in tokenizer_json.get("added_tokens", []) }
+        byte_decoder = _byte_level_decoder()
+
+        table = [b""] * self.vocab_size()
+        for p, idx in self.hf_tokenizer.get_vocab().items():
+            if idx >= len(table): continue
+            if idx in added_tokens:
+                if not added_tokens[idx]["special"]: table[idx] = p.encode("utf-8")
+            elif byte_fallback and self.ord_exp.match(p):
+                table[idx] = bytes([self.piece_to_ord(p)])
+            elif byte_level:
+                try: table[idx] = bytes(byte_decoder[c] for c in p)
+                except KeyError: table[idx] = p.encode("utf-8")
+            else:
+                table[idx] = p.replace("▁", " ").encode("utf-8")
+        return table
+
+    def encode_batch(self, texts: List[str]) -> List[list]:
+        encodings = self.hf_tokenizer.encode_batch(texts, add_special_tokens = False)
+        return [e.ids for e in encodings]
+
+    def decode_batch(self, seqs: List[List[int]]) -> List[str]:
+        return self.hf_tokenizer.decode_batch(seqs)
@@ -1,6 +1,26 @@
 from typing import List, Union
 from sentencepiece import SentencePieceProcessor
 from exllamav2.tokenizers.base import ExLlamaV2TokenizerBase
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+# Shared pool for batch encoding/decoding. SentencePiece releases the GIL in its batch calls, so chunks of a large
+# batch can run concurrently
+
+batch_pool: ThreadPoolExecutor or None = None
+batch_min_chunk = 32
+
+def _map_chunks(fn, items):
+    global batch_pool
+
+    if len(items) == 0: return []
+    num_workers = os.cpu_count() or 1
+    if num_workers == 1 or len(items) < batch_min_chunk * 2: return fn(items)
+
+    if batch_pool is None: batch_pool = ThreadPoolExecutor(max_workers = num_workers)
+    chunk_size = max(batch_min_chunk, (len(items) + num_workers - 1) // num_workers)
+    chunks = [items[i : i + chunk_size] for i in range(0, len(items), chunk_size)]
+    return [r for chunk_result in batch_pool.map(fn, chunks) for r in chunk_result]
 
 class ExLlamaV2TokenizerSPM(ExLlamaV2TokenizerBase):
 
@@ -40,3 +60,18 @@ class ExLlamaV2TokenizerSPM(ExLlamaV2TokenizerBase):
     def encode(self, text: list or str) -> list:
         encoding = self.spm.EncodeAsIds(text)
         return encoding
+
+    def token_bytes_table(self) -> List[bytes] or None:
+        table = []
+        for idx, p in self.enumerate_tokens():
+            if self.spm.IsControl(idx): table.append(b"")
+            elif self.spm.IsUnknown(idx): table.append(self.spm.decode([idx]).encode("utf-8"))
+            elif self.spm.IsByte(idx): table.append(bytes([self.piece_to_ord(p)]))
+            else: table.append(p.replace(self.space_char(), " ").encode("utf-8"))
+        return table
+
+    def encode_batch(self, texts: List[str]) -> List[list]:
+        return _map_chunks(self.spm.EncodeAsIds, list(texts))
+
+    def decode_batch(self, seqs: List[List[int]]) -> List[str]:
+        return _map_chunks(self.spm.decode, list(seqs))
@@ -0,0 +1,158 @@
+import math
+from exllamav2.planner import plan_autosplit, cache_layer_bytes
+
+# Memory budget autotuner. Searches max_batch_size, max_input_len and max_attention_size for the combination with the
+# highest predicted throughput on a workload that fits in the given device memory, with the cache sized for the
+# workload, using the split planner's memory accounting.
+#
+# The workload is a list of prompt lengths (a sample of the expected distribution), the number of tokens generated
+# per prompt and the number of concurrent sequences. Prompts are served in batches of up to max_batch_size in the
+# order given, each batch prefilled together (padded to its longest prompt) in chunks as ExLlamaV2.forward splits
+# them, then decoded together. The cache holds the longest prompt plus the completion for every sequence in a batch.
+#
+# Time per forward pass is modelled as a fixed launch overhead, plus reading the weights and the K/V cache once at
+# memory bandwidth, plus matmul and attention FLOPs at the given throughput. Absolute numbers are only as good as
+# the bandwidth/flops figures, but the ranking of configurations mostly depends on the number and size of passes.
+
+
+class ExLlamaV2TuneResult:
+
+    max_batch_size: int
+    max_input_len: int
+    max_attention_size: int
+    cache_max_seq_len: int
+    cache_batch_size: int
+    tokens_per_second: float        # Predicted generated tokens per second
+    plan = None                     # ExLlamaV2SplitPlan with the predicted memory breakdown
+    candidates: int
+
+    def __init__(self, max_batch_size, max_input_len, max_attention_size, cache_max_seq_len, tokens_per_second, plan):
+
+        self.max_batch_size = max_batch_size
+        self.max_input_len = max_input_len
+        self.max_attention_size = max_attention_size
+        self.cache_max_seq_len = cache_max_seq_len
+        self.cache_batch_size = max_batch_size
+        self.tokens_per_second = tokens_per_second
+        self.plan = plan
+        self.candidates = 0
+
+
+    # Set the tuned options on config. The cache should be created with cache_batch_size and cache_max_seq_len
+
+    def apply(self, config):
+
+        config.max_batch_size = self.max_batch_size
+        config.max_input_len = self.max_input_len
+        config.max_attention_size = self.max_attention_size
+        config.max_seq_len = self.cache_max_seq_len
+
+
+    def report(self):
+
+        lines = [f" -- Tuned config ({self.candidates} candidates evaluated):",
+                 f"    max_batch_size: {self.max_batch_size}",
+                 f"    max_input_len: {self.max_input_len}",
+                 f"    max_attention_size: {self.max_attention_size}",
+                 f"    cache: {self.cache_batch_size} x {self.cache_max_seq_len} tokens",
+                 f"    predicted throughput: {self.tokens_per_second:.1f} tokens/s",
+                 self.plan.report()]
+        return "\n".join(lines)
+
+
+# Number of tokens processed in each forward pass when prefilling prompt_len tokens, following the chunking in
+# ExLlamaV2.forward
+
+def prefill_chunks(prompt_len, bsz, max_input_len, max_batch_size, max_attention_size):
+
+    effective_max_input_len = max_input_len * max_batch_size // bsz
+    chunks = []
+    past_len = 0
+    remaining = prompt_len
+    while remaining > 0:
+        chunk_size = min(remaining, effective_max_input_len)
+        if (past_len + remaining) * remaining > max_attention_size:
+            cs = (math.sqrt(past_len ** 2 + 4 * max_attention_size) - past_len) / 2
+            chunk_size = min(chunk_size, max(math.floor(cs), 1))
+        chunks.append((past_len, chunk_size))
+        past_len += chunk_size
+        remaining -= chunk_size
+    return chunks
+
+
+def autotune(model, device_memory, prompt_lengths, completion_length = 256, concurrency = 1, cache_8bit = False,
+             reserve = None, bandwidth = 900e9, flops = 80e12, launch_overhead = 2e-3, batch_sizes = None,
+             input_lens = None):
+
+    config = model.config
+    saved = (config.max_batch_size, config.max_input_len, config.max_attention_size, config.max_seq_len)
+
+    num_params = sum(module.numel() for module in model.modules[1:])
+    num_layers = config.num_hidden_layers
+    attn_dim = config.num_attention_heads * config.head_dim
+    kv_token_bytes = cache_layer_bytes(config, 1, 1, cache_8bit) * num_layers
+
+    if batch_sizes is None:
+        batch_sizes = sorted(set([2 ** i for i in range(int(math.log2(concurrency)) + 1)] + [concurrency]))
+    if input_lens is None:
+        input_lens = [128, 256, 512, 1024, 2048, 4096]
+
+    def pass_time(weight_bytes, bsz, past_len, q_len):
+        t = launch_overhead + weight_bytes / bandwidth
+        t += bsz * past_len * kv_token_bytes / bandwidth
+        t += 2 * num_params * bsz * q_len / flops
+        t += 4 * num_layers * attn_dim * bsz * q_len * (past_len + q_len) / flops
+        return t
+
+    cache_len = min((max(prompt_lengths) + completion_length + 255) // 256 * 256, saved[3])
+    best = None
+    candidates = 0
+
+    try:
+        for bsz in batch_sizes:
+
+            batches = [prompt_lengths[i : i + bsz] for i in range(0, len(prompt_lengths), bsz)]
+
+            for max_input_len in input_lens:
+                if max_input_len > cache_len and max_input_len != input_lens[0]: continue
+
+                for max_attention_size in sorted(set([max_input_len ** 2, max_input_len * cache_len])):
+
+                    config.max_batch_size = bsz
+                    config.max_input_len = max_input_len
+                    config.max_attention_size = max_attention_size
+                    config.max_seq_len = cache_len
+                    candidates += 1
+
+                    plan = plan_autosplit(model, device_memory, max_seq_len = cache_len, batch_size = bsz,
+                                          cache_8bit = cache_8bit, reserve = reserve)
+                    if not plan.fits: continue
+
+                    weight_bytes = sum(d["weights"] for d in plan.devices)
+                    total_time = 0
+                    total_tokens = 0
+                    for batch in batches:
+                        prompt_len = min(max(batch), cache_len - completion_length)
+                        for past_len, q_len in prefill_chunks(prompt_len, len(batch), max_input_len, bsz, max_attention_size):
+                            total_time += pass_time(weight_bytes, len(batch), past_len, q_len)
+
+                        # Decode pass time is linear in past_len
+
+                        t0 = pass_time(weight_bytes, len(batch), 0, 1)
+                        slope = pass_time(weight_bytes, len(batch), 1, 1) - t0
+                        past_sum = completion_length * prompt_len + completion_length * (completion_length - 1) // 2
+                        total_time += completion_length * t0 + past_sum * slope
+                        total_tokens += len(batch) * completion_length
+
+                    tps = total_tokens / total_time
+                    if best is None or tps > best.tokens_per_second:
+                        best = ExLlamaV2TuneResult(bsz, max_input_len, max_attention_size, cache_len, tps, plan)
+
+    finally:
+        config.max_batch_size, config.max_input_len, config.max_attention_size, config.max_seq_len = saved
+
+    if best is None:
+        raise ValueError("No configuration fits in the given device memory")
+
+    best.candidates = candidates
+    return best
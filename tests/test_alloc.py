@@ -13,6 +13,8 @@ from exllamav2.generator import (
     ExLlamaV2Sampler
 )
 
+from exllamav2.memory import format_memory_report
+
 import time
 import torch
 
@@ -156,6 +158,9 @@ print(f"Attention heads:      {config.num_attention_heads}")
 print(f"Key/value heads:      {config.num_key_value_heads}")
 print(f"Max attention size:   {math.sqrt(config.max_attention_size)} ** 2")
 print(f"Max input len:        {config.max_input_len}")
+print()
+
+print(format_memory_report(model.memory_report([cache])))
 # print(f"Correction amount:    {mem_total - mem_exp:,.2f} B")
 
 
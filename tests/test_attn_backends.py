@@ -0,0 +1,80 @@
+import sys, os, time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from exllamav2.attn_backend import attn_backends, get_attn_backend
+
+# Check every available attention backend against the matmul reference and time it, for decode and prefill shapes
+# with and without grouped K/V heads and padding masks. Runs on the GPU if available, otherwise on the CPU
+
+device = "cuda:0" if torch.cuda.is_available() else "cpu"
+dtype = torch.float16
+head_dim = 128
+iterations = 20
+
+# (batch_size, q_len, past_len, num_attention_heads, num_key_value_heads, masked)
+
+shapes = [(1, 1, 2047, 32, 32, False),
+          (1, 1, 2047, 32, 8, False),
+          (8, 1, 2047, 32, 8, False),
+          (8, 1, 2047, 32, 8, True),
+          (1, 512, 0, 32, 8, False),
+          (1, 512, 1536, 32, 8, False),
+          (4, 512, 0, 32, 8, True)]
+
+
+def make_mask(batch_size, q_len, past_len, masked):
+
+    kv_len = past_len + q_len
+    mask = torch.zeros((batch_size, 1, q_len, kv_len), dtype = dtype, device = device)
+    mask[:, :, :q_len - 1, past_len + 1:] = torch.triu(torch.full((q_len - 1, q_len - 1), float("-inf"), device = device))
+    if masked:
+        for i in range(batch_size): mask[i, :, :, : i * 17] = float("-inf")
+    if q_len == 1 and not masked: return None
+    return mask
+
+
+# Query rows that can see at least one key, as a (batch_size, q_len, 1, 1) mask. Rows that are padding themselves
+# attend to nothing and come out as NaN (or zero, depending on the backend), so they are left out of the comparison
+
+def visible_rows(mask, batch_size, q_len):
+
+    if mask is None: return torch.ones((batch_size, q_len, 1, 1), dtype = torch.bool, device = device)
+    visible = (mask != float("-inf")).any(dim = -1)
+    return visible.expand(batch_size, 1, q_len).transpose(1, 2).unsqueeze(-1)
+
+
+def timed(func):
+
+    func()
+    if device != "cpu": torch.cuda.synchronize()
+    time_begin = time.time()
+    for _ in range(iterations): func()
+    if device != "cpu": torch.cuda.synchronize()
+    return (time.time() - time_begin) / iterations
+
+
+reference = get_attn_backend("matmul")
+torch.manual_seed(0)
+
+for batch_size, q_len, past_len, num_heads, num_kv_heads, masked in shapes:
+
+    kv_len = past_len + q_len
+    q = torch.randn((batch_size, q_len, num_heads, head_dim), dtype = dtype, device = device)
+    k = torch.randn((batch_size, kv_len, num_kv_heads, head_dim), dtype = dtype, device = device)
+    v = torch.randn((batch_size, kv_len, num_kv_heads, head_dim), dtype = dtype, device = device)
+    mask = make_mask(batch_size, q_len, past_len, masked)
+    visible = visible_rows(mask, batch_size, q_len)
+    ref = torch.where(visible, reference.forward(q, k, v, mask).float(), 0.0)
+
+    print(f" -- bsz {batch_size}, q_len {q_len}, past_len {past_len}, heads {num_heads}/{num_kv_heads}, "
+          f"{'padding mask' if masked else 'causal'}")
+
+    for backend in attn_backends():
+        if not backend.available() or not backend.supports(q, k, masked): continue
+        attn_mask = mask if backend.supports_mask else None
+        out = backend.forward(q, k, v, attn_mask)
+        diff = (torch.where(visible, out.float(), 0.0) - ref).abs().max().item()
+        assert diff < 1e-2, f"Mismatch in {backend.name}, max diff {diff}"
+        t = timed(lambda: backend.forward(q, k, v, attn_mask))
+        print(f"    {backend.name:12} {t * 1000:8.3f} ms   max diff {diff:.5f}")
@@ -0,0 +1,47 @@
+import sys, os, time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from exllamav2.attn import ExLlamaV2Attention, ExLlamaV2AttnMaskCache
+
+# Check masks from ExLlamaV2AttnMaskCache against freshly built masks for a chunked, padded batch prefill followed by
+# decode steps, then compare the time spent building masks with and without the cache. Runs on the GPU if available
+
+device = "cuda:0" if torch.cuda.is_available() else "cpu"
+batch_size = 4
+prompt_len = 2048
+chunk_size = 256
+decode_steps = 256
+
+
+def padding_mask(batch_size, length):
+
+    mask = torch.zeros((batch_size, length), dtype = torch.float16)
+    for i in range(batch_size): mask[i, : i * 17] = float("-inf")
+    return mask
+
+
+def mask_sequence(mask_cache, input_mask, check = False):
+
+    past_len = 0
+    steps = [chunk_size] * (prompt_len // chunk_size) + [1] * decode_steps
+    for seq_len in steps:
+        for im in [None, input_mask]:
+            params = ExLlamaV2Attention.Params(batch_size, seq_len, past_len, im, None, mask_cache)
+            mask = params.get_attn_mask(device)
+            if check and mask is not None:
+                ref = params.build_single_attn_mask(batch_size, seq_len, past_len, device, im)
+                assert torch.equal(mask.expand_as(ref), ref), f"Mismatch, seq_len {seq_len}, past_len {past_len}, masked {im is not None}"
+        past_len += seq_len
+    if device != "cpu": torch.cuda.synchronize()
+
+
+input_mask = padding_mask(batch_size, prompt_len)
+mask_sequence(ExLlamaV2AttnMaskCache(), input_mask, check = True)
+print(" -- Cached masks match")
+
+for name, mask_cache in [("uncached", None), ("cached", ExLlamaV2AttnMaskCache())]:
+    mask_sequence(mask_cache, input_mask)
+    time_begin = time.time()
+    mask_sequence(mask_cache, input_mask)
+    print(f" -- {name}: {(time.time() - time_begin) * 1000:8.2f} ms")
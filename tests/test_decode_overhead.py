@@ -0,0 +1,67 @@
+import sys, os, time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from exllamav2 import ExLlamaV2, ExLlamaV2Config, ExLlamaV2CacheBase
+
+# Measure per-token Python overhead of ExLlamaV2.forward for single-token passes, with and without the precomputed
+# decode plan. Modules are stubs that return their input, so only the dispatch cost is measured and everything runs
+# on the CPU
+
+num_layers = 32
+num_tokens = 5000
+
+
+class StubModule:
+
+    def __init__(self, device_idx):
+        self.device_idx = device_idx
+        self.padding = 0
+
+    def forward(self, hidden_states, cache = None, attn_params = None, past_len = None, loras = None, intermediates = False):
+        return hidden_states
+
+
+class StubCache(ExLlamaV2CacheBase):
+
+    def __init__(self, max_seq_len):
+        self.max_seq_len = max_seq_len
+        self.batch_size = 1
+        self.current_seq_len = 0
+
+
+config = ExLlamaV2Config()
+config.max_seq_len = num_tokens + 1
+
+model = ExLlamaV2.__new__(ExLlamaV2)
+model.config = config
+model.modules = [StubModule(-1) for _ in range(num_layers * 2 + 3)]
+model.head_layer_idx = len(model.modules) - 1
+model.last_kv_layer_idx = len(model.modules) - 3
+model.decode_plan = None
+model.offload = None
+
+cache = StubCache(num_tokens + 1)
+input_ids = torch.zeros((1, 1), dtype = torch.long)
+
+results = {}
+for use_plan in [False, True]:
+
+    config.use_decode_plan = use_plan
+    model.decode_plan = None
+    cache.current_seq_len = 0
+
+    for _ in range(100): model.forward(input_ids, cache)
+    cache.current_seq_len = 0
+
+    time_begin = time.time()
+    for _ in range(num_tokens):
+        model.forward(input_ids, cache)
+    elapsed = time.time() - time_begin
+
+    assert cache.current_seq_len == num_tokens
+    results[use_plan] = elapsed / num_tokens
+    print(f" -- {'decode plan' if use_plan else 'generic path'}: {elapsed / num_tokens * 1e6:8.2f} us/token "
+          f"({len(model.modules)} modules)")
+
+print(f" -- Overhead reduction: {(1 - results[True] / results[False]) * 100:.1f}%")
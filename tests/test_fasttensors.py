@@ -67,10 +67,21 @@ for stfile in stfiles:
     t = time.time() - t
     print(f"Time: {t:.4f} s, {stfile_size / t / 1024**3:.4f} GB/s")
 
+    tensors3 = {}
+
+    t = time.time()
+    for k in keys:
+        tensor = sttest.get_tensor(k, device = "cpu", mmap_cpu = True)
+        tensors3[k] = tensor
+    t = time.time() - t
+    print(f"Time: {t:.4f} s (mmap, CPU)")
+
     for k in sttest.get_dict().keys():
         a = tensors1[k]
         b = tensors2[k]
+        c = tensors3[k]
         assert a.equal(b), k
+        assert a.cpu().equal(c), k
 
     print("ok")
 
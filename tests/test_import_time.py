@@ -0,0 +1,41 @@
+import sys, os, subprocess, time
+
+# Measure import time of the tokenizer-only path vs. the full model path, each in a fresh interpreter, and check that
+# importing the config and tokenizer doesn't load the extension or initialize CUDA
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+repeats = 5
+
+light_import = """
+import sys, torch
+from exllamav2 import ExLlamaV2Config, ExLlamaV2Tokenizer
+assert "exllamav2.ext" not in sys.modules, "Extension was loaded"
+assert "exllamav2.model" not in sys.modules, "Model module was loaded"
+assert not torch.cuda.is_initialized(), "CUDA was initialized"
+"""
+
+full_import = """
+from exllamav2 import ExLlamaV2, ExLlamaV2Config, ExLlamaV2Tokenizer
+from exllamav2.generator import ExLlamaV2StreamingGenerator
+"""
+
+baseline_import = """
+import torch
+"""
+
+def measure(code):
+
+    times = []
+    for _ in range(repeats):
+        time_begin = time.time()
+        subprocess.run([sys.executable, "-c", code], check = True, cwd = package_dir)
+        times.append(time.time() - time_begin)
+    return min(times)
+
+t_base = measure(baseline_import)
+t_light = measure(light_import)
+t_full = measure(full_import)
+
+print(f" -- torch only:       {t_base:7.3f} s")
+print(f" -- config/tokenizer: {t_light:7.3f} s  (+{t_light - t_base:.3f} s over torch)")
+print(f" -- full:             {t_full:7.3f} s  (+{t_full - t_base:.3f} s over torch)")
@@ -0,0 +1,175 @@
+import sys, os, time, random, math
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch import nn
+from exllamav2.attn import ExLlamaV2Attention
+from exllamav2.cache import ExLlamaV2CacheBase
+
+# Validate batched attention over multiple caches with ragged past_lens against the per-cache reference loop, and
+# time both. The batched path gathers each sequence's whole K/V history into a padded batch per layer, so the long
+# ragged cases show where that copy stops paying for itself. Uses random Q/K/V and stub caches, so no model is needed.
+# Runs on the CPU unless a GPU is available
+
+device = "cuda:0" if torch.cuda.is_available() else "cpu"
+num_attention_heads = 32
+num_key_value_heads = 8
+head_dim = 128
+max_seq_len = 2048
+iterations = 20
+
+
+class StubConfig:
+
+    def __init__(self):
+        self.num_attention_heads = num_attention_heads
+        self.num_key_value_heads = num_key_value_heads
+        self.num_key_value_groups = num_attention_heads // num_key_value_heads
+        self.head_dim = head_dim
+        self.no_flash_attn = False
+        self.attn_backend = None
+
+
+class StubModel:
+
+    def __init__(self):
+        self.config = StubConfig()
+
+
+class StubCache(ExLlamaV2CacheBase):
+
+    def __init__(self, past_len):
+        self.max_seq_len = max_seq_len
+        self.batch_size = 1
+        self.current_seq_len = past_len
+        shape = (1, max_seq_len, num_key_value_heads, head_dim)
+        self.key_states = [torch.randn(shape, dtype = torch.float16, device = device)]
+        self.value_states = [torch.randn(shape, dtype = torch.float16, device = device)]
+
+    def clone(self):
+        c = StubCache.__new__(StubCache)
+        c.max_seq_len = self.max_seq_len
+        c.batch_size = 1
+        c.current_seq_len = self.current_seq_len
+        c.key_states = [t.clone() for t in self.key_states]
+        c.value_states = [t.clone() for t in self.value_states]
+        return c
+
+    def get_kv_state(self, layer_idx, batch_size, offset, width):
+        return self.key_states[layer_idx], self.value_states[layer_idx]
+
+    def store_kv_state(self, layer_idx, batch_size, offset, width):
+        pass
+
+
+# Reference: attention over one cache at a time, as ExLlamaV2Attention did before multi_cache_attn
+
+def multi_cache_attn_loop(attn, q_states, k_states, v_states, cache, attn_params, past_len):
+
+    num_key_value_groups = attn.model.config.num_key_value_groups
+    head_dim = attn.model.config.head_dim
+    q_len = q_states.shape[1]
+
+    attn_outputs = []
+    for i in range(len(cache)):
+
+        # Add keys and values to cache
+
+        batch_keys, batch_values = cache[i].get_kv_state(attn.layer_idx, 1, 0, past_len[i])
+        new_keys = batch_keys.narrow(1, past_len[i], q_len)
+        new_values = batch_values.narrow(1, past_len[i], q_len)
+        new_keys.copy_(k_states.narrow(0, i, 1))
+        new_values.copy_(v_states.narrow(0, i, 1))
+
+        # Store updated cache values
+
+        cache[i].store_kv_state(attn.layer_idx, 1, past_len[i], q_len)
+
+        # Key/value tensors with past
+
+        k_states_b = batch_keys.narrow(1, 0, past_len[i] + q_len)
+        v_states_b = batch_values.narrow(1, 0, past_len[i] + q_len)
+
+        # Causal mask for this cache, combined with its row of the input mask if any
+
+        attn_mask = None
+        if attn_params.input_mask is not None or q_len > 1:
+            input_mask = attn_params.input_mask[i : i + 1] if attn_params.input_mask is not None else None
+            attn_mask = attn_params.build_single_attn_mask(1, q_len, past_len[i], q_states.device, input_mask)
+
+        # Torch matmul attention
+
+        q_states_b = q_states.transpose(1, 2).narrow(0, i, 1)
+        k_states_b = k_states_b.transpose(1, 2)
+        v_states_b = v_states_b.transpose(1, 2)
+
+        k_states_b = attn.repeat_kv(k_states_b, num_key_value_groups)
+        k_states_b = k_states_b.transpose(-1, -2)
+
+        attn_weights = torch.matmul(q_states_b, k_states_b)
+        q_states_b = None
+        k_states_b = None
+
+        attn_weights /= math.sqrt(head_dim)
+        if attn_mask is not None: attn_weights = attn_weights + attn_mask
+        attn_weights = nn.functional.softmax(attn_weights, dim = -1, dtype = torch.float16)
+
+        v_states_b = attn.repeat_kv(v_states_b, num_key_value_groups)
+        attn_output_b = torch.matmul(attn_weights, v_states_b)
+        v_states_b = None
+
+        attn_outputs.append(attn_output_b)
+
+    return torch.cat(attn_outputs, dim = 0).transpose(1, 2)
+
+
+attn = ExLlamaV2Attention.__new__(ExLlamaV2Attention)
+attn.model = StubModel()
+attn.layer_idx = 0
+ref_func = lambda *args: multi_cache_attn_loop(attn, *args)
+
+
+def run(func, caches, q, k, v):
+
+    past_len = [c.current_seq_len for c in caches]
+    params = ExLlamaV2Attention.Params(len(caches), q.shape[1], past_len, None, None)
+    out = func(q, k, v, caches, params, past_len)
+    if device != "cpu": torch.cuda.synchronize()
+    return out
+
+
+random.seed(0)
+torch.manual_seed(0)
+
+for batch_size, q_len, min_past, max_past in [(1, 1, 0, 1024),
+                                              (4, 1, 0, 1024),
+                                              (8, 1, 0, 1024),
+                                              (16, 1, 0, 1024),
+                                              (4, 16, 0, 1024),
+                                              (8, 128, 0, 1024),
+                                              (4, 1, 64, 1900),
+                                              (16, 1, 1024, 1900)]:
+
+    past_len = [random.randint(min_past, max_past) for _ in range(batch_size)]
+    caches = [StubCache(p) for p in past_len]
+    q = torch.randn((batch_size, q_len, num_attention_heads, head_dim), dtype = torch.float16, device = device)
+    k = torch.randn((batch_size, q_len, num_key_value_heads, head_dim), dtype = torch.float16, device = device)
+    v = torch.randn((batch_size, q_len, num_key_value_heads, head_dim), dtype = torch.float16, device = device)
+
+    caches_ref = [c.clone() for c in caches]
+    out = run(attn.multi_cache_attn, caches, q, k, v)
+    ref = run(ref_func, caches_ref, q, k, v)
+
+    diff = (out.float() - ref.float()).abs().max().item()
+    assert diff < 1e-2, f"Mismatch, batch_size {batch_size}, q_len {q_len}, max diff {diff}"
+    for c, r in zip(caches, caches_ref):
+        assert torch.equal(c.key_states[0], r.key_states[0]) and torch.equal(c.value_states[0], r.value_states[0])
+
+    timings = []
+    for func in [ref_func, attn.multi_cache_attn]:
+        time_begin = time.time()
+        for _ in range(iterations): run(func, caches, q, k, v)
+        timings.append((time.time() - time_begin) / iterations)
+
+    print(f" -- bsz {batch_size:3}, q_len {q_len:4}, max past {max(past_len):4}, max diff {diff:.5f}   loop: {timings[0] * 1000:8.3f} ms   "
+          f"batched: {timings[1] * 1000:8.3f} ms   speedup: {timings[0] / timings[1]:.2f}x")
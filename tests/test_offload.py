@@ -0,0 +1,62 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exllamav2 import(
+    ExLlamaV2,
+    ExLlamaV2Config,
+)
+
+import torch
+
+# Compare logits from layer-streaming offload with a small residency budget against the same model with every
+# module resident. Defaults to device_idx = -1, which runs the whole model on the CPU and exercises the residency
+# logic without a GPU (use a small unquantized model for that). Pass a device index to test uploads and prefetching
+
+model_directory = "/mnt/str/models/tinyllama-1.1b/"
+device_idx = int(sys.argv[1]) if len(sys.argv) > 1 else -1
+seq_len = 16
+passes = 3
+
+config = ExLlamaV2Config()
+config.model_dir = model_directory
+config.prepare()
+config.max_seq_len = seq_len
+config.max_input_len = seq_len
+
+input_ids = torch.randint(0, config.vocab_size, (1, seq_len))
+
+def run(max_resident):
+
+    model = ExLlamaV2(config)
+    model.load_offload(device_idx = device_idx, max_resident = max_resident)
+
+    offload = model.offload
+    total = sum(offload.footprints)
+    logits = [model.forward(input_ids).float().cpu() for _ in range(passes)]
+
+    # The module being run is always loaded, even when pinned modules already take up the budget
+
+    stats = offload.get_stats()
+    pinned_bytes = sum(offload.footprints[i] for i in offload.pinned)
+    limit = max(max_resident, pinned_bytes + max(offload.footprints))
+    assert stats["resident_bytes"] + stats["staged_bytes"] <= limit, "Residency budget exceeded"
+    print(f" -- max_resident {max_resident / 1024 ** 2:10.1f} MB of {total / 1024 ** 2:.1f} MB: "
+          f"{stats['hits']} hits, {stats['loads']} loads, {stats['bytes_uploaded'] / 1024 ** 2:.1f} MB uploaded")
+
+    model.unload()
+    return logits, total
+
+
+# Everything resident
+
+logits_ref, total = run(2 ** 62)
+
+# Streaming with a quarter of the weights resident, then with only the pinned modules
+
+for max_resident in [total // 4, 1]:
+    logits, _ = run(max_resident)
+    for a, b in zip(logits, logits_ref):
+        diff = (a - b).abs().max().item()
+        assert diff < 1e-3, f"Offloaded logits differ from resident ones, max diff {diff}"
+
+print(" -- Offloaded logits match")
@@ -0,0 +1,57 @@
+import sys, os, time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from exllamav2 import ExLlamaV2, ExLlamaV2Config
+
+# Time the head layer's dense forward pass against forward_rows for constrained vocabularies of various sizes. FP16
+# heads gather the allowed rows of the weight, quantized heads run the dense kernel and select outputs. For quantized
+# heads, also time reconstructing the full matrix and gathering from it, to show why that isn't done
+
+model_dir = sys.argv[1] if len(sys.argv) > 1 else "/mnt/str/models/_exl2/llama2-7b-exl2/4.0bpw/"
+iterations = 100
+
+config = ExLlamaV2Config()
+config.model_dir = model_dir
+config.prepare()
+model = ExLlamaV2(config)
+model.load()
+
+head = model.modules[model.head_layer_idx]
+device = head.device()
+hidden_states = torch.randn((1, 1, config.hidden_size), dtype = torch.half, device = device)
+
+
+def timed(func):
+
+    func()
+    torch.cuda.synchronize()
+    time_begin = time.time()
+    for _ in range(iterations): func()
+    torch.cuda.synchronize()
+    return (time.time() - time_begin) / iterations
+
+
+with torch.inference_mode():
+
+    print(f" -- Head: {head.out_features} x {head.in_features}, {'quantized' if head.is_quant() else 'FP16'}")
+    t_dense = timed(lambda: head.forward(hidden_states))
+    print(f" -- dense:                  {t_dense * 1e6:10.2f} us")
+
+    for num_rows in [16, 256, 4096]:
+
+        row_ids = torch.randperm(head.out_features)[:num_rows].sort().values
+        dense = head.forward(hidden_states).index_select(-1, row_ids.to(device))
+        sparse = head.forward_rows(hidden_states, row_ids)
+        assert (dense.float() - sparse.float()).abs().max().item() < 1e-1
+
+        # New row set every step, as with regex/JSON filters
+
+        sets = [torch.randperm(head.out_features)[:num_rows].sort().values for _ in range(iterations + 1)]
+        it = iter(sets * 2)
+        t_sparse = timed(lambda: head.forward_rows(hidden_states, next(it)))
+        print(f" -- forward_rows, {num_rows:5} rows: {t_sparse * 1e6:10.2f} us   ({t_dense / t_sparse:.2f}x dense)")
+
+        if head.is_quant():
+            t_recons = timed(lambda: torch.matmul(hidden_states, head.get_weight_tensor_dq().index_select(1, row_ids.to(device))))
+            print(f"    reconstruct + gather:   {t_recons * 1e6:10.2f} us   ({t_dense / t_recons:.2f}x dense)")
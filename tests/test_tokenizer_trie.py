@@ -0,0 +1,105 @@
+import sys, os, time, random, tracemalloc
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exllamav2 import ExLlamaV2Config
+from exllamav2 import ExLlamaV2Tokenizer
+
+# Compare the array-backed character trie with the previous nested-dict trie: build time, memory and walk speed
+
+# model_path = "/mnt/str/models/_exl2/llama2-7b-exl2/4.0bpw/"
+model_path = "/mnt/str/models/_exl2/qwen-72b-llamafied/"
+
+config = ExLlamaV2Config()
+config.model_dir = model_path
+config.prepare(no_tensors = True)
+tokenizer = ExLlamaV2Tokenizer(config, lazy_init = True)
+id_to_piece = tokenizer.get_id_to_piece_list()
+
+print(f" -- Vocabulary size: {len(id_to_piece)}")
+
+
+# Reference implementation
+
+class NestedTrie:
+
+    def __init__(self):
+        self.children = {}
+        self.leaf = []
+
+def make_nested_trie(ci):
+
+    trie = NestedTrie()
+    for idx, piece in enumerate(id_to_piece):
+        if ci: piece = piece.lower()
+        w = trie
+        while piece != "":
+            p = piece[0]
+            piece = piece[1:]
+            if p not in w.children: w.children[p] = NestedTrie()
+            w = w.children[p]
+            if piece == "": w.leaf.append(idx)
+    return trie
+
+
+def measure_build(fn):
+
+    tracemalloc.start()
+    time_begin = time.time()
+    trie = fn()
+    time_end = time.time()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return trie, time_end - time_begin, size, peak
+
+
+def walk(trie):
+
+    num_nodes = 0
+    num_leaves = 0
+    stack = [trie]
+    while stack:
+        w = stack.pop()
+        num_nodes += 1
+        num_leaves += len(w.leaf)
+        for _, child in w.children.items(): stack.append(child)
+    return num_nodes, num_leaves
+
+
+def lookup(trie, strings):
+
+    found = 0
+    for s in strings:
+        w = trie
+        for c in s:
+            if c in w.children: w = w.children[c]
+            else: break
+            found += len(w.leaf)
+    return found
+
+
+random.seed(0)
+strings = [id_to_piece[random.randrange(len(id_to_piece))] + id_to_piece[random.randrange(len(id_to_piece))] for _ in range(100000)]
+
+results = {}
+for name, fn in [("nested", lambda: make_nested_trie(False)),
+                 ("array", lambda: tokenizer._make_trie(False))]:
+
+    trie, build_time, size, peak = measure_build(fn)
+
+    time_begin = time.time()
+    num_nodes, num_leaves = walk(trie)
+    walk_time = time.time() - time_begin
+
+    time_begin = time.time()
+    found = lookup(trie, strings)
+    lookup_time = time.time() - time_begin
+
+    results[name] = (num_nodes, num_leaves, found)
+
+    print(f" -- {name:6}  build: {build_time:7.3f} s   retained: {size / 1024**2:8.2f} MB   peak: {peak / 1024**2:8.2f} MB   "
+          f"walk: {walk_time:7.3f} s   lookup: {lookup_time:7.3f} s   nodes: {num_nodes}")
+
+    del trie
+
+assert results["nested"] == results["array"], "Trie contents differ"
+print(" -- Tries match")
@@ -0,0 +1,48 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from exllamav2 import ExLlamaV2, ExLlamaV2Config
+from exllamav2.tuner import autotune
+
+# Pick max_batch_size, max_input_len, max_attention_size and cache size for a workload and memory budget, without
+# loading the model
+
+parser = argparse.ArgumentParser(description = "Tune batch size, input length and cache size for a memory budget")
+parser.add_argument("model_dir", type = str, help = "Path to model directory")
+parser.add_argument("-gm", "--gpu_memory", type = str, required = True, help = "Memory per GPU in GB, comma-separated")
+parser.add_argument("-pl", "--prompt_lengths", type = str, required = True, help = "Sample of prompt lengths, comma-separated, or path to a file with one length per line")
+parser.add_argument("-cl", "--completion_length", type = int, default = 256, help = "Tokens generated per prompt")
+parser.add_argument("-cc", "--concurrency", type = int, default = 1, help = "Max. number of sequences served at once")
+parser.add_argument("-c8", "--cache_8bit", action = "store_true", help = "Use 8-bit cache")
+parser.add_argument("-bw", "--bandwidth", type = float, default = 900, help = "Device memory bandwidth, GB/s")
+parser.add_argument("-tf", "--tflops", type = float, default = 80, help = "Device FP16 throughput, TFLOPS")
+args = parser.parse_args()
+
+if os.path.exists(args.prompt_lengths):
+    with open(args.prompt_lengths) as f:
+        prompt_lengths = [int(line) for line in f if line.strip()]
+else:
+    prompt_lengths = [int(x) for x in args.prompt_lengths.split(",")]
+
+config = ExLlamaV2Config()
+config.model_dir = args.model_dir
+config.prepare()
+
+model = ExLlamaV2(config)
+
+device_memory = [int(float(g) * 1024**3) for g in args.gpu_memory.split(",")]
+result = autotune(model,
+                  device_memory,
+                  prompt_lengths,
+                  completion_length = args.completion_length,
+                  concurrency = args.concurrency,
+                  cache_8bit = args.cache_8bit,
+                  bandwidth = args.bandwidth * 1e9,
+                  flops = args.tflops * 1e12)
+
+print(f" -- Model: {args.model_dir}")
+print(f" -- Workload: {len(prompt_lengths)} prompts, {min(prompt_lengths)}-{max(prompt_lengths)} tokens, "
+      f"{args.completion_length} tokens generated, concurrency {args.concurrency}")
+print(result.report())
+print(f" -- device_map: {result.plan.device_map}")
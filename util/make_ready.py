@@ -0,0 +1,27 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse, time
+from exllamav2 import ExLlamaV2, ExLlamaV2Config
+from exllamav2.ready import export_ready, ready_filename
+
+parser = argparse.ArgumentParser(description = "Write a ready-to-load container for a model, read instead of the .safetensors files when present")
+parser.add_argument("model_dir", type = str, help = "Path to model directory")
+parser.add_argument("-o", "--output", type = str, help = f"Output file (default: {ready_filename} in model directory)")
+args = parser.parse_args()
+
+config = ExLlamaV2Config()
+config.model_dir = args.model_dir
+config.use_ready_file = False
+config.prepare()
+
+model = ExLlamaV2(config, lazy_load = True)
+
+def callback(idx, num_modules):
+    print(f" -- Writing module {idx + 1}/{num_modules}" if idx < num_modules else " -- Done writing", end = "\r" if idx < num_modules else "\n")
+
+time_begin = time.time()
+filename = export_ready(model, args.output, callback = callback)
+time_end = time.time()
+
+print(f" -- Wrote {filename}: {os.path.getsize(filename) / 1024**3:.2f} GB in {time_end - time_begin:.2f} s")
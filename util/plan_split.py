@@ -0,0 +1,41 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from exllamav2 import ExLlamaV2, ExLlamaV2Config
+from exllamav2.planner import plan_autosplit
+
+# Plan how a model would be split across devices without loading it or touching any GPU. The printed device map can
+# be passed to model.load(device_map = ...)
+
+parser = argparse.ArgumentParser(description = "Plan device split for a model and cache without loading it")
+parser.add_argument("model_dir", type = str, help = "Path to model directory")
+parser.add_argument("-gm", "--gpu_memory", type = str, required = True, help = "Memory per GPU in GB, comma-separated")
+parser.add_argument("-l", "--length", type = int, help = "Cache length (default: model's max_seq_len)")
+parser.add_argument("-bs", "--batch_size", type = int, default = 1, help = "Cache batch size")
+parser.add_argument("-c8", "--cache_8bit", action = "store_true", help = "Plan for 8-bit cache")
+parser.add_argument("-il", "--max_input_len", type = int, help = "Override config.max_input_len")
+parser.add_argument("-as", "--max_attention_size", type = int, help = "Override config.max_attention_size")
+parser.add_argument("-mb", "--max_batch_size", type = int, help = "Override config.max_batch_size")
+parser.add_argument("-dm", "--device_map", action = "store_true", help = "Print device map")
+args = parser.parse_args()
+
+config = ExLlamaV2Config()
+config.model_dir = args.model_dir
+config.prepare()
+if args.length: config.max_seq_len = args.length
+if args.max_input_len: config.max_input_len = args.max_input_len
+if args.max_attention_size: config.max_attention_size = args.max_attention_size
+if args.max_batch_size: config.max_batch_size = args.max_batch_size
+
+model = ExLlamaV2(config)
+
+device_memory = [int(float(g) * 1024**3) for g in args.gpu_memory.split(",")]
+plan = plan_autosplit(model, device_memory, max_seq_len = args.length, batch_size = args.batch_size, cache_8bit = args.cache_8bit)
+
+print(f" -- Model: {args.model_dir}")
+print(f" -- Cache: {args.length or config.max_seq_len} tokens x {args.batch_size}, {'8-bit' if args.cache_8bit else 'FP16'}")
+print(f" -- Config: max_input_len {config.max_input_len}, max_attention_size {config.max_attention_size}, max_batch_size {config.max_batch_size}")
+print(plan.report())
+print(f" -- gpu_split: {','.join(f'{g:.2f}' for g in plan.gpu_split())}")
+if args.device_map: print(f" -- device_map: {plan.device_map}")